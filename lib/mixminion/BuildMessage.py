@@ -20,8 +20,9 @@ import mixminion._minionlib
 if sys.version_info[:3] < (2,2,0):
     import mixminion._zlibutil as zlibutil
 
-__all__ = ['buildForwardPacket', 'buildEncryptedForwardPacket',
-           'buildReplyPacket', 'buildReplyBlock', 'checkPathLength',
+__all__ = ['buildForwardPacket', 'buildForwardPackets',
+           'buildEncryptedForwardPacket', 'buildReplyPacket',
+           'buildReplyPackets', 'buildReplyBlock', 'checkPathLength',
            'encodeMessage', 'decodePayload', 'getNPacketsToEncode' ]
 
 def getNPacketsToEncode(message, overhead, uncompressedFragmentPrefix=""):
@@ -107,7 +108,7 @@ def buildRandomPayload(paddingPRNG=None):
     return paddingPRNG.getBytes(PAYLOAD_LEN)
 
 def buildForwardPacket(payload, exitType, exitInfo, path1, path2,
-                       paddingPRNG=None, suppressTag=0):
+                       paddingPRNG=None, suppressTag=0, routingCache=None):
     """Construct a forward message.
             payload: The payload to deliver.  Must be exactly 28K.  If the
                   payload is None, 28K of random data is sent.
@@ -119,6 +120,8 @@ def buildForwardPacket(payload, exitType, exitInfo, path1, path2,
                   If None, a new PRNG is initialized.
             suppressTag: if true, do not include a decodind handle in the
                   routingInfo for this packet.
+            routingCache: a RoutingCache to look up routing information for
+                  the servers on the path, or None.
 
         Neither path1 nor path2 may be empty.  If one is, MixError is raised.
     """
@@ -141,7 +144,26 @@ def buildForwardPacket(payload, exitType, exitInfo, path1, path2,
         tag = _getRandomTag(paddingPRNG)
         exitInfo = tag + exitInfo
     return _buildPacket(payload, exitType, exitInfo, path1, path2,
-                        paddingPRNG,suppressTag=suppressTag)
+                        paddingPRNG,suppressTag=suppressTag,
+                        routingCache=routingCache)
+
+def buildForwardPackets(payloads, exitType, exitInfo, paths,
+                        paddingPRNG=None, suppressTag=0):
+    """Construct one forward packet for each payload in 'payloads'.  'paths'
+       is a list of (path1, path2) tuples, one for each payload.  Other
+       arguments are as for buildForwardPacket.  Return a list of packets.
+
+       This is faster than calling buildForwardPacket for each payload,
+       since we only compute the routing information for each server once.
+    """
+    assert len(payloads) == len(paths)
+    if paddingPRNG is None:
+        paddingPRNG = Crypto.getCommonPRNG()
+    cache = RoutingCache()
+    return [ buildForwardPacket(payload, exitType, exitInfo, path1, path2,
+                                paddingPRNG, suppressTag=suppressTag,
+                                routingCache=cache)
+             for payload, (path1, path2) in zip(payloads, paths) ]
 
 
 def buildEncryptedForwardPacket(payload, exitType, exitInfo, path1, path2,
@@ -204,10 +226,13 @@ def buildEncryptedForwardPacket(payload, exitType, exitInfo, path1, path2,
     # And now, we can finally build the message.
     return _buildPacket(payload, exitType, exitInfo, path1, path2,paddingPRNG)
 
-def buildReplyPacket(payload, path1, replyBlock, paddingPRNG=None):
+def buildReplyPacket(payload, path1, replyBlock, paddingPRNG=None,
+                     routingCache=None):
     """Build a message using a reply block.  'path1' is a sequence of
        ServerInfo for the nodes on the first leg of the path.  'payload'
-       must be exactly 28K long.
+       must be exactly 28K long.  If 'routingCache' is provided, it is a
+       RoutingCache to look up routing information for the servers on
+       path1.
     """
     if paddingPRNG is None:
         paddingPRNG = Crypto.getCommonPRNG()
@@ -226,7 +251,24 @@ def buildReplyPacket(payload, path1, replyBlock, paddingPRNG=None):
     payload = Crypto.lioness_decrypt(payload, k)
 
     return _buildPacket(payload, None, None,
-                         path1=path1, path2=replyBlock)
+                         path1=path1, path2=replyBlock,
+                         routingCache=routingCache)
+
+def buildReplyPackets(payloads, paths, replyBlocks, paddingPRNG=None):
+    """Build one reply packet for each payload in 'payloads', using the
+       corresponding path in 'paths' for its first leg, and the
+       corresponding reply block in 'replyBlocks'.  Return a list of
+       packets.
+
+       This is faster than calling buildReplyPacket for each payload,
+       since we only compute the routing information for each server once.
+    """
+    assert len(payloads) == len(paths) == len(replyBlocks)
+    cache = RoutingCache()
+    return [ buildReplyPacket(payload, path1, replyBlock, paddingPRNG,
+                              routingCache=cache)
+             for payload, path1, replyBlock in zip(payloads, paths,
+                                                   replyBlocks) ]
 
 def _buildReplyBlockImpl(path, exitType, exitInfo, expiryTime=0,
                          secretPRNG=None, tag=None):
@@ -319,7 +361,7 @@ def buildReplyBlock(path, exitType, exitInfo, userKey,
     return replyBlock
 
 def checkPathLength(path1, path2, exitType, exitInfo, explicitSwap=0,
-                    suppressTag=0):
+                    suppressTag=0, routingCache=None):
     """Given two path legs (lists of servers), an exit type and an
        exitInfo, raise an error if we can't build a header with the
        provided legs.  If suppressTag is true, no decoding handle will
@@ -327,11 +369,13 @@ def checkPathLength(path1, path2, exitType, exitInfo, explicitSwap=0,
 
        The leg "path1" may be null.
     """
+    if routingCache is None:
+        routingCache = _NO_ROUTING_CACHE
     err = 0 # 0: no error. 1: 1st leg too big. 2: 1st leg okay, 2nd too big.
     if path1 is not None and path2 is not None:
         try:
-            rt,ri = path1[-1].getRoutingFor(path2[0],swap=1)
-            _getRouting(path1, rt, ri)
+            rt,ri = routingCache.getRoutingFor(path1[-1],path2[0],swap=1)
+            _getRouting(path1, rt, ri, routingCache)
         except MixError:
             err = 1
     # Add a dummy tag as needed to last exitinfo.
@@ -344,7 +388,7 @@ def checkPathLength(path1, path2, exitType, exitInfo, explicitSwap=0,
         try:
             if path2 and not isinstance(path2, ReplyBlock):
                 try:
-                    _getRouting(path2, exitType, exitInfo)
+                    _getRouting(path2, exitType, exitInfo, routingCache)
                 except:
                     print ">>>>>",path2
                     raise
@@ -493,7 +537,7 @@ def _decodeStatelessReplyPayload(payload, tag, userKey):
 #----------------------------------------------------------------------
 def _buildPacket(payload, exitType, exitInfo,
                  path1, path2, paddingPRNG=None, paranoia=0,
-                 suppressTag=0):
+                 suppressTag=0, routingCache=None):
     """Helper method to create a message.
 
     The following fields must be set:
@@ -518,8 +562,13 @@ def _buildPacket(payload, exitType, exitInfo,
        paranoia: If this is false, we use the padding PRNG to generate
          header secrets too.  Otherwise, we read all of our header secrets
          from the true entropy source.
+
+       routingCache: A RoutingCache to look up routing information for the
+         servers on the path.
     """
     assert len(payload) == PAYLOAD_LEN
+    if routingCache is None:
+        routingCache = _NO_ROUTING_CACHE
     reply = None
     if isinstance(path2, ReplyBlock):
         reply = path2
@@ -532,7 +581,7 @@ def _buildPacket(payload, exitType, exitInfo,
 
     checkPathLength(path1, path2, exitType, exitInfo,
                     explicitSwap=(reply is None),
-                    suppressTag=suppressTag)
+                    suppressTag=suppressTag, routingCache=routingCache)
 
     ### SETUP CODE: let's handle all the variant cases.
 
@@ -551,7 +600,8 @@ def _buildPacket(payload, exitType, exitInfo,
         path1exittype = reply.routingType
         path1exitinfo = reply.routingInfo
     else:
-        path1exittype, path1exitinfo = path1[-1].getRoutingFor(path2[0],swap=1)
+        path1exittype, path1exitinfo = routingCache.getRoutingFor(
+            path1[-1], path2[0], swap=1)
 
     # Generate secrets for path1.
     secrets1 = [ secretRNG.getBytes(SECRET_LEN) for _ in path1 ]
@@ -560,18 +610,20 @@ def _buildPacket(payload, exitType, exitInfo,
         # Make secrets for header 2, and construct header 2.  We do this before
         # making header1 so that our rng won't be used for padding yet.
         secrets2 = [ secretRNG.getBytes(SECRET_LEN) for _ in range(len(path2))]
-        header2 = _buildHeader(path2,secrets2,exitType,exitInfo,paddingPRNG)
+        header2 = _buildHeader(path2,secrets2,exitType,exitInfo,paddingPRNG,
+                               routingCache)
     else:
         secrets2 = None
         header2 = reply.header
 
     # Construct header1.
     header1 = _buildHeader(path1,secrets1,path1exittype,path1exitinfo,
-                           paddingPRNG)
+                           paddingPRNG, routingCache)
 
     return _constructMessage(secrets1, secrets2, header1, header2, payload)
 
-def _buildHeader(path,secrets,exitType,exitInfo,paddingPRNG):
+def _buildHeader(path,secrets,exitType,exitInfo,paddingPRNG,
+                 routingCache=None):
     """Helper method to construct a single header.
            path: A sequence of serverinfo objects.
            secrets: A list of 16-byte strings to use as master-secrets for
@@ -580,14 +632,18 @@ def _buildHeader(path,secrets,exitType,exitInfo,paddingPRNG):
            exitInfo: The routing info for the last node in the header.
                (Must include 20-byte decoding tag, if any.)
            paddingPRNG: A pseudo-random number generator to generate padding
+           routingCache: A RoutingCache, or None.
     """
     assert len(path) == len(secrets)
+    if routingCache is None:
+        routingCache = _NO_ROUTING_CACHE
 
     for info in path:
-        if not info.supportsPacketVersion():
+        if not routingCache.supportsPacketVersion(info):
             raise MixError("Server %s does not support any recognized packet format."%info.getNickname())
 
-    routing, sizes, totalSize = _getRouting(path, exitType, exitInfo)
+    routing, sizes, totalSize = _getRouting(path, exitType, exitInfo,
+                                            routingCache)
     if totalSize > HEADER_LEN:
         raise MixError("Path cannot fit in header")
 
@@ -732,7 +788,7 @@ def _checkPayload(payload):
     else:
         return payload[2:22] == Crypto.sha1(payload[22:])
 
-def _getRouting(path, exitType, exitInfo):
+def _getRouting(path, exitType, exitInfo, routingCache=None):
     """Given a list of ServerInfo, and a final exitType and exitInfo,
        return a 3-tuple of:
            1) A list of routingtype/routinginfo tuples for the header
@@ -741,11 +797,14 @@ def _getRouting(path, exitType, exitInfo):
            3) Minimum size (in bytes) needed for the header.
 
        Raises MixError if the routing info is too big to fit into a single
-       header. """
+       header.  If 'routingCache' is provided, we use it to look up the
+       routing between servers."""
+    if routingCache is None:
+        routingCache = _NO_ROUTING_CACHE
     # Construct a list 'routing' of exitType, exitInfo.
     routing = []
     for i in xrange(len(path)-1):
-        routing.append(path[i].getRoutingFor(path[i+1],swap=0))
+        routing.append(routingCache.getRoutingFor(path[i],path[i+1],swap=0))
     routing.append((exitType, exitInfo))
 
     # sizes[i] is number of bytes added to header for subheader i.
@@ -764,3 +823,44 @@ def _getRouting(path, exitType, exitInfo):
 
     return routing, sizes, totalSize
 
+class _NoRoutingCache:
+    """Helper: looks up the same information as a RoutingCache, but
+       doesn't remember any of it."""
+    def getRoutingFor(self, server, nextServer, swap=0):
+        return server.getRoutingFor(nextServer, swap=swap)
+    def supportsPacketVersion(self, server):
+        return server.supportsPacketVersion()
+
+_NO_ROUTING_CACHE = _NoRoutingCache()
+
+class RoutingCache(_NoRoutingCache):
+    """A RoutingCache remembers the routing information for relaying from
+       one server to another, and whether servers support our packet
+       format, so that building many packets over the same servers only
+       computes these once.  (Computing routing information involves
+       encoding and hashing the next server's identity key.)
+
+       A RoutingCache holds references to all the servers it has seen, so
+       it should only live as long as a single batch of packets."""
+    ## Fields:
+    # routing: A map from (server, nextServer, swap) to a (routingType,
+    #    routingInfo) tuple.
+    # supported: A map from server to the result of supportsPacketVersion.
+    def __init__(self):
+        self.routing = {}
+        self.supported = {}
+    def getRoutingFor(self, server, nextServer, swap=0):
+        """Return server.getRoutingFor(nextServer, swap)."""
+        key = (server, nextServer, swap)
+        try:
+            return self.routing[key]
+        except KeyError:
+            r = self.routing[key] = server.getRoutingFor(nextServer, swap=swap)
+            return r
+    def supportsPacketVersion(self, server):
+        """Return server.supportsPacketVersion()."""
+        try:
+            return self.supported[server]
+        except KeyError:
+            r = self.supported[server] = server.supportsPacketVersion()
+            return r
@@ -511,6 +511,12 @@ class ClientEnv:
         """
         pass
 
+    def writeFragmentedMessage(self, messageID, out):
+        """As reassembleFragmentedMessage, but write the original message
+           to the file 'out' without holding all of it in memory.
+        """
+        pass
+
     def removeFragmentedMessage(self, messageID):
         """Remove the message 'messageID' from the fragment pool."""
         pass
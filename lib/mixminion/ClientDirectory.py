@@ -23,6 +23,7 @@ import time
 import types
 import rfc822
 import urllib2
+import zlib
 
 from httplib import HTTPException
 
@@ -34,7 +35,7 @@ import mixminion.ServerInfo
 from mixminion.Common import LOG, MixError, MixFatalError, UIError, \
      ceilDiv, createPrivateDir, formatDate, formatFnameTime, openUnique, \
      previousMidnight, readPickled, readPossiblyGzippedFile, \
-     replaceFile, tryUnlink, writePickled, floorDiv, isSMTPMailbox
+     replaceFile, tryUnlink, writeFile, writePickled, floorDiv, isSMTPMailbox
 from mixminion.Packet import MBOX_TYPE, SMTP_TYPE, DROP_TYPE, FRAGMENT_TYPE, \
      parseMBOXInfo, parseRelayInfoByType, parseSMTPInfo, ParseError, \
      ServerSideFragmentedMessage
@@ -90,7 +91,7 @@ class _DescriptorSourceSharedState:
         """
         d = s.getDigest()
         if not self.digestMap.has_key(d):
-            self.digestMap[d] = s['Server']['Valid-Until']
+            self.digestMap[d] = s.getValidUntil()
             self._changed = 1
     def __getstate__(self):
         return self.MAGIC, self.digestMap
@@ -156,6 +157,79 @@ class DescriptorSource:
         """Helper: set the shared state for this object to 'state'."""
         self._s = state
 
+def _summarizeServer(s):
+    """Helper: return a tuple of the fields from the ServerInfo 's' that
+       we need for path selection, for use by _CachedServerInfo."""
+    if isinstance(s, _CachedServerInfo):
+        return s._summary
+    return (s.getNickname(), s.getDigest(), s.getKeyDigest(),
+            s.getPublished(), s.getValidAfter(), s.getValidUntil(),
+            s.getHostname(), s['Incoming/MMTP'].get('Port'),
+            s.getIncomingMMTPProtocols(), s.getOutgoingMMTPProtocols(),
+            s.getCaps(), s.supportsPacketVersion(), s.isValidated())
+
+class _CachedServerInfo(mixminion.ServerInfo.ServerInfo):
+    """A ServerInfo for a descriptor that we loaded from our cache.
+
+       The cache holds only the fields that path selection needs (see
+       _summarizeServer), so that loading it doesn't require parsing every
+       descriptor we know about.  The first time anybody asks for anything
+       else, we parse the descriptor from the text that our
+       DescriptorSource keeps on disk.
+    """
+    ## Fields:
+    # _source: The DescriptorSource that holds the text of this descriptor.
+    # _key: The key that _source uses to find our text.
+    # _summary: A tuple as returned by _summarizeServer.
+    # _info: None, or a ServerInfo parsed from our text.
+    def __init__(self, source, key, summary):
+        """Create a new _CachedServerInfo for the descriptor called 'key'
+           in 'source', given the tuple 'summary' that _summarizeServer
+           returned for it."""
+        self._source = source
+        self._key = key
+        self._summary = summary
+        self._info = None
+
+    def __getattr__(self, name):
+        # Only called when ordinary lookup fails: that is, for the parsed
+        # contents of the descriptor, which live in self._info.
+        if name.startswith("__") or not self.__dict__.has_key("_source"):
+            raise AttributeError(name)
+        return getattr(self._getInfo(), name)
+
+    def _getInfo(self):
+        """Return a ServerInfo parsed from the text of this descriptor."""
+        if self._info is None:
+            LOG.trace("Parsing cached descriptor for %s", self.getNickname())
+            text = self._source._getDescriptorText(self._key)
+            try:
+                info = mixminion.ServerInfo.ServerInfo(string=text,
+                                                       assumeValid=1)
+            except mixminion.Config.ConfigError, e:
+                raise UIError("Cached descriptor for %s is invalid: %s"%(
+                    self.getNickname(), e))
+            if info.getDigest() != self.getDigest():
+                raise UIError("Cached descriptor for %s has changed on disk; "
+                              "try updating the directory."%self.getNickname())
+            self._info = info
+        return self._info
+
+    def getNickname(self): return self._summary[0]
+    def getDigest(self): return self._summary[1]
+    def getKeyDigest(self): return self._summary[2]
+    def getIdentityDigest(self): return self._summary[2]
+    def getPublished(self): return self._summary[3]
+    def getValidAfter(self): return self._summary[4]
+    def getValidUntil(self): return self._summary[5]
+    def getHostname(self): return self._summary[6]
+    def getPort(self): return self._summary[7]
+    def getIncomingMMTPProtocols(self): return self._summary[8]
+    def getOutgoingMMTPProtocols(self): return self._summary[9]
+    def getCaps(self): return self._summary[10]
+    def supportsPacketVersion(self): return self._summary[11]
+    def isValidated(self): return self._summary[12]
+
 class FSBackedDescriptorSource(DescriptorSource):
     """A FSBackedDescriptorStore holds a number of server descriptors in a
        filesystem, one per file.  All files are kept in a single directory,
@@ -164,8 +238,9 @@ class FSBackedDescriptorSource(DescriptorSource):
     ## Fields:
     # directory: the location for this store on the filesystem
     # servers: A map from filename within the directory to tuples of
-    #     (file mtime, ServerInfo).
-    MAGIC = "FBBDS-0.1"
+    #     (file mtime, ServerInfo).  When we save ourself, we store each
+    #     ServerInfo as a tuple from _summarizeServer.
+    MAGIC = "FBBDS-0.2"
     EXPIRY_SLOPPINESS = 7200
     def __init__(self, state):
         """Create a new FSBackedDescriptorSource"""
@@ -244,7 +319,7 @@ class FSBackedDescriptorSource(DescriptorSource):
         for _,s in self.servers.values():
             byNickname.setdefault(s.getNickname().lower(),[]).append(s)
         for fname, (_, s) in self.servers.items():
-            expires = s['Server']['Valid-Until']
+            expires = s.getValidUntil()
             if expires > cutoff:
                 LOG.debug("Removing expired server %s",fname)
                 removed.append(fname)
@@ -308,17 +383,36 @@ class FSBackedDescriptorSource(DescriptorSource):
             del self.servers[fname]
         self._changed = 1
 
+    def _getDescriptorText(self, fname):
+        """Return the text of the descriptor stored in 'fname' within our
+           directory.  (Used by _CachedServerInfo.)"""
+        try:
+            return readPossiblyGzippedFile(os.path.join(self.directory,fname))
+        except (IOError, OSError, zlib.error), e:
+            raise UIError("Couldn't read cached descriptor %s: %s"%(fname,e))
+
     def __getstate__(self):
-        return self.MAGIC, self.servers
+        servers = {}
+        for fname, (mtime, s) in self.servers.items():
+            servers[fname] = (mtime, _summarizeServer(s))
+        return self.MAGIC, servers
 
     def __setstate__(self,state):
+        self.directory = None
         if (type(state) != types.TupleType or len(state)<1 or
-            state[0] != self.MAGIC):
+            state[0] not in (self.MAGIC, "FBBDS-0.1")):
             LOG.warn("Unrecognized state on picked FSBDS; rebuilding.")
             self.servers = {}
             self._changed = 1
-        else:
+        elif state[0] == "FBBDS-0.1":
+            # Stored by an older version, with full ServerInfo objects.
             self.servers = state[1]
+            self._changed = 1
+        else:
+            self.servers = {}
+            for fname, (mtime, summary) in state[1].items():
+                self.servers[fname] = (mtime,
+                                       _CachedServerInfo(self, fname, summary))
             self._changed = 0
 
 class DirectoryBackedDescriptorSource(DescriptorSource):
@@ -329,44 +423,83 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
     ## Fields:
     # fnameBase: The name of the file where we'll store a cached directory.
     #   We may append '.gz' or '_new' or '_new.gz' as appropriate.
-    # serverDir: An instance of mixminion.ServerInfo.ServerDirectory, or
-    #   None.
+    # servers: A list of ServerInfo for all the servers in our directory,
+    #   or None if we have no directory.  When we save ourself, we store
+    #   each ServerInfo as a tuple from _summarizeServer.
+    # goodNicknames: A list of the lowercase nicknames of the servers
+    #   that our directory recommends.
+    # recommendedVersions: A 2-tuple of the lists of software versions
+    #   that our directory recommends for clients and for servers.
+    # _descriptorText: None, or a map from descriptor digest to the text of
+    #   each descriptor in our cached directory.  Not saved.
     # lastDownload: When did we last download the directory?
     # __downloading: Boolean: are we currently downloading a new directory?
     # timeout: How long do we wait when trying to download?  A number
     #   of seconds, or None.
-    MAGIC = "BDBS-0.1"
+    MAGIC = "BDBS-0.2"
     def __init__(self, state):
         """Create a new DirectoryBackedDescriptorSource"""
         DescriptorSource.__init__(self)
         self._setSharedState(state)
         self.fnameBase = None
-        self.serverDir = None
+        self._setDirectory(None)
         self.lastDownload = 0
         self._changed = 1
         self.__downloading = 0
         self.timeout = None
 
     def getServerList(self):
-        if self.serverDir is None:
+        if self.servers is None:
             return []
         else:
-            return self.serverDir.getAllServers()
+            return self.servers
 
     def getRecommendedNicknames(self):
-        if self.serverDir is None:
-            return []
-        else:
-            return self.serverDir.getRecommendedNicknames()
+        return self.goodNicknames
 
     def getRecommendedVersions(self):
         """Return a 2-tuple of the software versions recommended for clients
            and servers by the directory."""
-        if self.serverDir == None:
-            return [], []
-        sec = self.serverDir['Recommended-Software']
-        return (sec.get("MixminionClient",[]),
-                sec.get("MixminionServer",[]))
+        return self.recommendedVersions
+
+    def _setDirectory(self, serverDir):
+        """Helper: remember the servers and recommendations from the parsed
+           directory 'serverDir', which may be None."""
+        self._descriptorText = None
+        if serverDir is None:
+            self.servers = None
+            self.goodNicknames = []
+            self.recommendedVersions = ([], [])
+            return
+        self.servers = serverDir.getAllServers()
+        self.goodNicknames = serverDir.getRecommendedNicknames()
+        sec = serverDir['Recommended-Software']
+        self.recommendedVersions = (sec.get("MixminionClient",[]),
+                                    sec.get("MixminionServer",[]))
+
+    def _getDescriptorText(self, digest):
+        """Return the text of the descriptor in our cached directory whose
+           digest is 'digest'.  (Used by _CachedServerInfo.)"""
+        if self._descriptorText is None:
+            contents = None
+            for ext in "", ".gz":
+                fname = self.fnameBase + ext
+                if not os.path.exists(fname):
+                    continue
+                try:
+                    contents = readPossiblyGzippedFile(fname)
+                except (IOError, OSError, zlib.error), e:
+                    raise UIError("Couldn't read cached directory: %s"%e)
+            if contents is None:
+                raise UIError("Cached directory is missing; try updating "
+                              "the directory.")
+            self._descriptorText = \
+                      mixminion.ServerInfo.getDescriptorsByDigest(contents)
+        try:
+            return self._descriptorText[digest]
+        except KeyError:
+            raise UIError("Cached directory has changed on disk; try "
+                          "updating the directory.")
 
     def configure(self, config):
         self.fnameBase = os.path.join(config.getDirectoryRoot(), "dir")
@@ -388,16 +521,17 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
                 if not os.path.exists(fname):
                     continue
                 serverDir = mixminion.ServerInfo.parseDirectory(
-                    fname=fname, validatedDigests=self._s.digestMap)
+                    fname=fname, validatedDigests=self._s.digestMap,
+                    knownServers=self._getKnownServers())
                 lastDownload = os.stat(fname)[stat.ST_MTIME]
             if serverDir is None:
                 return
-            self.serverDir = serverDir
+            self._setDirectory(serverDir)
             self.lastDownload = lastDownload
         except mixminion.Config.ConfigError, e:
             LOG.warn("Found invalid cached directory; not using: %s",e)
             return
-        for s in self.serverDir.getAllServers():
+        for s in self.servers:
             self._s._addDigest(s)
         self._changed = 1
 
@@ -416,7 +550,7 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         if url is None:
             url = MIXMINION_DIRECTORY_URL
 
-        if (self.serverDir is None or forceDownload or
+        if (self.servers is None or forceDownload or
             self.lastDownload < previousMidnight(now)):
             self.downloadDirectory(url=url,lock=lock)
         else:
@@ -455,12 +589,72 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
 
     def _downloadDirectoryImpl(self, url, lock=None):
         """Helper function: does the actual work of fetching a directory."""
-        LOG.info("Downloading directory from %s", url)
-        # XXXX Refactor download logic.
-        if self.timeout:
-            mixminion.NetUtils.setGlobalTimeout(self.timeout)
         if lock is None:
             lock = RWLock()
+
+        # If we can, build the new directory from the one we have and a
+        # diff; otherwise, download the whole thing.
+        tmpname = self._tryDirectoryDiff(url, lock)
+        if tmpname is not None:
+            isGzipped = 0
+        else:
+            if url.endswith(".gz"):
+                isGzipped = 1
+                tmpname = self.fnameBase + "_new.gz"
+            else:
+                isGzipped = 0
+                tmpname = self.fnameBase + "_new"
+            LOG.info("Downloading directory from %s", url)
+            self._fetchURL(url, tmpname)
+
+        # Open and validate the directory
+        LOG.info("Validating directory")
+
+        lock.read_in()
+        digestMap = self._s.digestMap.copy()
+        knownServers = self._getKnownServers()
+        lock.read_out()
+
+        try:
+            directory = mixminion.ServerInfo.parseDirectory(
+                fname=tmpname,
+                validatedDigests=digestMap,
+                knownServers=knownServers)
+        except mixminion.Config.ConfigError, e:
+            raise GotInvalidDirectoryError(
+                "Received an invalid directory: %s"%e)
+
+        if isinstance(directory, mixminion.ServerInfo.ServerDirectory):
+            identity = directory['Signature']['DirectoryIdentity']
+            fp = MIXMINION_DIRECTORY_FINGERPRINT #XXXX
+            if fp and mixminion.Crypto.pk_fingerprint(identity) != fp:
+                raise MixFatalError("Bad identity key on directory")
+        else:
+            #XXXX CHECK THAT SIGNATURES ARE WHAT WE EXPECT!!!!!!
+            pass
+
+        if isGzipped:
+            replaceFile(tmpname, self.fnameBase+".gz")
+            tryUnlink(self.fnameBase)
+        else:
+            replaceFile(tmpname, self.fnameBase)
+            tryUnlink(self.fnameBase+".gz")
+
+        lock.write_in()
+        try:
+            self._setDirectory(directory)
+            self.lastDownload = time.time()
+            self._changed = 1
+            for s in self.servers:
+                self._s._addDigest(s)
+        finally:
+            lock.write_out()
+
+    def _fetchURL(self, url, fname):
+        """Helper: download the contents of 'url' into the file 'fname'.
+           Raise DirectoryDownloadError on failure."""
+        if self.timeout:
+            mixminion.NetUtils.setGlobalTimeout(self.timeout)
         try:
             try:
                 # Tell HTTP proxies and their ilk not to cache the directory.
@@ -490,15 +684,8 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
             if self.timeout:
                 mixminion.NetUtils.unsetGlobalTimeout()
 
-        if url.endswith(".gz"):
-            isGzipped = 1
-            tmpname = self.fnameBase + "_new.gz"
-        else:
-            isGzipped = 0
-            tmpname = self.fnameBase + "_new"
-
         # Open a temporary output file.
-        outfile = open(tmpname, 'wb')
+        outfile = open(fname, 'wb')
 
         # Read the file off the network.
         while 1:
@@ -512,59 +699,99 @@ class DirectoryBackedDescriptorSource(DescriptorSource):
         dateHeader = infile.info().get("Date","")
         if dateHeader: self._warnIfSkewed(dateHeader, expected=startTime)
 
-        # Open and validate the directory
-        LOG.info("Validating directory")
-
+    def _tryDirectoryDiff(self, url, lock):
+        """Helper: try to build the directory published at 'url' from the
+           directory we have cached and the diff published beside it.  On
+           success, return the name of a temporary file holding the new
+           directory.  If we have no directory, or the diff is missing or
+           doesn't apply to our directory, return None.
+        """
         lock.read_in()
-        digestMap = self._s.digestMap.copy()
-        lock.read_out()
-
         try:
-            directory = mixminion.ServerInfo.parseDirectory(
-                fname=tmpname,
-                validatedDigests=digestMap)
-        except mixminion.Config.ConfigError, e:
-            raise GotInvalidDirectoryError(
-                "Received an invalid directory: %s"%e)
-
-        if isinstance(directory, mixminion.ServerInfo.ServerDirectory):
-            identity = directory['Signature']['DirectoryIdentity']
-            fp = MIXMINION_DIRECTORY_FINGERPRINT #XXXX
-            if fp and mixminion.Crypto.pk_fingerprint(identity) != fp:
-                raise MixFatalError("Bad identity key on directory")
+            haveDir = self.servers is not None
+        finally:
+            lock.read_out()
+        if not haveDir:
+            return None
+        for ext in "", ".gz":
+            cachedName = self.fnameBase + ext
+            if os.path.exists(cachedName):
+                break
         else:
-            #XXXX CHECK THAT SIGNATURES ARE WHAT WE EXPECT!!!!!!
-            pass
+            return None
+        try:
+            base = readPossiblyGzippedFile(cachedName)
+        except (IOError, zlib.error), e:
+            LOG.info("Couldn't read cached directory: %s", e)
+            return None
 
-        if isGzipped:
-            replaceFile(tmpname, self.fnameBase+".gz")
-            tryUnlink(self.fnameBase)
+        # The server publishes diffs under the digest of the directory
+        # they apply to, so we only ask for one that fits ours.
+        diffURL = mixminion.ServerInfo.getDirectoryDiffName(
+            url, mixminion.ServerInfo.getDirectoryDiffBase(base))
+        if diffURL.endswith(".gz"):
+            diffName = self.fnameBase + "_diff.gz"
         else:
-            replaceFile(tmpname, self.fnameBase)
-            tryUnlink(self.fnameBase+".gz")
-
-        lock.write_in()
+            diffName = self.fnameBase + "_diff"
+        LOG.info("Downloading directory diff from %s", diffURL)
         try:
-            self.serverDir = directory
-            self.lastDownload = time.time()
-            self._changed = 1
-            for s in self.serverDir.getAllServers():
-                self._s._addDigest(s)
+            try:
+                self._fetchURL(diffURL, diffName)
+                diff = readPossiblyGzippedFile(diffName)
+                contents = mixminion.ServerInfo.applyDirectoryDiff(base, diff)
+            except (DirectoryDownloadError, mixminion.Config.ConfigError,
+                    IOError, zlib.error), e:
+                LOG.info("Couldn't use directory diff: %s", e)
+                return None
         finally:
-            lock.write_out()
+            tryUnlink(diffName)
+
+        LOG.info("Built new directory from a %s-byte diff", len(diff))
+        tmpname = self.fnameBase + "_new"
+        writeFile(tmpname, contents)
+        return tmpname
+
+    def _getKnownServers(self):
+        """Helper: return a map from digest to ServerInfo for every
+           validated descriptor in our current directory, so that we don't
+           need to parse them again when they reappear in a new one."""
+        known = {}
+        if self.servers is None:
+            return known
+        for s in self.servers:
+            d = s.getDigest()
+            if s.isValidated() and self._s.digestMap.has_key(d):
+                known[d] = s
+        return known
 
     def __getstate__(self):
-        return self.MAGIC, self.lastDownload, self.serverDir
+        if self.servers is None:
+            summaries = None
+        else:
+            summaries = [ _summarizeServer(s) for s in self.servers ]
+        return (self.MAGIC, self.lastDownload, summaries, self.goodNicknames,
+                self.recommendedVersions)
 
     def __setstate__(self,state):
+        self._setDirectory(None)
         if (type(state) != types.TupleType or len(state)<1 or
-            state[0] != self.MAGIC):
+            state[0] not in (self.MAGIC, "BDBS-0.1")):
             LOG.warn("Unrecognized state on picked FSBDS; rebuilding.")
-            self.serverDir = None
             self.lastDownload = 0
             self._changed = 1
+        elif state[0] == "BDBS-0.1":
+            # Stored by an older version, with a full ServerDirectory.
+            _, self.lastDownload, serverDir = state
+            if serverDir is not None:
+                self._setDirectory(serverDir)
+            self._changed = 1
         else:
-            _, self.lastDownload, self.serverDir = state
+            _, self.lastDownload, summaries, goodNicknames, versions = state
+            if summaries is not None:
+                self.servers = [ _CachedServerInfo(self, summary[1], summary)
+                                 for summary in summaries ]
+            self.goodNicknames = goodNicknames
+            self.recommendedVersions = versions
             self._changed = 0
         self.__downloading = 0
         self.fnameBase = None
@@ -708,6 +935,129 @@ def loadCachingDescriptorSource(config):
     store.save()
     return store
 
+class _RelayGraph:
+    """Helper class for ClientDirectory: remembers which of the relays live
+       over a given time window can be used at each position in a path,
+       and which relays can relay to which others, so that generating many
+       paths doesn't require checking every pair of relays every time.
+    """
+    ## Fields:
+    # relays: A list of ServerInfo for the unblocked recommended relays
+    #    live over the window, as returned by ClientDirectory.__find.
+    # byNickname: A map from lowercase nickname to index within relays.
+    # entries: A list of indices of relays we may use as the first hop.
+    # exits: A map whose keys are the indices of relays we may use as the
+    #    last hop.
+    # succ: A list mapping the index of each relay to a map whose keys are
+    #    the indices of the other relays it can relay to.
+    # pred: A list mapping the index of each relay to a map whose keys are
+    #    the indices of the other relays that can relay to it.
+    # startLo, startHi, endLo, endHi: The set of live relays is the same
+    #    for any window starting in [startLo, startHi) and ending in
+    #    (endLo, endHi].  None means 'unbounded'.
+    def __init__(self, relays, allServers, startAt, endAt, isBlocked):
+        """Build a new _RelayGraph for a list of live relays 'relays',
+           selected from 'allServers' as valid from 'startAt' through
+           'endAt'.  'isBlocked' is a function that takes a nickname and
+           the isEntry and isExit flags, as ClientDirectory.__nicknameIsBlocked.
+        """
+        self.relays = relays
+        self.byNickname = {}
+        self.entries = []
+        self.exits = {}
+        self.succ = []
+        self.pred = []
+        n = len(relays)
+        for i in xrange(n):
+            c = relays[i]
+            self.byNickname[c.getNickname().lower()] = i
+            if c.canStartAt() and not isBlocked(c.getNickname(), isEntry=1):
+                self.entries.append(i)
+            if not isBlocked(c.getNickname(), isExit=1):
+                self.exits[i] = 1
+            self.succ.append({})
+            self.pred.append({})
+        for i in xrange(n):
+            for j in xrange(n):
+                # Relays returned by __find have distinct nicknames, so we
+                # only need to skip i==j to avoid same-server hops.
+                if i != j and relays[i].canRelayTo(relays[j]):
+                    self.succ[i][j] = 1
+                    self.pred[j][i] = 1
+
+        self.startLo = self.startHi = self.endLo = self.endHi = None
+        for info in allServers:
+            va = info.getValidAfter()
+            vu = info.getValidUntil()
+            if va <= startAt:
+                if self.startLo is None or va > self.startLo:
+                    self.startLo = va
+            elif self.startHi is None or va < self.startHi:
+                self.startHi = va
+            if vu < endAt:
+                if self.endLo is None or vu > self.endLo:
+                    self.endLo = vu
+            elif self.endHi is None or vu < self.endHi:
+                self.endHi = vu
+
+    def covers(self, startAt, endAt):
+        """Return true iff this graph describes the relays that are live
+           from 'startAt' through 'endAt'."""
+        return ((self.startLo is None or self.startLo <= startAt) and
+                (self.startHi is None or startAt < self.startHi) and
+                (self.endLo is None or self.endLo < endAt) and
+                (self.endHi is None or endAt <= self.endHi))
+
+    def getCandidates(self, isFirst, isLast, prev, next):
+        """Return a list of the relays that can appear in a path between
+           the ServerInfos 'prev' and 'next' (either of which may be None).
+           If 'isFirst' or 'isLast' is true, this position is the first
+           or last hop in the path.  (Only the first hop may lack a 'prev'.)
+           The list is in the same order as self.relays.
+        """
+        if isFirst:
+            positions = self.entries
+        else:
+            positions = xrange(len(self.relays))
+        filters = []
+        if isLast:
+            filters.append(self.exits)
+        if prev:
+            filters.append(self.__getNeighbors(prev, self.succ, 0))
+        if next:
+            filters.append(self.__getNeighbors(next, self.pred, 1))
+        result = []
+        for i in positions:
+            for f in filters:
+                if not f.has_key(i):
+                    break
+            else:
+                result.append(self.relays[i])
+        return result
+
+    def __getNeighbors(self, server, table, isNext):
+        """Helper: return a map whose keys are the indices of the relays
+           that 'server' can relay to (if isNext is false) or that can
+           relay to 'server' (if isNext is true).  'table' is self.succ or
+           self.pred, respectively."""
+        i = self.byNickname.get(server.getNickname().lower())
+        if i is not None and self.relays[i] is server:
+            return table[i]
+        # 'server' isn't one of our relays (it was given explicitly, or
+        # it's a different descriptor for one of them); check it directly.
+        d = {}
+        for j in xrange(len(self.relays)):
+            c = self.relays[j]
+            if c.hasSameNicknameAs(server):
+                continue
+            if isNext:
+                ok = c.canRelayTo(server)
+            else:
+                ok = server.canRelayTo(c)
+            if ok:
+                d[j] = 1
+        return d
+
 class ClientDirectory:
     """Utility wrapper around a CachingDescriptorSource to handle common
        functionality such as server lookup, path generation, and so on.
@@ -731,8 +1081,12 @@ class ClientDirectory:
     # blockedNicknames: a map from lowercase nickname to a list of the purposes
     #   ('entry', 'exit', or '*') for which the corresponding server shouldn't
     #   be selected in automatic path generation.  Set by configure.
+    # _relayGraph: None, or a _RelayGraph for the most recent time window
+    #   used in path generation.  Cleared whenever the servers or the
+    #   blocked nicknames change.
     def __init__(self, config=None, store=None, diskLock=None):
         self._lock = RWLock()
+        self._relayGraph = None
         if diskLock is None:
             self._diskLock = DummyLock()
         else:
@@ -761,6 +1115,7 @@ class ClientDirectory:
         self.goodServers = []
         self.byNickname = {}
         self.byKeyID = {}
+        self._relayGraph = None
         for n in self.store.getRecommendedNicknames():
             assert n == n.lower()
             self.goodNicknames[n]=1
@@ -822,6 +1177,7 @@ class ClientDirectory:
                     blocked[nn.lower()] = ['*']
 
             self.blockedNicknames = blocked
+            self._relayGraph = None
         finally:
             self._lock.write_out()
 
@@ -1038,8 +1394,8 @@ class ClientDirectory:
                 blocked = self.blockedNicknames.get(nickname.lower(), [])
                 if goodOnly and not isGood:
                     continue
-                va = sd['Server']['Valid-After']
-                vu = sd['Server']['Valid-Until']
+                va = sd.getValidAfter()
+                vu = sd.getValidUntil()
                 d = result.setdefault(nickname, {}).setdefault((va,vu), {})
                 for feature,(sec,ent) in resFeatures:
                     if sec == '+':
@@ -1126,6 +1482,23 @@ class ClientDirectory:
                 res.append(info)
         return res
 
+    def __getRelayGraph(self, startAt, endAt):
+        """Helper: return a _RelayGraph for the relays live from startAt
+           through endAt, reusing the last one we built if we can.
+
+           Caller must hold read lock.  (Two readers may both build a new
+           graph at once; that's harmless.)
+        """
+        g = self._relayGraph
+        if g is not None and g.covers(startAt, endAt):
+            return g
+        relays = self.__excludeBlocked(
+            self.__find(self.goodServers, startAt, endAt))
+        g = _RelayGraph(relays, self.goodServers, startAt, endAt,
+                        self.__nicknameIsBlocked)
+        self._relayGraph = g
+        return g
+
     def getLiveServers(self, startAt=None, endAt=None, isEntry=0, isExit=0):
         """Return a list of all server desthat are live from startAt through
            endAt.  The list is in the standard (ServerInfo,where) format,
@@ -1333,8 +1706,8 @@ class ClientDirectory:
                 servers.append(self.getServerInfo(name, startAt, endAt, 1))
 
         # Now figure out which relays we haven't used yet.
-        relays = self.__find(self.goodServers, startAt, endAt)
-        relays = self.__excludeBlocked(relays)
+        graph = self.__getRelayGraph(startAt, endAt)
+        relays = graph.relays
         if not relays:
             raise UIError("No relays known")
         elif len(relays) == 2:
@@ -1355,29 +1728,11 @@ class ClientDirectory:
                 next = servers[i+1]
             else:
                 next = None
-            # ...and see if there are any relays left that aren't adjacent?
-            candidates = []
-            for c in relays:
-                # Skip blocked entry points
-                if i==0 and self.__nicknameIsBlocked(c.getNickname(),
-                                                     isEntry=1):
-                    continue
-                # Skip blocked exit points
-                if i==(len(servers)-1) and self.__nicknameIsBlocked(
-                    c.getNickname(), isExit=1):
-                    continue
-                # Avoid same-server hops
-                if ((prev and c.hasSameNicknameAs(prev)) or
-                    (next and c.hasSameNicknameAs(next))):
-                    continue
-                # Avoid hops that can't relay to one another.
-                if ((prev and not prev.canRelayTo(c)) or
-                    (next and not c.canRelayTo(next))):
-                    continue
-                # Avoid first hops that we can't deliver to.
-                if (not prev) and not c.canStartAt():
-                    continue
-                candidates.append(c)
+            # ...and see if there are any relays left that aren't adjacent,
+            # that can relay to and from their neighbors, and that aren't
+            # blocked from this position?
+            candidates = graph.getCandidates(i==0, i==len(servers)-1,
+                                             prev, next)
             if candidates:
                 # Good.  There are some okay servers.
                 servers[i] = prng.pick(candidates)
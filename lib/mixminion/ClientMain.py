@@ -391,12 +391,12 @@ class MixminionClient:
         directory.validatePath(pathSpec, address, startAt, endAt,
                                warnUnrecommended=0)
 
-        for p, (path1,path2) in zip(payloads, directory.generatePaths(
-            len(payloads), pathSpec, address, startAt, endAt)):
-
-            pkt = mixminion.BuildMessage.buildForwardPacket(
-                p, routingType, routingInfo, path1, path2,
-                self.prng, suppressTag=address.suppressTag())
+        paths = directory.generatePaths(len(payloads), pathSpec, address,
+                                        startAt, endAt)
+        pkts = mixminion.BuildMessage.buildForwardPackets(
+            payloads, routingType, routingInfo, paths,
+            self.prng, suppressTag=address.suppressTag())
+        for pkt, (path1,path2) in zip(pkts, paths):
             r.append( (pkt, path1[0]) )
 
         return r
@@ -432,14 +432,16 @@ class MixminionClient:
                 raise UIError("Not enough usable reply blocks found; all were used or expired.")
 
 
-            for (surb,payload,(path1,path2)) in zip(surbs,payloads,
-                  directory.generatePaths(len(payloads),pathSpec, address,
-                                          startAt,endAt)):
+            paths = directory.generatePaths(len(payloads),pathSpec, address,
+                                            startAt,endAt)
+            surbs = surbs[:len(payloads)]
+            for path1,path2 in paths:
                 assert path1 and not path2
-                LOG.info("Generating packet...")
-                pkt = mixminion.BuildMessage.buildReplyPacket(
-                    payload, path1, surb, self.prng)
+            LOG.info("Generating packet(s)...")
+            pkts = mixminion.BuildMessage.buildReplyPackets(
+                payloads, [ path1 for path1,_ in paths ], surbs, self.prng)
 
+            for surb, pkt, (path1,_) in zip(surbs, pkts, paths):
                 surbLog.markSURBUsed(surb)
                 result.append( (pkt, path1[0]) )
 
@@ -2156,17 +2158,16 @@ def reassemble(cmd, args):
         removed = []
         for msgid in args:
             if reassemble:
-                try:
-                    msg = client.pool.getMessage(msgid, force=force)
-                except CompressedDataTooLong:
-                    raise UIError("Can't reassemble message %s: possible zlib bomb.")
                 if out == None:
                     if outfilename in ('-',None):
                         out = sys.stdout
                     else:
                         out = open(outfilename, 'wb')
                         closeoutfile = 1
-                out.write(msg)
+                try:
+                    client.pool.writeMessage(msgid, out, force=force)
+                except CompressedDataTooLong:
+                    raise UIError("Can't reassemble message %s: possible zlib bomb.")
             if purge:
                 removed.append(msgid)
         client.pool.removeMessages(removed)
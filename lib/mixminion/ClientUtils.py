@@ -24,8 +24,9 @@ import mixminion.Filestore
 import mixminion.Packet
 
 from mixminion.Common import LOG, MixError, UIError, ceilDiv, \
-     createPrivateDir, floorDiv, previousMidnight, readFile, \
-     succeedingMidnight, writeFile, armorText, unarmorText, MixFatalError
+     createPrivateDir, floorDiv, openUnique, previousMidnight, readFile, \
+     secureDelete, succeedingMidnight, writeFile, armorText, unarmorText, \
+     MixFatalError
 from mixminion.Crypto import sha1, ctr_crypt, DIGEST_LEN, AES_KEY_LEN, \
      getCommonPRNG, trng
 
@@ -960,6 +961,45 @@ class ClientFragmentPool:
             raise MixFatalError("Can't decode message %s; I don't know why!"
                                 %msgid)
 
+    def writeMessage(self, msgid, out, force=0):
+        """As getMessage, but write the uncompressed message to the file
+           'out' rather than returning it, without ever holding the whole
+           message in memory.
+
+           We uncompress into a temporary file next to the pool first, so
+           that nothing is written to 'out' if the message turns out to be
+           invalid or overcompressed.
+        """
+        pool = self.__getPool()
+        state = pool.getStateByMsgID(msgid)
+        if state is None:
+            raise UIError("No such message as '%s'" % msgid)
+        elif not state.isDone():
+            raise UIError("Message '%s' is still missing fragments."%msgid)
+
+        if force:
+            maxSize = None
+        else:
+            maxSize = state.params.length*20
+        tmp, tmpname = openUnique(self.dir+"_tmp", 'wb')
+        try:
+            try:
+                d = mixminion.Packet.StreamDecompressor(tmp.write, maxSize)
+                pool.writeReadyMessage(state.messageid, d.feed)
+                d.close()
+            except mixminion.Packet.ParseError, e:
+                raise UIError("Invalid message %s: %s"%(msgid,e))
+            tmp.close()
+            tmp = open(tmpname, 'rb')
+            while 1:
+                b = tmp.read(1<<16)
+                if not b:
+                    break
+                out.write(b)
+        finally:
+            tmp.close()
+            secureDelete(tmpname, blocking=1)
+
     def removeMessages(self, msgids):
         """Remove all the messages whose IDs are in the list 'msgIDs'.  If the
            messages were reassembled, mark them as 'COMPLETED'; else mark them
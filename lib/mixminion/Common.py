@@ -11,12 +11,14 @@ __all__ = [ 'IntervalSet', 'Lockfile', 'LockfileLocked', 'LOG', 'LogStream',
             'createPrivateDir', 'disp64',
             'encodeBase64', 'englishSequence', 'floorDiv', 'formatBase64',
             'formatDate', 'formatFnameDate', 'formatFnameTime', 'formatTime',
+            'getSecureDeleteStats',
             'installSIGCHLDHandler', 'isSMTPMailbox', 'iterFileLines',
             'openUnique', 'parseFnameDate',
             'previousMidnight', 'readFile', 'readPickled',
             'readPossiblyGzippedFile', 'secureDelete', 'stringContains',
             'succeedingMidnight', 'tryUnlink', 'unarmorText',
-            'waitForChildren', 'writeFile', 'writePickled' ]
+            'waitForChildren', 'waitForSecureDeletes', 'writeFile',
+            'writePickled' ]
 
 import binascii
 import bisect
@@ -673,7 +675,8 @@ _SHRED_OPTS = None
 
 def configureShredCommand(conf):
     """Initialize the secure delete command from a given Config object.
-       If no object is provided, try some sane defaults."""
+       If no object is provided, or the object doesn't name a command, use
+       our internal implementation."""
     global _SHRED_CMD
     global _SHRED_OPTS
     cmd, opts = None, None
@@ -682,26 +685,24 @@ def configureShredCommand(conf):
         if val is not None:
             cmd, opts = val
 
-    if cmd is None:
-        if os.path.exists("/usr/bin/shred"):
-            cmd, opts = "/usr/bin/shred", ["-uz", "-n0"]
-        else:
-            # Use built-in _overwriteFile
-            cmd, opts = None, None
-
     _SHRED_CMD, _SHRED_OPTS = cmd, opts
 
 
 # Map from parent directory to blocksize.  We only overwrite files in a few
 # locations, so this should be safe.
 _BLKSIZEMAP = {}
-# A string of max(_BLKSIZEMAP.values()) zeros
+# A string of zeros, at least _OVERWRITE_CHUNK bytes long, and a multiple
+# of every value in _BLKSIZEMAP.
 _NILSTR = ""
-def _overwriteFile(f):
-    """Overwrite f with zeros, rounding up to the nearest block.  This is
-       used as the default implementation of secureDelete."""
+# How many bytes do we try to write at once when overwriting a file?
+_OVERWRITE_CHUNK = 1<<20
+# How many files do we overwrite before we wait for them to reach the disk?
+_DELETE_BATCH = 64
+def _overwriteFd(fd, parent):
+    """Overwrite the file open for writing as 'fd', which is in the
+       directory 'parent', with zeros, rounding up to the nearest block.
+       Return the number of bytes written."""
     global _NILSTR
-    parent = os.path.split(f)[0]
     try:
         sz = _BLKSIZEMAP[parent]
     except KeyError:
@@ -713,22 +714,136 @@ def _overwriteFile(f):
         else:
             sz = 8192 # Should be a safe guess? (????)
         _BLKSIZEMAP[parent] = sz
-        if sz > len(_NILSTR):
-            _NILSTR = '\x00' * sz
-    nil = _NILSTR[:sz]
+        chunk = ceilDiv(_OVERWRITE_CHUNK, sz)*sz
+        if chunk > len(_NILSTR):
+            _NILSTR = '\x00' * chunk
+    size = ceilDiv(os.fstat(fd)[stat.ST_SIZE], sz)*sz
+    # Write as much as we can at a time, in whole blocks.
+    chunk = floorDiv(len(_NILSTR), sz)*sz
+    left = size
+    while left:
+        left -= os.write(fd, _NILSTR[:min(left, chunk)])
+    return size
+
+# Lock to protect _DELETE_STATS, _DELETE_QUEUE, and _DELETE_THREAD.
+_DELETE_LOCK = threading.Lock()
+# A list of the number of files we've deleted internally, the number of
+# bytes we've overwritten, and the number of seconds we've spent.
+_DELETE_STATS = [ 0, 0, 0.0 ]
+# A list of lists of filenames waiting for _DELETE_THREAD to delete them.
+_DELETE_QUEUE = []
+# A thread to delete the files in _DELETE_QUEUE, or None if the queue is
+# empty.
+_DELETE_THREAD = None
+
+def _deleteFiles(fnames):
+    """Helper: overwrite every file in 'fnames' with zeros, make sure the
+       zeros have reached the disk, and unlink the files.  This is our
+       internal implementation of secureDelete."""
+    start = time.time()
+    nFiles = nBytes = 0
+    parents = {}
+    for i in xrange(0, len(fnames), _DELETE_BATCH):
+        batch = fnames[i:i+_DELETE_BATCH]
+        fds = []
+        try:
+            for f in batch:
+                try:
+                    fd = os.open(f, os.O_WRONLY|O_BINARY)
+                except OSError:
+                    continue
+                fds.append(fd)
+                nBytes += _overwriteFd(fd, os.path.split(f)[0])
+            # Start all the writes in the batch before we wait for any of
+            # them.  (We can't unlink a file before its zeros are on disk:
+            # the kernel is free to throw away the dirty blocks of a
+            # deleted file.)
+            if hasattr(os, 'fsync'):
+                for fd in fds:
+                    os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        for f in batch:
+            if tryUnlink(f):
+                nFiles += 1
+            parents[os.path.split(f)[0]] = 1
+
+    # Make sure the unlinks have reached the disk too.
+    if hasattr(os, 'fsync'):
+        for d in parents.keys():
+            try:
+                fd = os.open(d or ".", os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    pass # Not every platform can fsync a directory.
+            finally:
+                os.close(fd)
+
+    _DELETE_LOCK.acquire()
     try:
-        fd = os.open(f, os.O_WRONLY|O_BINARY)
-    except OSError:
-        return
+        _DELETE_STATS[0] += nFiles
+        _DELETE_STATS[1] += nBytes
+        _DELETE_STATS[2] += time.time()-start
+    finally:
+        _DELETE_LOCK.release()
+
+def _deleteFilesInBackground(fnames):
+    """Helper: arrange for _deleteFiles to be called on 'fnames' from a
+       background thread, and return immediately."""
+    global _DELETE_THREAD
+    _DELETE_LOCK.acquire()
     try:
-        size = os.fstat(fd)[stat.ST_SIZE]
-        blocks = ceilDiv(size, sz)
-        for _ in xrange(blocks):
-            os.write(fd, nil)
-        if hasattr(os, 'fsync'):
-            os.fsync(fd)
+        _DELETE_QUEUE.append(fnames)
+        if _DELETE_THREAD is None:
+            _DELETE_THREAD = threading.Thread(target=_deleteThreadMain)
+            _DELETE_THREAD.start()
     finally:
-        os.close(fd)
+        _DELETE_LOCK.release()
+
+def _deleteThreadMain():
+    """Helper: main loop for _DELETE_THREAD.  Deletes the files in
+       _DELETE_QUEUE until it is empty, then exits."""
+    global _DELETE_THREAD
+    while 1:
+        _DELETE_LOCK.acquire()
+        try:
+            if not _DELETE_QUEUE:
+                _DELETE_THREAD = None
+                return
+            fnames = []
+            for lst in _DELETE_QUEUE:
+                fnames.extend(lst)
+            del _DELETE_QUEUE[:]
+        finally:
+            _DELETE_LOCK.release()
+        try:
+            _deleteFiles(fnames)
+        except:
+            LOG.error_exc(sys.exc_info(), "Error while deleting files")
+
+def waitForSecureDeletes():
+    """Wait until all the files we're deleting in the background have
+       been removed."""
+    while 1:
+        t = _DELETE_THREAD
+        if t is None:
+            return
+        t.join()
+
+def getSecureDeleteStats():
+    """Return a tuple of the number of files that secureDelete has removed
+       without an external command, the number of bytes it has
+       overwritten, and the number of seconds it has spent doing so."""
+    _DELETE_LOCK.acquire()
+    try:
+        return tuple(_DELETE_STATS)
+    finally:
+        _DELETE_LOCK.release()
 
 def secureDelete(fnames, blocking=0):
     """Given a list of filenames, removes the contents of all of those
@@ -755,11 +870,10 @@ def secureDelete(fnames, blocking=0):
        against a well-funded adversary with access to your hard drive
        and a bunch of sensitive magnetic equipment.
 
-       XXXX Currently, we use shred from GNU fileutils.  Shred's 'unlink'
-       XXXX operation has the regrettable property that two shred commands
-       XXXX running in the same directory can sometimes get into a race.
-       XXXX The source to shred.c seems to imply that this is harmless, but
-       XXXX let's try to avoid that, to be on the safe side.
+       Unless the user has configured a ShredCommand, we overwrite the
+       files ourselves, with large writes, and wait for the disk only once
+       for each batch of files.  Nonblocking removes happen in a
+       background thread.
     """
     if _SHRED_CMD == "---":
         configureShredCommand(None)
@@ -771,9 +885,10 @@ def secureDelete(fnames, blocking=0):
         fnames = [fnames]
 
     if not _SHRED_CMD:
-        for f in fnames:
-            _overwriteFile(f)
-            os.unlink(f)
+        if blocking:
+            _deleteFiles(fnames)
+        else:
+            _deleteFilesInBackground(fnames[:])
         return None
 
     # Some systems are unhappy when you call them with too many options.
@@ -787,10 +902,7 @@ def secureDelete(fnames, blocking=0):
             if e.errno not in (errno.EAGAIN, errno.ENOMEM):
                 raise
             LOG.warn("Transient error while shredding files: %s",e)
-            for f in files:
-                if os.path.exists(f):
-                    _overwriteFile(f)
-                    os.unlink(f)
+            _deleteFiles([f for f in files if os.path.exists(f)])
         else:
             if blocking:
                 try:
@@ -1470,6 +1582,28 @@ class IntervalSet:
             r += self.edges[i+1][0] - self.edges[i][0]
         return r
 
+    def getSpanLengthsWithin(self, intervals):
+        """Given a sorted list of disjoint (start,end) tuples, return a list
+           of the lengths of this set's intersection with each of them.
+           Equivalent to computing (self*IntervalSet([(s,e)])).spanLength()
+           for each (s,e), but takes time linear in the sizes of this set
+           and of 'intervals'."""
+        edges = self.edges
+        nEdges = len(edges)
+        result = []
+        i = 0
+        for s, e in intervals:
+            # Skip the intervals of ours that end before this one starts.
+            while i < nEdges and edges[i+1][0] <= s:
+                i += 2
+            r = 0
+            j = i
+            while j < nEdges and edges[j][0] < e:
+                r += min(e, edges[j+1][0]) - max(s, edges[j][0])
+                j += 2
+            result.append(r)
+        return result
+
     def _checkRep(self):
         """Helper function: raises AssertionError if this set's data is
            corrupted."""
@@ -1529,7 +1663,10 @@ def isSMTPMailbox(s):
 # Signal handling
 
 def waitForChildren(onceOnly=0, blocking=1):
-    """Wait until all subprocesses have finished.  Useful for testing."""
+    """Wait until all subprocesses in our process group have finished.
+       Useful for testing."""
+    if blocking and not onceOnly:
+        waitForSecureDeletes()
     if sys.platform == 'win32':
         LOG.trace("Skipping waitForChildren")
         return
@@ -1540,7 +1677,7 @@ def waitForChildren(onceOnly=0, blocking=1):
     while 1:
         try:
             # WWWW This won't work on Windows.  What to do?
-            pid, status = os.waitpid(-1, options)
+            pid, status = os.waitpid(0, options)
         except OSError, e:
             return
         except e:
@@ -1554,9 +1691,12 @@ def _sigChldHandler(signal_num, _):
     # believe we need to re-register ourself.
     signal.signal(signal.SIGCHLD, _sigChldHandler)
 
+    # We only reap children in our own process group: processes that
+    # manage their own children (like the packet worker pool) move them
+    # into another group so that they can wait for them themselves.
     while 1:
         try:
-            pid, status = os.waitpid(-1, os.WNOHANG)
+            pid, status = os.waitpid(0, os.WNOHANG)
             if pid == 0:
                 break
         except OSError:
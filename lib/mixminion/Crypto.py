@@ -17,18 +17,26 @@ import sys
 import threading
 from types import StringType
 
+try:
+    # Incremental SHA1 objects, for hashing data too large to hold in memory.
+    from hashlib import sha1 as _sha1_new
+except ImportError:
+    from sha import new as _sha1_new
+
 import mixminion._minionlib as _ml
 from mixminion.Common import MixError, MixFatalError, floorDiv, ceilDiv, LOG
 
 __all__ = [ 'AESCounterPRNG', 'CryptoError', 'Keyset', 'bear_decrypt',
             'bear_encrypt', 'ctr_crypt', 'getCommonPRNG', 'init_crypto',
-            'lioness_decrypt', 'lioness_encrypt', 'openssl_seed',
+            'lioness_decrypt', 'lioness_decrypt_stream', 'lioness_encrypt',
+            'openssl_seed',
             'pk_check_signature', 'pk_decode_private_key',
             'pk_decode_public_key', 'pk_decrypt', 'pk_encode_private_key',
             'pk_encode_public_key', 'pk_encrypt', 'pk_fingerprint',
             'pk_from_modulus', 'pk_generate', 'pk_get_modulus',
-            'pk_same_public_key', 'pk_sign', 'prng', 'sha1', 'strxor', 'trng',
-            'unwhiten', 'whiten',
+            'pk_same_public_key', 'pk_sign', 'prng', 'sha1',
+            'sprp_crypt_inplace', 'strxor', 'trng',
+            'unwhiten', 'unwhiten_stream', 'whiten',
             'AES_KEY_LEN', 'DIGEST_LEN', 'HEADER_SECRET_MODE', 'PRNG_MODE',
             'RANDOM_JUNK_MODE', 'HEADER_ENCRYPT_MODE', 'APPLICATION_KEY_MODE',
             'PAYLOAD_ENCRYPT_MODE', 'HIDE_HEADER_MODE' ]
@@ -93,31 +101,16 @@ def lioness_encrypt(s,(key1,key2,key3,key4)):
     assert len(key2) == len(key4) == DIGEST_LEN
     assert len(s) > DIGEST_LEN
 
-    # Split the message.
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    # Performance note: This business with sha1("".join((key,right,key)))
-    # may look slow, but it contributes only .7% to the total time for
-    # LIONESS.
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key1,left,key1)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left,  _ml.sha1("".join((key2,right,key2))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key3,left,key3)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left,  _ml.sha1("".join((key4,right,key4))))
-
-    # You could write the above as:
-    #   right = ctr_crypt(right, "".join((key1,left,key1))[:AES_KEY_LEN])
+    # This is implemented in C, for speed.  It's equivalent to:
+    #   left, right = s[:DIGEST_LEN], s[DIGEST_LEN:]
+    #   right = ctr_crypt(right, sha1("".join((key1,left,key1)))[:AES_KEY_LEN])
     #   left = strxor(left, sha1("".join((key2,right,key2))))
-    #   right = ctr_crypt(right, "".join((key3,left,key3))[:AES_KEY_LEN])
+    #   right = ctr_crypt(right, sha1("".join((key3,left,key3)))[:AES_KEY_LEN])
     #   left = strxor(left, sha1("".join((key4,right,key4))))
-    # but that would be slower by about 10%.  (Since LIONESS is in the
-    # critical path, we care.)
-
-    return left + right
+    #   return left + right
+    # but doing it all in one call saves us several copies of the 28K
+    # right-hand side.  (Since LIONESS is in the critical path, we care.)
+    return _ml.lioness_encrypt(s,(key1,key2,key3,key4))
 
 def lioness_decrypt(s,(key1,key2,key3,key4)):
     """Given a 16-byte key2 and key4, and a 20-byte key1 and key3, decrypts
@@ -128,27 +121,65 @@ def lioness_decrypt(s,(key1,key2,key3,key4)):
     assert len(key2)==len(key4)==DIGEST_LEN
     assert len(s) > DIGEST_LEN
 
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-
     # Slow, comprehensible version:
     #left = strxor(left,  sha1("".join([key4,right,key4])))
     #right = ctr_crypt(right, sha1("".join([key3,left,key3]))[:AES_KEY_LEN])
     #left = strxor(left,  sha1("".join([key2,right,key2])))
     #right = ctr_crypt(right, sha1("".join([key1,left,key1]))[:AES_KEY_LEN])
+    return _ml.lioness_decrypt(s,(key1,key2,key3,key4))
 
-    # Equivalent-but-faster version:
-    left = _ml.strxor(left, _ml.sha1("".join((key4,right,key4))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key3,left, key3)))[:AES_KEY_LEN]),
-        right, 0)
-    left = _ml.strxor(left, _ml.sha1("".join((key2,right,key2))))
-    right = _ml.aes_ctr128_crypt(
-        _ml.aes_key(_ml.sha1("".join((key1,left, key1)))[:AES_KEY_LEN]),
-        right, 0)
+def lioness_decrypt_stream(blocks, (key1,key2,key3,key4), write):
+    """Decrypt a LIONESS-encrypted string that is too large to hold in
+       memory.  'blocks' is a function that returns an iterable of strings
+       whose concatenation is the ciphertext; it is called three times.
+       The plaintext is passed, a block at a time, to the function 'write'.
 
-    return left + right
+       The result is the same as that of lioness_decrypt.
+    """
+    assert len(key1)==len(key3)==DIGEST_LEN
+    assert len(key2)==len(key4)==DIGEST_LEN
+
+    # We follow the 'slow, comprehensible version' of lioness_decrypt,
+    # but never hold the whole right-hand side in memory.  Instead, we
+    # make one pass over the ciphertext for each hash of the right side,
+    # and regenerate the intermediate right side on the fly from the
+    # counter-mode streams, which we can start at any offset.
+    h = _sha1_new(key4)
+    left = _forEachRightBlock(blocks, lambda off, b, h=h: h.update(b))
+    h.update(key4)
+    left = strxor(left, h.digest())
+
+    k3 = aes_key(sha1("".join([key3,left,key3]))[:AES_KEY_LEN])
+    h = _sha1_new(key2)
+    def hashRight(off, b, h=h, k3=k3):
+        h.update(ctr_crypt(b, k3, off))
+    _forEachRightBlock(blocks, hashRight)
+    h.update(key2)
+    left = strxor(left, h.digest())
+
+    k1 = aes_key(sha1("".join([key1,left,key1]))[:AES_KEY_LEN])
+    write(left)
+    def writeRight(off, b, k1=k1, k3=k3, write=write):
+        write(ctr_crypt(ctr_crypt(b, k3, off), k1, off))
+    _forEachRightBlock(blocks, writeRight)
+
+def _forEachRightBlock(blocks, fn):
+    """Helper for lioness_decrypt_stream: call fn(offset, block) for every
+       block of the right-hand side of the string given by 'blocks()', and
+       return the left-hand side."""
+    left = ""
+    offset = 0
+    for b in blocks():
+        if len(left) < DIGEST_LEN:
+            n = DIGEST_LEN - len(left)
+            left += b[:n]
+            b = b[n:]
+        if b:
+            fn(offset, b)
+            offset += len(b)
+    if not offset:
+        raise CryptoError("String too short for LIONESS")
+    return left
 
 def bear_encrypt(s,(key1,key2)):
     """Given four 20-byte keys, encrypts s using the BEAR
@@ -158,13 +189,11 @@ def bear_encrypt(s,(key1,key2)):
     assert len(key1) == len(key2) == DIGEST_LEN
     assert len(s) > DIGEST_LEN
 
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    left = _ml.strxor(left, _ml.sha1("".join((key1,right,key1))))
-    right = ctr_crypt(right, _ml.sha1(left)[:AES_KEY_LEN])
-    left = _ml.strxor(left, _ml.sha1("".join((key2,right,key2))))
-    return left + right
+    # Equivalent to:
+    #left = strxor(left, sha1("".join((key1,right,key1))))
+    #right = ctr_crypt(right, sha1(left)[:AES_KEY_LEN])
+    #left = strxor(left, sha1("".join((key2,right,key2))))
+    return _ml.bear_encrypt(s,(key1,key2))
 
 def bear_decrypt(s,(key1,key2)):
     """Given four 20-byte keys, decrypts s using the BEAR
@@ -174,13 +203,20 @@ def bear_decrypt(s,(key1,key2)):
     assert len(key1) == len(key2) == DIGEST_LEN
     assert len(s) > DIGEST_LEN
 
-    left = s[:DIGEST_LEN]
-    right = s[DIGEST_LEN:]
-    del s
-    left = _ml.strxor(left, _ml.sha1("".join((key2,right,key2))))
-    right = ctr_crypt(right, _ml.sha1(left)[:AES_KEY_LEN])
-    left = _ml.strxor(left, _ml.sha1("".join((key1,right,key1))))
-    return left + right
+    # Equivalent to:
+    #left = strxor(left, sha1("".join((key2,right,key2))))
+    #right = ctr_crypt(right, sha1(left)[:AES_KEY_LEN])
+    #left = strxor(left, sha1("".join((key1,right,key1))))
+    return _ml.bear_decrypt(s,(key1,key2))
+
+def sprp_crypt_inplace(buf, keys, encrypt=1, offset=0, length=-1):
+    """Given a writable buffer 'buf' (such as an array), encrypt it in place
+       using LIONESS (if 'keys' is a tuple of four 20-byte keys) or BEAR
+       (if 'keys' is a tuple of two 20-byte keys).  If 'encrypt' is false,
+       decrypt it instead.  If 'offset' and 'length' are provided, only
+       transform the 'length' bytes of 'buf' starting at 'offset'."""
+    assert len(keys) in (2,4)
+    return _ml.sprp_crypt_inplace(buf, tuple(keys), encrypt, offset, length)
 
 def whiten(s):
     """Return a whitened version of a string 's', using the whitening
@@ -196,6 +232,12 @@ def unwhiten(s):
     keys = Keyset("WHITEN").getLionessKeys("WHITEN")
     return lioness_decrypt(s, keys)
 
+def unwhiten_stream(blocks, write):
+    """Like unwhiten, but for strings too large to hold in memory.  See
+       lioness_decrypt_stream for the meaning of 'blocks' and 'write'."""
+    keys = Keyset("WHITEN").getLionessKeys("WHITEN")
+    lioness_decrypt_stream(blocks, keys, write)
+
 def openssl_seed(count):
     """Seeds the openssl rng with 'count' bytes of real entropy."""
     _ml.openssl_seed(trng(count))
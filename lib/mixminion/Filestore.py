@@ -15,23 +15,28 @@
 import anydbm
 import binascii
 import cPickle
+import cStringIO
 import dumbdbm
 import errno
 import os
 import stat
+import struct
 import threading
 import time
 import types
 import whichdb
 
 from mixminion.Common import MixError, MixFatalError, secureDelete, LOG, \
-     createPrivateDir, readFile, replaceFile, tryUnlink, writePickled
+     ceilDiv, createPrivateDir, readFile, readPickled, replaceFile, \
+     tryUnlink, writeFile, writePickled
 from mixminion.Crypto import getCommonPRNG
 
 __all__ = [ "StringStore", "StringMetadataStore",
             "ObjectStore", "ObjectMetadataStore",
             "MixedStore", "MixedMetadataStore",
+            "SegmentedStore", "SegmentedMetadataStore",
             "DBBase", "JournaledDBBase", "BooleanJournaledDBBase",
+            "JournalFile",
             "CorruptedFile",
             ]
 
@@ -46,6 +51,245 @@ class CorruptedFile(MixError):
 # trash.
 INPUT_TIMEOUT = 6000
 
+# Name of the file in a store's directory that holds its manifest.
+MANIFEST_FNAME = "manifest"
+# Tag at the start of every pickled manifest.
+MANIFEST_VERSION = "MANIFEST-1"
+# Layout of the header of a manifest journal record: a one-character
+# operation, the length of the handle, and the length of the data.  The
+# handle and the data follow the header.
+_MANIFEST_RECORD = "!cBL"
+_MANIFEST_RECORD_LEN = struct.calcsize(_MANIFEST_RECORD)
+
+class _StoreManifest:
+    """A persistent list of the messages in a BaseStore, along with their
+       pickled metadata, so that the store doesn't need to list its
+       directory or read every metadata file when it's opened.
+
+       The manifest is a pickled snapshot of the store's contents, and a
+       JournalFile of the changes made since the snapshot was written.
+       Each change is journaled _before_ the store makes it.  Thus, after a
+       crash, only the messages named in the journal can differ from what
+       the manifest says, and the store only needs to check those.  Before
+       we write a new snapshot, we fsync the store's directory, so that
+       every change in the old journal has reached the disk.
+
+       Not threadsafe: the caller must hold the store's lock."""
+    # Smallest number of journal records to let accumulate before we write
+    # a new snapshot.  (We also wait for at least one record per message,
+    # so that writing snapshots takes O(1) amortized time per change.)
+    MIN_JOURNAL = 1024
+    ## Fields:
+    # dir -- the store's directory.
+    # fname -- the name of the snapshot file.
+    # journalFileName -- the name of the journal file.
+    # journalFile -- a JournalFile for the journal, or None if the manifest
+    #    isn't loaded.
+    # nJournaled -- the number of records in the journal.
+    # handles -- a map from the handle of every message in 'msg' state to 1.
+    # metadata -- a map from handle to the contents of the corresponding
+    #    meta_ file (a pickled string).
+    # inputs -- a map from the handle of every message that may be in 'inp'
+    #    state to 1.
+    # removed -- a map from the handle of every message that may have files
+    #    in 'rmv' or 'rmvm' state to 1.
+    def __init__(self, dir):
+        """Create a manifest for the store in the directory 'dir'.  Call
+           load() or reset() before using it."""
+        self.dir = dir
+        self.fname = os.path.join(dir, MANIFEST_FNAME)
+        self.journalFileName = self.fname+"_jrnl"
+        self.journalFile = None
+        self.nJournaled = 0
+        self.handles = {}
+        self.metadata = {}
+        self.inputs = {}
+        self.removed = {}
+
+    def load(self):
+        """Read the manifest from disk.  Return a map from the handle of
+           every message named in the journal to 1.  If there is no usable
+           manifest, return None: the caller should build one with
+           reset()."""
+        try:
+            contents = readPickled(self.fname)
+            tag = contents[0]
+        except (OSError, IOError):
+            return None
+        except (cPickle.UnpicklingError, EOFError, ValueError,
+                TypeError, IndexError), e:
+            LOG.warn("Couldn't read manifest for %s: %s", self.dir, e)
+            return None
+        if tag != MANIFEST_VERSION:
+            LOG.warn("Unrecognized manifest version for %s", self.dir)
+            return None
+        _, self.handles, self.metadata, self.inputs, self.removed = contents
+
+        journaled = {}
+        n = pos = 0
+        if os.path.exists(self.journalFileName):
+            j = readFile(self.journalFileName, 1)
+            pos = 0
+            while pos + _MANIFEST_RECORD_LEN <= len(j):
+                op, hlen, dlen = struct.unpack(
+                    _MANIFEST_RECORD, j[pos:pos+_MANIFEST_RECORD_LEN])
+                start = pos + _MANIFEST_RECORD_LEN
+                end = start + hlen + dlen
+                if end > len(j):
+                    # We crashed in the middle of a write; the change
+                    # wasn't made.
+                    break
+                h = j[start:start+hlen]
+                self._apply(op, h, j[start+hlen:end])
+                journaled[h] = 1
+                pos = end
+                n += 1
+
+        self.journalFile = JournalFile(self.journalFileName)
+        # Remove any partial record at the end of the journal.
+        os.ftruncate(self.journalFile.fd, pos)
+        self.nJournaled = n
+        return journaled
+
+    def reset(self, handles, metadata, inputs, removed):
+        """Replace the contents of this manifest with the message handles
+           in 'handles', the metadata in 'metadata', the incomplete messages
+           in 'inputs', and the removed messages in 'removed', and write it
+           to disk."""
+        self.handles = handles
+        self.metadata = metadata
+        self.inputs = inputs
+        self.removed = removed
+        if self.journalFile is None:
+            self.journalFile = JournalFile(self.journalFileName)
+        self.compact()
+
+    def addMessage(self, handle):
+        """Record that 'handle' is about to enter the 'msg' state."""
+        self._append('A', handle)
+
+    def removeMessage(self, handle):
+        """Record that 'handle' is about to leave the 'msg' state."""
+        self._append('R', handle)
+
+    def addInput(self, handle):
+        """Record that 'handle' has just entered the 'inp' state."""
+        self._append('I', handle)
+
+    def discardInput(self, handle, state):
+        """Record that 'handle' is about to move from 'state' (either 'inp'
+           or 'inpm') to 'rmv' or 'rmvm'."""
+        self._append('T', handle, state)
+
+    def forgetInput(self, handle):
+        """Note that 'handle' is no longer in 'inp' state.  We don't journal
+           this: if we crash before the next snapshot, we just check the
+           handle again."""
+        try:
+            del self.inputs[handle]
+        except KeyError:
+            pass
+
+    def forgetRemoved(self, handle):
+        """Note that 'handle' has no files left in 'rmv' or 'rmvm' state.
+           As with forgetInput, we don't journal this."""
+        try:
+            del self.removed[handle]
+        except KeyError:
+            pass
+
+    def setMetadata(self, handle, s):
+        """Record that the metadata for 'handle' is about to become the
+           pickled string 's'."""
+        self._append('M', handle, s)
+
+    def removeMetadata(self, handle):
+        """Record that the metadata for 'handle' is about to be removed."""
+        self._append('D', handle)
+
+    def _apply(self, op, handle, data):
+        """Helper: make the change described by a journal record."""
+        if op == 'A':
+            self.handles[handle] = 1
+            self.forgetInput(handle)
+        elif op == 'R':
+            try:
+                del self.handles[handle]
+            except KeyError:
+                pass
+            self.removed[handle] = 1
+        elif op == 'M':
+            self.metadata[handle] = data
+        elif op == 'D':
+            try:
+                del self.metadata[handle]
+            except KeyError:
+                pass
+            self.removed[handle] = 1
+        elif op == 'I':
+            self.inputs[handle] = 1
+        elif op == 'T':
+            if data == 'inp':
+                self.forgetInput(handle)
+            self.removed[handle] = 1
+        else:
+            LOG.warn("Unrecognized record %r in manifest for %s",
+                     op, self.dir)
+
+    def _append(self, op, handle, data=""):
+        """Helper: journal a change, and apply it to the manifest in
+           memory."""
+        # Only write a snapshot _before_ journaling a change: the change
+        # we're about to journal hasn't been made yet.
+        if self.nJournaled >= max(self.MIN_JOURNAL, len(self.handles)):
+            self.compact()
+        self.journalFile.append(
+            struct.pack(_MANIFEST_RECORD, op, len(handle), len(data))
+            + handle + data)
+        self.nJournaled += 1
+        self._apply(op, handle, data)
+
+    def compact(self):
+        """Write a new snapshot of the manifest, and clear the journal."""
+        _fsyncDir(self.dir)
+        tmpname = self.fname+".tmp"
+        f = open(tmpname, 'wb')
+        try:
+            cPickle.dump((MANIFEST_VERSION, self.handles, self.metadata,
+                          self.inputs, self.removed), f, 1)
+            f.flush()
+            if hasattr(os, 'fsync'):
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        replaceFile(tmpname, self.fname)
+        self.journalFile.truncate()
+        self.nJournaled = 0
+
+    def close(self):
+        """Write a new snapshot of the manifest, and close the journal."""
+        if self.nJournaled:
+            self.compact()
+        self.journalFile.close()
+        self.journalFile = None
+
+def _fsyncDir(d):
+    """Helper: make sure that all the renames and unlinks in the directory
+       'd' have reached the disk, if this platform lets us."""
+    if not hasattr(os, 'fsync'):
+        return
+    try:
+        fd = os.open(d, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass # Not every platform can fsync a directory.
+    finally:
+        os.close(fd)
+
 class BaseStore:
     """A BaseStore is an unordered collection of files with secure insert,
        move, and delete operations.
@@ -82,6 +326,13 @@ class BaseStore:
        In the Mixminion server, no queue currently has more than one producer
        or more than one consumer ... so synchronization turns out to be
        fairly easy.
+
+       A store may keep a manifest (see _StoreManifest) of its messages,
+       their metadata, and its incomplete and removed messages.  If it
+       does, we never need to list the directory to find the messages or
+       to clean the store, except when building the manifest for the
+       first time.  A store with a manifest assumes that nobody
+       else is changing its directory.
        """
 
     # Fields:   dir--the location of the file store.
@@ -91,11 +342,14 @@ class BaseStore:
     #                 the queue object.  Filesystem operations are allowed
     #                 without holding the lock, but they must not be visible
     #                 to users of the queue.
-    def __init__(self, location, create=0, scrub=0):
+    #           _manifest: A _StoreManifest for this store, or None if we
+    #                 aren't keeping one.
+    def __init__(self, location, create=0, scrub=0, manifest=0):
         """Creates a file store object for a given directory, 'location'.  If
            'create' is true, creates the directory if necessary.  If 'scrub'
            is true, removes any incomplete or invalidated messages from the
-           store."""
+           store.  If 'manifest' is true, keep a manifest of the store's
+           contents."""
         secureDelete([]) # Make sure secureDelete is configured. HACK!
 
         self._lock = threading.RLock()
@@ -109,11 +363,96 @@ class BaseStore:
 
         createPrivateDir(location, nocreate=(not create))
 
+        # Count messages on first time through.
+        self.n_entries = -1
+
+        self._manifest = None
+        if manifest:
+            self._openManifest()
+
         if scrub:
             self.cleanQueue()
 
-        # Count messages on first time through.
-        self.n_entries = -1
+    def _openManifest(self):
+        """Helper: load this store's manifest, and bring it up to date with
+           the directory.  If there is no manifest yet, build one."""
+        try:
+            self._lock.acquire()
+            self._manifest = _StoreManifest(self.dir)
+            journaled = self._manifest.load()
+            if journaled is None:
+                self._rebuildManifest()
+            else:
+                # Every change is journaled before we make it, so only the
+                # messages named in the journal can disagree with the
+                # directory.
+                for h in journaled.keys():
+                    self._recoverHandle(h)
+            self.n_entries = len(self._manifest.handles)
+        finally:
+            self._lock.release()
+
+    def _rebuildManifest(self):
+        """Helper: replace this store's manifest with one built by scanning
+           the directory."""
+        LOG.info("Scanning %s to rebuild its manifest", self.dir)
+        handles = {}
+        inputs = {}
+        removed = {}
+        metaHandles = []
+        for fn in os.listdir(self.dir):
+            if fn.startswith("msg_"):
+                handles[fn[4:]] = 1
+            elif fn.startswith("inp_"):
+                inputs[fn[4:]] = 1
+            elif fn.startswith("rmv_"):
+                removed[fn[4:]] = 1
+            elif fn.startswith("rmvm_"):
+                removed[fn[5:]] = 1
+            elif fn.startswith("meta_"):
+                metaHandles.append(fn[5:])
+        self._manifest.reset(handles, self._readMetadataFiles(metaHandles),
+                             inputs, removed)
+
+    def _readMetadataFiles(self, handles):
+        """Helper: return a map from each handle in 'handles' to the
+           contents of its meta_ file.  Stores without metadata ignore
+           meta_ files."""
+        return {}
+
+    def _recoverHandle(self, handle):
+        """Helper: make the manifest's view of the message 'handle' match
+           the directory.  Called for messages that a crash or an error
+           may have left in an unexpected state."""
+        m = self._manifest
+        exists = os.path.exists(os.path.join(self.dir, "msg_"+handle))
+        if exists and not m.handles.has_key(handle):
+            m.addMessage(handle)
+        elif not exists and m.handles.has_key(handle):
+            m.removeMessage(handle)
+        # If we journaled a change to an incomplete message but never made
+        # it, make sure that cleanQueue still knows about the message.
+        if (not m.inputs.has_key(handle) and
+            os.path.exists(os.path.join(self.dir, "inp_"+handle))):
+            m.addInput(handle)
+        # If the metadata and the manifest disagree, we keep whichever
+        # we have: the manifest's copy is the newer one.
+        fname = os.path.join(self.dir, "meta_"+handle)
+        if os.path.exists(fname):
+            if not m.metadata.has_key(handle):
+                m.setMetadata(handle, readFile(fname, 1))
+        elif m.metadata.has_key(handle):
+            m.removeMetadata(handle)
+
+    def close(self):
+        """Release any resources held by this filestore."""
+        try:
+            self._lock.acquire()
+            if self._manifest is not None:
+                self._manifest.close()
+                self._manifest = None
+        finally:
+            self._lock.release()
 
     def lock(self):
         """Prevent access to this filestore from other threads."""
@@ -124,11 +463,16 @@ class BaseStore:
         self._lock.release()
 
     def count(self, recount=0):
-        """Returns the number of complete messages in the filestore."""
+        """Returns the number of complete messages in the filestore.  If
+           'recount' is true, rescan the directory."""
         try:
             self._lock.acquire()
             if self.n_entries >= 0 and not recount:
                 return self.n_entries
+            elif self._manifest is not None:
+                self._rebuildManifest()
+                self.n_entries = len(self._manifest.handles)
+                return self.n_entries
             else:
                 res = 0
                 for fn in os.listdir(self.dir):
@@ -153,13 +497,20 @@ class BaseStore:
         """Returns handles for all messages currently in the filestore.
            Note: this ordering is not guaranteed to be random."""
         self._lock.acquire()
-        hs = [fn[4:] for fn in os.listdir(self.dir) if fn.startswith("msg_")]
-        self._lock.release()
-        return hs
+        try:
+            if self._manifest is not None:
+                return self._manifest.handles.keys()
+            return [fn[4:] for fn in os.listdir(self.dir)
+                    if fn.startswith("msg_")]
+        finally:
+            self._lock.release()
 
     def messageExists(self, handle):
         """Return true iff this filestore contains a message with the handle
            'handle'."""
+        m = self._manifest
+        if m is not None:
+            return m.handles.has_key(handle)
         return os.path.exists(os.path.join(self.dir, "msg_"+handle))
 
     def _doRemove(self, handle, newState):
@@ -181,7 +532,7 @@ class BaseStore:
             for m in os.listdir(self.dir):
                 if m[:4] in ('inp_', 'msg_'):
                     self._changeState(m[4:], m[:3], "rmv")
-                elif m[:4] in ('inpm_', 'meta_'):
+                elif m[:5] in ('inpm_', 'meta_'):
                     self._changeState(m[5:], m[:4], "rmvm")
             self.n_entries = 0
             self.cleanQueue(secureDeleteFn)
@@ -207,6 +558,15 @@ class BaseStore:
         while 1:
             f, handle = getCommonPRNG().openNewFile(self.dir, "inp_", 1,
                                                        "msg_")
+            if self._manifest is not None:
+                # We can't journal the handle until the file exists.  If we
+                # crash in between, we leave an empty inp_ file that only a
+                # rebuild of the manifest will find.
+                try:
+                    self._lock.acquire()
+                    self._manifest.addInput(handle)
+                finally:
+                    self._lock.release()
             return f, handle
         raise AssertionError # unreached; appease pychecker
 
@@ -243,10 +603,19 @@ class BaseStore:
            returns 0.
         """
         # We don't need to hold the lock here; we synchronize via the
-        # filesystem.
+        # filesystem.  (If we have a manifest, _findTrashInManifest holds
+        # the lock while it reads the manifest.)
 
-        rmv = []
         allowedTime = int(time.time()) - INPUT_TIMEOUT
+        if self._manifest is not None:
+            rmv = self._findTrashInManifest(allowedTime)
+            if secureDeleteFn:
+                secureDeleteFn(rmv)
+            else:
+                secureDelete(rmv, blocking=1)
+            return
+
+        rmv = []
         for m in os.listdir(self.dir):
             if m.startswith("rmv_") or m.startswith("rmvm_"):
                 rmv.append(os.path.join(self.dir, m))
@@ -263,18 +632,65 @@ class BaseStore:
         else:
             secureDelete(rmv, blocking=1)
 
+    def _findTrashInManifest(self, allowedTime):
+        """Helper for cleanQueue: use the manifest to find every incomplete
+           message last modified before 'allowedTime', and mark it removed.
+           Return a list of the names of all the removed files in the
+           store."""
+        rmv = []
+        try:
+            self._lock.acquire()
+            m = self._manifest
+            for h in m.inputs.keys():
+                try:
+                    s = os.stat(os.path.join(self.dir, "inp_"+h))
+                except OSError:
+                    m.forgetInput(h)
+                    continue
+                if s[stat.ST_MTIME] < allowedTime:
+                    self._changeState(h, "inp", "rmv")
+            for h in m.removed.keys():
+                found = 0
+                for fn in "rmv_"+h, "rmvm_"+h:
+                    fn = os.path.join(self.dir, fn)
+                    if os.path.exists(fn):
+                        rmv.append(fn)
+                        found = 1
+                # We only forget a removed message once its files are
+                # really gone, in case the last delete didn't finish.
+                if not found:
+                    m.forgetRemoved(h)
+        finally:
+            self._lock.release()
+        return rmv
+
     def _changeState(self, handle, s1, s2):
         """Helper method: changes the state of message 'handle' from 's1'
            to 's2', and changes the internal count."""
         try:
             self._lock.acquire()
+            m = self._manifest
+            if m is not None:
+                # Journal the change before we make it; see _StoreManifest.
+                if s2 == 'msg' and s1 != 'msg':
+                    m.addMessage(handle)
+                elif s1 == 'msg' and s2 != 'msg':
+                    m.removeMessage(handle)
+                elif s1 == 'meta' and s2 != 'meta':
+                    m.removeMetadata(handle)
+                elif s1 in ('inp', 'inpm') and s2 in ('rmv', 'rmvm'):
+                    m.discardInput(handle, s1)
             try:
                 replaceFile(os.path.join(self.dir, s1+"_"+handle),
                             os.path.join(self.dir, s2+"_"+handle))
             except OSError, e:
-                contents = os.listdir(self.dir)
                 LOG.error("Error while trying to change %s from %s to %s: %s",
                           handle, s1, s2, e)
+                if m is not None:
+                    self._recoverHandle(handle)
+                    self.n_entries = len(m.handles)
+                    return
+                contents = os.listdir(self.dir)
                 LOG.error("Directory %s contains: %s", self.dir, contents)
                 self.count(1)
                 return
@@ -359,16 +775,50 @@ class BaseMetadataStore(BaseStore):
     ##Fields:
     # _metadata_cache: map from handle to cached metadata object.  This is
     #    a write-through cache.
-    def __init__(self, location, create=0, scrub=0):
+    def __init__(self, location, create=0, scrub=0, manifest=0):
         """Create a new BaseMetadataStore to store files in 'location'. The
-           'create' and 'scrub' arguments are as for BaseStore(...)."""
-        BaseStore.__init__(self, location=location, create=create, scrub=scrub)
+           'create', 'scrub', and 'manifest' arguments are as for
+           BaseStore(...)."""
+        BaseStore.__init__(self, location=location, create=create, scrub=scrub,
+                           manifest=manifest)
         self._metadata_cache = {}
         if scrub:
             self.cleanMetadata()
 
+    def _readMetadataFiles(self, handles):
+        metadata = {}
+        for h in handles:
+            try:
+                metadata[h] = readFile(os.path.join(self.dir, "meta_"+h), 1)
+            except (OSError, IOError), e:
+                LOG.warn("Couldn't read metadata for %s in %s: %s",
+                         h, self.dir, e)
+        return metadata
+
     def cleanMetadata(self,secureDeleteFn=None):
         """Find all orphaned metadata files and remove them."""
+        if self._manifest is not None:
+            # We can find the orphans without listing the directory.
+            self._lock.acquire()
+            try:
+                m = self._manifest
+                orphans = [ h for h in m.metadata.keys()
+                            if not m.handles.has_key(h) ]
+                if not orphans:
+                    return
+                LOG.warn("Removing %s orphaned metadata files from %s",
+                         len(orphans), self.dir)
+                for h in orphans:
+                    self._changeState(h, "meta", "rmvm")
+            finally:
+                self._lock.release()
+            rmv = [ os.path.join(self.dir, "rmvm_"+h) for h in orphans ]
+            if secureDeleteFn:
+                secureDeleteFn(rmv)
+            else:
+                secureDelete(rmv, blocking=1)
+            return
+
         hSet = {}
         for h in self.getAllMessages():
             hSet[h] = 1
@@ -376,7 +826,7 @@ class BaseMetadataStore(BaseStore):
         for h in [fn[5:] for fn in os.listdir(self.dir)
                   if fn.startswith("meta_")]:
             if not hSet.get(h):
-                rmv.append("meta_"+h)
+                rmv.append(os.path.join(self.dir, "meta_"+h))
         if rmv:
             LOG.warn("Removing %s orphaned metadata files from %s",
                      len(rmv), self.dir)
@@ -388,9 +838,22 @@ class BaseMetadataStore(BaseStore):
     def loadAllMetadata(self, newDataFn):
         """For all objects in the store, load their metadata into the internal
            cache.  If any object is missing its metadata, create metadata for
-           it by invoking newDataFn(handle)."""
+           it by invoking newDataFn(handle).
+
+           If we have a manifest, we don't unpickle any metadata yet: the
+           cache does that when somebody asks for it."""
         try:
             self._lock.acquire()
+            if self._manifest is not None:
+                self._metadata_cache = _MetadataCache(self)
+                meta = self._manifest.metadata
+                for h in self.getAllMessages():
+                    if meta.has_key(h):
+                        self._metadata_cache.handles[h] = 1
+                    else:
+                        LOG.warn("Missing metadata for file %s",h)
+                        self.setMetadata(h, newDataFn(h))
+                return
             self._metadata_cache = {}
             for h in self.getAllMessages():
                 try:
@@ -407,7 +870,7 @@ class BaseMetadataStore(BaseStore):
         """Return the metadata associated with a given handle.  If the
            metadata is damaged, may raise CorruptedFile."""
         fname = os.path.join(self.dir, "meta_"+handle)
-        if not os.path.exists(fname):
+        if self._manifest is None and not os.path.exists(fname):
             raise KeyError(handle)
         try:
             self._lock.acquire()
@@ -415,20 +878,30 @@ class BaseMetadataStore(BaseStore):
                 return self._metadata_cache[handle]
             except KeyError:
                 pass
-            f = open(fname, 'rb')
-            try:
-                res = cPickle.load(f)
-            except cPickle.UnpicklingError, e:
-                LOG.error("Found damaged metadata for %s in filestore %s: %s",
-                          handle, self.dir, str(e))
-                self._preserveCorrupted(handle)
-                raise CorruptedFile()
-            f.close()
+            res = self._loadMetadata(handle)
             self._metadata_cache[handle] = res
             return res
         finally:
             self._lock.release()
 
+    def _loadMetadata(self, handle):
+        """Helper: read and unpickle the metadata for 'handle'.  If the
+           metadata is damaged, raise CorruptedFile.  Callers must hold
+           self._lock."""
+        if self._manifest is not None:
+            f = cStringIO.StringIO(self._manifest.metadata[handle])
+        else:
+            f = open(os.path.join(self.dir, "meta_"+handle), 'rb')
+        try:
+            res = cPickle.load(f)
+        except (cPickle.UnpicklingError, EOFError), e:
+            LOG.error("Found damaged metadata for %s in filestore %s: %s",
+                      handle, self.dir, str(e))
+            self._preserveCorrupted(handle)
+            raise CorruptedFile()
+        f.close()
+        return res
+
     def setMetadata(self, handle, object):
         """Change the metadata associated with a given handle."""
         # On windows or (old-school) mac, binary != text.
@@ -438,7 +911,12 @@ class BaseMetadataStore(BaseStore):
             self._lock.acquire()
             fname = os.path.join(self.dir, "inpm_"+handle)
             f = os.fdopen(os.open(fname, flags, 0600), "wb")
-            cPickle.dump(object, f, 1)
+            if self._manifest is not None:
+                s = cPickle.dumps(object, 1)
+                f.write(s)
+                self._manifest.setMetadata(handle, s)
+            else:
+                cPickle.dump(object, f, 1)
             self.finishMessage(f, handle, _ismeta=1)
             self._metadata_cache[handle] = object
             return handle
@@ -451,7 +929,12 @@ class BaseMetadataStore(BaseStore):
             # Remove the message before the metadata, so we don't have
             # a message without metadata.
             BaseStore._doRemove(self, handle, newState)
-            if os.path.exists(os.path.join(self.dir, "meta_"+handle)):
+            if self._manifest is not None:
+                hasMeta = self._manifest.metadata.has_key(handle)
+            else:
+                hasMeta = os.path.exists(
+                    os.path.join(self.dir, "meta_"+handle))
+            if hasMeta:
                 self._changeState(handle, "meta", newState+"m")
 
             try:
@@ -461,6 +944,72 @@ class BaseMetadataStore(BaseStore):
         finally:
             self._lock.release()
 
+class _MetadataCache:
+    """The write-through metadata cache of a BaseMetadataStore that keeps a
+       manifest.  It knows which messages have metadata, but it only
+       unpickles a message's metadata when somebody asks for it.  Supports
+       as much of the dict interface as users of _metadata_cache need."""
+    ## Fields:
+    # store -- the BaseMetadataStore.
+    # handles -- a map from the handle of every message in the cache to 1.
+    # objects -- a map from handle to unpickled metadata, for every message
+    #    whose metadata we've unpickled.
+    def __init__(self, store):
+        self.store = store
+        self.handles = {}
+        self.objects = {}
+
+    def __len__(self):
+        return len(self.handles)
+
+    def has_key(self, handle):
+        return self.handles.has_key(handle)
+
+    __contains__ = has_key
+
+    def keys(self):
+        return self.handles.keys()
+
+    def __getitem__(self, handle):
+        try:
+            return self.objects[handle]
+        except KeyError:
+            pass
+        if not self.handles.has_key(handle):
+            raise KeyError(handle)
+        try:
+            self.store._lock.acquire()
+            obj = self.store._loadMetadata(handle)
+        finally:
+            self.store._lock.release()
+        self.objects[handle] = obj
+        return obj
+
+    def __setitem__(self, handle, obj):
+        self.handles[handle] = 1
+        self.objects[handle] = obj
+
+    def __delitem__(self, handle):
+        del self.handles[handle]
+        try:
+            del self.objects[handle]
+        except KeyError:
+            pass
+
+    def items(self):
+        """Return a list of (handle, metadata) for every message in the
+           cache whose metadata isn't damaged."""
+        res = []
+        for h in self.handles.keys():
+            try:
+                res.append((h, self[h]))
+            except CorruptedFile:
+                pass
+        return res
+
+    def values(self):
+        return [ obj for _, obj in self.items() ]
+
 class StringMetadataStoreMixin(StringStoreMixin):
     """Add this mixin class to a BaseMetadataStore in order to get a
        filestore that stores strings with metadata."""
@@ -492,38 +1041,603 @@ class ObjectMetadataStoreMixin(ObjectStoreMixin):
         return handle
 
 class StringStore(BaseStore, StringStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, manifest=0):
+        BaseStore.__init__(self, location, create, scrub, manifest)
         StringStoreMixin.__init__(self)
 
 class StringMetadataStore(BaseMetadataStore, StringMetadataStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseMetadataStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, manifest=0):
+        BaseMetadataStore.__init__(self, location, create, scrub, manifest)
         StringMetadataStoreMixin.__init__(self)
 
 class ObjectStore(BaseStore, ObjectStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, manifest=0):
+        BaseStore.__init__(self, location, create, scrub, manifest)
         ObjectStoreMixin.__init__(self)
 
 class ObjectMetadataStore(BaseMetadataStore, ObjectMetadataStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseMetadataStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, manifest=0):
+        BaseMetadataStore.__init__(self, location, create, scrub, manifest)
         ObjectMetadataStoreMixin.__init__(self)
 
 class MixedStore(BaseStore, StringStoreMixin, ObjectStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, manifest=0):
+        BaseStore.__init__(self, location, create, scrub, manifest)
         StringStoreMixin.__init__(self)
         ObjectStoreMixin.__init__(self)
 
 class MixedMetadataStore(BaseMetadataStore, StringMetadataStoreMixin,
                          ObjectMetadataStoreMixin):
-    def __init__(self, location, create=0, scrub=0):
-        BaseMetadataStore.__init__(self, location, create, scrub)
+    def __init__(self, location, create=0, scrub=0, manifest=0):
+        BaseMetadataStore.__init__(self, location, create, scrub, manifest)
         StringMetadataStoreMixin.__init__(self)
         ObjectMetadataStoreMixin.__init__(self)
 
+# ======================================================================
+# Segmented filestores.
+
+# Magic string at the start of every slot that holds part of a message.
+_SLOT_MAGIC = "MSLT"
+# Layout of the header at the start of every used slot: the magic string,
+# the message's handle, the serial number of the record, the index of this
+# slot within the record, the number of slots in the record, the number of
+# bytes of the record in this slot, and the length of the record's metadata.
+_SLOT_HEADER = "!4s8sLHHLL"
+_SLOT_HEADER_LEN = struct.calcsize(_SLOT_HEADER)
+# Default length of a slot: enough for a 32K packet, plus room for the
+# pickling overhead and metadata of the objects we queue.
+DEFAULT_SLOT_LEN = 33*1024
+
+class SegmentedStore:
+    """A SegmentedStore implements the same interface as MixedStore, but
+       keeps all of its messages in a few large 'segment' files instead of
+       one file per message.  This saves us the creat, rename, and unlink
+       calls (and the shred process) that every message costs a BaseStore.
+
+       Implementation: each segment file is divided into SLOTS_PER_SEGMENT
+       slots of 'slotLen' bytes.  We store a message (along with its
+       pickled metadata, if any) as a 'record' that takes up one or more
+       slots; each slot in a record starts with a header giving the
+       message's handle, the record's serial number, and the slot's place
+       in the record.  We never change a record in place: to change a
+       message's metadata, we write a new record with a higher serial
+       number and then wipe the old one.  When we remove a message, we
+       overwrite its slots with zeros and reuse them for later messages.
+
+       We keep an index of which slots hold which messages in memory, and
+       rebuild it from the slot headers when we open the store.  Records
+       with missing slots (because we crashed while writing them) are
+       discarded.
+
+       If we find files from a BaseStore in the directory, we import them
+       and remove them.
+       """
+    ## Fields:
+    # dir -- the location of the file store.
+    # slotLen -- the length of each slot, in bytes.
+    # _lock -- a threading.RLock that must be held while modifying or
+    #    accessing the store.
+    # _segments -- a list of file descriptors for the segment files, in
+    #    order.  Slot number N lives in segment N//SLOTS_PER_SEGMENT.
+    # _free -- a list of the numbers of unused slots.
+    # _records -- map from handle to a (serial, slot list, metadata length)
+    #    tuple for every message in the store.
+    # _nextSerial -- the serial number to use for the next record we write.
+    # _pending -- map from handle to pickled metadata (or None) for every
+    #    message returned by openNewMessage but not yet finished.
+    # _needSync -- flag: have we wiped any slots since the last cleanQueue?
+
+    # Number of slots in each segment file.
+    SLOTS_PER_SEGMENT = 256
+    def __init__(self, location, create=0, scrub=0,
+                 slotLen=DEFAULT_SLOT_LEN):
+        """Create a SegmentedStore to store files in 'location'.  If
+           'create' is true, creates the directory if necessary.  Every
+           message and its metadata will use a multiple of 'slotLen' bytes.
+           ('scrub' is accepted for compatibility with BaseStore; we always
+           discard incomplete messages.)"""
+        self._lock = threading.RLock()
+        self.dir = location
+        self.slotLen = slotLen
+
+        if not os.path.isabs(location):
+            LOG.warn("Directory path %s isn't absolute.", location)
+
+        if os.path.exists(location) and not os.path.isdir(location):
+            raise MixFatalError("%s is not a directory" % location)
+
+        createPrivateDir(location, nocreate=(not create))
+
+        self._segments = []
+        self._free = []
+        self._records = {}
+        self._nextSerial = 1
+        self._pending = {}
+        self._needSync = 0
+        self._scan()
+        self._importFiles()
+
+    def lock(self):
+        """Prevent access to this filestore from other threads."""
+        self._lock.acquire()
+
+    def unlock(self):
+        """Release the lock on this filestore."""
+        self._lock.release()
+
+    def _scan(self):
+        """Helper: open all of our segment files, and rebuild our index
+           from the slot headers."""
+        segNames = [ fn for fn in os.listdir(self.dir)
+                     if fn.startswith("seg_") ]
+        segNames.sort()
+        # Map from (handle, serial) to list of (idx, slot, nSlots, metaLen)
+        parts = {}
+        for fn in segNames:
+            if fn != "seg_%05d" % len(self._segments):
+                raise MixFatalError("Unexpected segment file %s in %s" %
+                                    (fn, self.dir))
+            fd = self._openSegment(os.path.join(self.dir, fn))
+            first = len(self._segments)*self.SLOTS_PER_SEGMENT
+            self._segments.append(fd)
+            for slot in xrange(first, first+self.SLOTS_PER_SEGMENT):
+                os.lseek(fd, (slot-first)*self.slotLen, 0)
+                hdr = os.read(fd, _SLOT_HEADER_LEN)
+                if len(hdr) < _SLOT_HEADER_LEN or hdr[:4] != _SLOT_MAGIC:
+                    self._free.append(slot)
+                    continue
+                _, handle, serial, idx, nSlots, _, metaLen = struct.unpack(
+                    _SLOT_HEADER, hdr)
+                parts.setdefault((handle, serial), []).append(
+                    (idx, slot, nSlots, metaLen))
+                if serial >= self._nextSerial:
+                    self._nextSerial = serial+1
+
+        # Keep the newest complete record for each handle.
+        stale = []
+        for (handle, serial), lst in parts.items():
+            lst.sort()
+            slots = [ slot for _, slot, _, _ in lst ]
+            nSlots, metaLen = lst[0][2], lst[0][3]
+            if [ idx for idx, _, _, _ in lst ] != range(nSlots):
+                LOG.warn("Discarding incomplete message %s in %s",
+                         handle, self.dir)
+                stale.extend(slots)
+                continue
+            old = self._records.get(handle)
+            if old is not None and old[0] > serial:
+                stale.extend(slots)
+                continue
+            elif old is not None:
+                stale.extend(old[1])
+            self._records[handle] = (serial, slots, metaLen)
+        if stale:
+            self._wipeSlots(stale)
+        # Hand out low-numbered slots first.
+        self._free.sort()
+        self._free.reverse()
+
+    def _importFiles(self):
+        """Helper: if there are any messages in this directory from a
+           BaseStore, move them into our segments."""
+        names = os.listdir(self.dir)
+        handles = [ fn[4:] for fn in names if fn.startswith("msg_") ]
+        if not handles:
+            return
+        LOG.info("Importing %s messages into segmented store %s",
+                 len(handles), self.dir)
+        for h in handles:
+            data = readFile(os.path.join(self.dir, "msg_"+h), 1)
+            metaFn = os.path.join(self.dir, "meta_"+h)
+            if os.path.exists(metaFn):
+                meta = readFile(metaFn, 1)
+            else:
+                meta = ""
+            self._writeRecord(h, meta, data)
+        rmv = [ os.path.join(self.dir, fn) for fn in names
+                if fn[:4] in ("msg_", "inp_", "rmv_") or
+                   fn[:5] in ("meta_", "inpm_", "rmvm_") ]
+        secureDelete(rmv, blocking=1)
+
+    def _openSegment(self, fname):
+        """Helper: open the segment file 'fname', creating it if needed, and
+           make sure that it has room for all of its slots."""
+        fd = os.open(fname, os.O_RDWR|os.O_CREAT|getattr(os,'O_BINARY',0),
+                     0600)
+        size = self.SLOTS_PER_SEGMENT*self.slotLen
+        curSize = os.fstat(fd)[stat.ST_SIZE]
+        if curSize == 0:
+            # Allocate the whole segment now, so that the file doesn't
+            # grow a little with every message.
+            os.ftruncate(fd, size)
+        elif curSize != size:
+            os.close(fd)
+            raise MixFatalError("Segment file %s has the wrong size" % fname)
+        return fd
+
+    def _allocSlots(self, n):
+        """Helper: remove 'n' slots from the free list and return them,
+           adding a new segment file if we need one."""
+        while len(self._free) < n:
+            fname = os.path.join(self.dir, "seg_%05d" % len(self._segments))
+            first = len(self._segments)*self.SLOTS_PER_SEGMENT
+            self._segments.append(self._openSegment(fname))
+            new = range(first, first+self.SLOTS_PER_SEGMENT)
+            new.reverse()
+            self._free[:0] = new
+        slots = self._free[-n:]
+        slots.reverse()
+        del self._free[-n:]
+        return slots
+
+    def _writeSlot(self, slot, s):
+        """Helper: write the string 's' at the start of slot number 'slot',
+           and fill the rest of the slot with zeros."""
+        assert len(s) <= self.slotLen
+        fd = self._segments[slot // self.SLOTS_PER_SEGMENT]
+        os.lseek(fd, (slot % self.SLOTS_PER_SEGMENT)*self.slotLen, 0)
+        s += "\000"*(self.slotLen-len(s))
+        while s:
+            n = os.write(fd, s)
+            s = s[n:]
+
+    def _readSlot(self, slot):
+        """Helper: return the contents of slot number 'slot'."""
+        fd = self._segments[slot // self.SLOTS_PER_SEGMENT]
+        os.lseek(fd, (slot % self.SLOTS_PER_SEGMENT)*self.slotLen, 0)
+        res = []
+        left = self.slotLen
+        while left:
+            s = os.read(fd, left)
+            if not s:
+                break
+            res.append(s)
+            left -= len(s)
+        return "".join(res)
+
+    def _wipeSlots(self, slots):
+        """Helper: overwrite every slot in 'slots' with zeros, and return
+           them to the free list."""
+        for slot in slots:
+            self._writeSlot(slot, "")
+        self._free.extend(slots)
+        self._needSync = 1
+
+    def _syncSlots(self, slots):
+        """Helper: make sure that every slot in 'slots' has reached the
+           disk."""
+        segs = {}
+        for slot in slots:
+            segs[slot // self.SLOTS_PER_SEGMENT] = 1
+        for seg in segs.keys():
+            os.fsync(self._segments[seg])
+
+    def _writeRecord(self, handle, meta, data):
+        """Helper: store the message 'data' with the pickled metadata
+           'meta' (or "" for none) under the handle 'handle', replacing
+           any record we already have for 'handle'."""
+        assert len(handle) == 8
+        payload = meta+data
+        room = self.slotLen - _SLOT_HEADER_LEN
+        nSlots = max(1, ceilDiv(len(payload), room))
+        try:
+            self._lock.acquire()
+            slots = self._allocSlots(nSlots)
+            serial = self._nextSerial
+            self._nextSerial += 1
+            for idx in xrange(nSlots):
+                chunk = payload[idx*room:(idx+1)*room]
+                hdr = struct.pack(_SLOT_HEADER, _SLOT_MAGIC, handle, serial,
+                                  idx, nSlots, len(chunk), len(meta))
+                self._writeSlot(slots[idx], hdr+chunk)
+            old = self._records.get(handle)
+            self._records[handle] = (serial, slots, len(meta))
+            if old is not None:
+                # The new record must be on disk before we wipe the old
+                # one, or a crash could leave us with neither.
+                self._syncSlots(slots)
+                self._wipeSlots(old[1])
+        finally:
+            self._lock.release()
+
+    def _readRecord(self, handle):
+        """Helper: return a (pickled metadata, message) tuple for the
+           message 'handle'.  Raises KeyError if there is no such
+           message."""
+        try:
+            self._lock.acquire()
+            _, slots, metaLen = self._records[handle]
+            chunks = []
+            for slot in slots:
+                s = self._readSlot(slot)
+                ln = struct.unpack(_SLOT_HEADER, s[:_SLOT_HEADER_LEN])[5]
+                chunks.append(s[_SLOT_HEADER_LEN:_SLOT_HEADER_LEN+ln])
+        finally:
+            self._lock.release()
+        payload = "".join(chunks)
+        return payload[:metaLen], payload[metaLen:]
+
+    def _newHandle(self):
+        """Helper: return a random handle that isn't yet in use."""
+        while 1:
+            h = binascii.b2a_base64(getCommonPRNG().getBytes(6)).strip()
+            h = h.replace("/","-")
+            if not (self._records.has_key(h) or self._pending.has_key(h)):
+                return h
+
+    def count(self, recount=0):
+        """Returns the number of complete messages in the filestore."""
+        return len(self._records)
+
+    def pickRandom(self, count=None):
+        """Returns a list of 'count' handles to messages in this filestore.
+           The messages are chosen randomly, and returned in a random order.
+
+           If there are fewer than 'count' messages in the filestore,
+           all the messages will be included."""
+        handles = self.getAllMessages() # handles locking
+
+        return getCommonPRNG().shuffle(handles, count)
+
+    def getAllMessages(self):
+        """Returns handles for all messages currently in the filestore.
+           Note: this ordering is not guaranteed to be random."""
+        try:
+            self._lock.acquire()
+            hs = self._records.keys()
+        finally:
+            self._lock.release()
+        return hs
+
+    def messageExists(self, handle):
+        """Return true iff this filestore contains a message with the handle
+           'handle'."""
+        return self._records.has_key(handle)
+
+    def removeMessage(self, handle):
+        """Given a handle, removes the corresponding message from the
+           filestore.  """
+        try:
+            self._lock.acquire()
+            try:
+                _, slots, _ = self._records[handle]
+            except KeyError:
+                LOG.error("Tried to remove nonexistent message %s from %s",
+                          handle, self.dir)
+                return
+            del self._records[handle]
+            self._wipeSlots(slots)
+        finally:
+            self._lock.release()
+
+    def _preserveCorrupted(self, handle):
+        """Given a handle, save the corresponding message in a crp_ file
+           for later analysis, and remove it from the store."""
+        try:
+            self._lock.acquire()
+            try:
+                meta, data = self._readRecord(handle)
+            except KeyError:
+                return
+            writeFile(os.path.join(self.dir, "crp_"+handle), data, binary=1)
+            if meta:
+                writeFile(os.path.join(self.dir, "crpm_"+handle), meta,
+                          binary=1)
+            self.removeMessage(handle)
+        finally:
+            self._lock.release()
+
+    def removeAll(self, secureDeleteFn=None):
+        """Removes all messages from this filestore."""
+        try:
+            self._lock.acquire()
+            for h in self._records.keys():
+                self.removeMessage(h)
+            self.cleanQueue(secureDeleteFn)
+        finally:
+            self._lock.release()
+
+    def openMessage(self, handle):
+        """Given a handle for an existing message, returns a file-like
+           object open to read that message."""
+        return cStringIO.StringIO(self.messageContents(handle))
+
+    def openNewMessage(self):
+        """Returns (file, handle) tuple to create a new message.  Once
+           you're done writing, you must call finishMessage to
+           commit your changes, or abortMessage to reject them."""
+        try:
+            self._lock.acquire()
+            handle = self._newHandle()
+            self._pending[handle] = None
+        finally:
+            self._lock.release()
+        return cStringIO.StringIO(), handle
+
+    def finishMessage(self, f, handle):
+        """Given a file and a corresponding handle, closes the file
+           commits the corresponding message."""
+        data = f.getvalue()
+        f.close()
+        try:
+            self._lock.acquire()
+            meta = self._pending[handle]
+            del self._pending[handle]
+            self._writeRecord(handle, meta or "", data)
+        finally:
+            self._lock.release()
+
+    def abortMessage(self, f, handle):
+        """Given a file and a corresponding handle, closes the file
+           rejects the corresponding message."""
+        f.close()
+        try:
+            self._lock.acquire()
+            del self._pending[handle]
+        finally:
+            self._lock.release()
+
+    def cleanQueue(self, secureDeleteFn=None):
+        """Make sure that the slots of every message we've removed have
+           been overwritten on disk.  ('secureDeleteFn' is accepted for
+           compatibility with BaseStore.)"""
+        try:
+            self._lock.acquire()
+            if self._needSync:
+                for fd in self._segments:
+                    os.fsync(fd)
+                self._needSync = 0
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Release all resources held by this store."""
+        try:
+            self._lock.acquire()
+            self.cleanQueue()
+            for fd in self._segments:
+                os.close(fd)
+            self._segments = []
+        finally:
+            self._lock.release()
+
+    def messageContents(self, handle):
+        """Given a message handle, returns the contents of the corresponding
+           message."""
+        return self._readRecord(handle)[1]
+
+    def queueMessage(self, contents):
+        """Creates a new message in the filestore whose contents are
+           'contents', and returns a handle to that message."""
+        f, handle = self.openNewMessage()
+        f.write(contents)
+        self.finishMessage(f, handle) # handles locking
+        return handle
+
+    def getObject(self, handle):
+        """Given a message handle, read and unpickle the contents of
+           the corresponding message.  In rare error cases, raises
+           CorruptedFile.
+           """
+        try:
+            self._lock.acquire()
+            try:
+                return cPickle.loads(self.messageContents(handle))
+            except (cPickle.UnpicklingError, EOFError, ValueError), e:
+                LOG.error("Found damaged object %s in filestore %s: %s",
+                          handle, self.dir, str(e))
+                self._preserveCorrupted(handle)
+                raise CorruptedFile()
+        finally:
+            self._lock.release()
+
+    def queueObject(self, object):
+        """Queue an object using cPickle, and return a handle to that
+           object."""
+        return self.queueMessage(cPickle.dumps(object, 1))
+
+class SegmentedMetadataStore(SegmentedStore):
+    """A SegmentedMetadataStore implements the same interface as
+       MixedMetadataStore, on top of a SegmentedStore.  Each message's
+       pickled metadata is kept in the same record as the message."""
+    ##Fields:
+    # _metadata_cache: map from handle to cached metadata object.  This is
+    #    a write-through cache.
+    def __init__(self, location, create=0, scrub=0,
+                 slotLen=DEFAULT_SLOT_LEN):
+        """Create a new SegmentedMetadataStore to store files in 'location'.
+           The other arguments are as for SegmentedStore(...)."""
+        self._metadata_cache = {}
+        SegmentedStore.__init__(self, location, create, scrub, slotLen)
+
+    def loadAllMetadata(self, newDataFn):
+        """For all objects in the store, load their metadata into the internal
+           cache.  If any object is missing its metadata, create metadata for
+           it by invoking newDataFn(handle)."""
+        try:
+            self._lock.acquire()
+            self._metadata_cache = {}
+            for h in self.getAllMessages():
+                try:
+                    self.getMetadata(h)
+                except KeyError:
+                    LOG.warn("Missing metadata for message %s",h)
+                    self.setMetadata(h, newDataFn(h))
+                except CorruptedFile:
+                    continue
+        finally:
+            self._lock.release()
+
+    def getMetadata(self, handle):
+        """Return the metadata associated with a given handle.  If the
+           metadata is damaged, may raise CorruptedFile."""
+        try:
+            self._lock.acquire()
+            try:
+                return self._metadata_cache[handle]
+            except KeyError:
+                pass
+            meta = self._readRecord(handle)[0]
+            if not meta:
+                raise KeyError(handle)
+            try:
+                res = cPickle.loads(meta)
+            except (cPickle.UnpicklingError, EOFError, ValueError), e:
+                LOG.error("Found damaged metadata for %s in filestore %s: %s",
+                          handle, self.dir, str(e))
+                self._preserveCorrupted(handle)
+                raise CorruptedFile()
+            self._metadata_cache[handle] = res
+            return res
+        finally:
+            self._lock.release()
+
+    def setMetadata(self, handle, object):
+        """Change the metadata associated with a given handle."""
+        meta = cPickle.dumps(object, 1)
+        try:
+            self._lock.acquire()
+            if self._pending.has_key(handle):
+                self._pending[handle] = meta
+            else:
+                self._writeRecord(handle, meta, self.messageContents(handle))
+            self._metadata_cache[handle] = object
+            return handle
+        finally:
+            self._lock.release()
+
+    def removeMessage(self, handle):
+        """Given a handle, removes the corresponding message and its
+           metadata from the filestore."""
+        try:
+            self._lock.acquire()
+            SegmentedStore.removeMessage(self, handle)
+            try:
+                del self._metadata_cache[handle]
+            except KeyError:
+                pass
+        finally:
+            self._lock.release()
+
+    def queueMessage(self, message):
+        LOG.warn("Called 'queueMessage' on a metadata store.")
+        return self.queueMessageAndMetadata(message, None)
+
+    def queueMessageAndMetadata(self, message, metadata):
+        f, handle = self.openNewMessage()
+        f.write(message)
+        self.setMetadata(handle, metadata)
+        self.finishMessage(f, handle) # handles locking
+        return handle
+
+    def queueObject(self, object):
+        LOG.warn("Called 'queueObject' on a metadata store.")
+        return self.queueObjectAndMetadata(object, None)
+
+    def queueObjectAndMetadata(self, object, metadata):
+        return self.queueMessageAndMetadata(cPickle.dumps(object, 1),
+                                            metadata)
+
 # ======================================================================
 # Database wrappers
 
@@ -723,6 +1837,88 @@ class DBBase:
 
 # Flags for use when opening the journal.
 _JOURNAL_OPEN_FLAGS = os.O_WRONLY|os.O_CREAT|getattr(os,'O_SYNC',0)|getattr(os,'O_BINARY',0)
+# Flags for use when opening the journal in group-commit mode.  We call
+# fsync ourselves after each group of writes.
+_GROUP_JOURNAL_OPEN_FLAGS = os.O_WRONLY|os.O_CREAT|getattr(os,'O_BINARY',0)
+
+class JournalFile:
+    """An append-only file of records, used as a journal by JournaledDBBase
+       and by mixminion.server.HashLog.
+
+       By default, every record is written to disk with O_SYNC as soon as
+       it is appended.  In group-commit mode, we gather records in memory
+       instead, and write each group to disk with a single write and
+       fsync: once MAX_BATCH records are waiting, once the oldest waiting
+       record is MAX_DELAY seconds old, or when commit() is called.  Users
+       of group-commit mode must call commit() (or replace the journal's
+       contents with truncate()) before relying on any record being on
+       disk.
+
+       Not threadsafe: the caller must hold a lock while using a
+       JournalFile."""
+    # Most records to gather before writing them.
+    MAX_BATCH = 256
+    # Most seconds to let a record wait before writing it.  (We only check
+    # this when a new record is appended.)
+    MAX_DELAY = 1.0
+    ## Fields:
+    # fname -- the name of the journal file.
+    # fd -- an fd open for appending to the journal file.
+    # groupCommit -- true iff we're in group-commit mode.
+    # pending -- a list of records not yet written to disk.
+    # pendingSince -- the time when the oldest record in 'pending' was
+    #    appended, or None if there are no such records.
+    def __init__(self, fname, groupCommit=0):
+        """Open the journal file 'fname' for appending, creating it if
+           needed.  If 'groupCommit' is true, use group-commit mode."""
+        self.fname = fname
+        self.groupCommit = groupCommit
+        self.pending = []
+        self.pendingSince = None
+        self.fd = os.open(fname, self._getFlags()|os.O_APPEND, 0600)
+
+    def _getFlags(self):
+        """Helper: return the flags to use when opening the journal."""
+        if self.groupCommit:
+            return _GROUP_JOURNAL_OPEN_FLAGS
+        else:
+            return _JOURNAL_OPEN_FLAGS
+
+    def append(self, record):
+        """Add the string 'record' to the end of the journal."""
+        if not self.groupCommit:
+            os.write(self.fd, record)
+            return
+        now = time.time()
+        if self.pendingSince is None:
+            self.pendingSince = now
+        self.pending.append(record)
+        if (len(self.pending) >= self.MAX_BATCH or
+            now - self.pendingSince >= self.MAX_DELAY):
+            self.commit()
+
+    def commit(self):
+        """Write all pending records to disk."""
+        if not self.pending:
+            return
+        os.write(self.fd, "".join(self.pending))
+        if hasattr(os, 'fsync'):
+            os.fsync(self.fd)
+        self.pending = []
+        self.pendingSince = None
+
+    def truncate(self):
+        """Remove all records from the journal, including pending ones."""
+        self.pending = []
+        self.pendingSince = None
+        os.close(self.fd)
+        self.fd = os.open(self.fname, self._getFlags()|os.O_TRUNC, 0600)
+
+    def close(self):
+        """Write all pending records to disk, and close the journal."""
+        self.commit()
+        os.close(self.fd)
+        self.fd = None
 
 class JournaledDBBase(DBBase):
     """Optimized version of DBBase that requires fewer sync() operations.
@@ -739,7 +1935,7 @@ class JournaledDBBase(DBBase):
     #      from disk.
     # journal -- map from journal-encoded key to journal-encoded value.
     # journalFileName -- filename to use for journal file.
-    # journalFile -- fd for the journal file
+    # journalFile -- a JournalFile for the journal file.
 
     def __init__(self, location, purpose, klen, vlen, vdflt):
         """Create a new JournaledDBBase that stores its files to match the
@@ -756,14 +1952,15 @@ class JournaledDBBase(DBBase):
         # If there's a journal file, snarf it into memory.
         if os.path.exists(self.journalFileName):
             j = readFile(self.journalFileName, 1)
-            for i in xrange(0, len(j), klen+vlen):
+            # (If we crashed in the middle of a write, ignore the partial
+            # record at the end.)
+            for i in xrange(0, len(j)-(klen+vlen)+1, klen+vlen):
                 if vlen:
                     self.journal[j[i:i+klen]] = j[i+klen:i+klen+vlen]
                 else:
                     self.journal[j[i:i+klen]] = self.vdefault
 
-        self.journalFile = os.open(self.journalFileName,
-                                   _JOURNAL_OPEN_FLAGS|os.O_APPEND, 0600)
+        self.journalFile = JournalFile(self.journalFileName)
 
         self.sync()
 
@@ -802,9 +1999,10 @@ class JournaledDBBase(DBBase):
         self._lock.acquire()
         try:
             self.journal[jk] = jv
-            os.write(self.journalFile, jk)
             if self.vlen:
-                os.write(self.journalFile, jv)
+                self.journalFile.append(jk+jv)
+            else:
+                self.journalFile.append(jk)
             if len(self.journal) > self.MAX_JOURNAL:
                 self.sync()
         finally:
@@ -834,9 +2032,7 @@ class JournaledDBBase(DBBase):
                 ev = self._encodeVal(self._jDecodeVal(self.journal[jk]))
                 self.log[ek] = ev
             self._syncLog()
-            os.close(self.journalFile)
-            self.journalFile = os.open(self.journalFileName,
-                                       _JOURNAL_OPEN_FLAGS|os.O_TRUNC, 0600)
+            self.journalFile.truncate()
             self.journal = {}
         finally:
             self._lock.release()
@@ -847,7 +2043,7 @@ class JournaledDBBase(DBBase):
             self.sync()
             self.log.close()
             self.log = None
-            os.close(self.journalFile)
+            self.journalFile.close()
         finally:
             self._lock.release()
 
@@ -6,10 +6,13 @@
 
 import binascii
 import math
+import sys
+import threading
 import time
 import mixminion._minionlib
 import mixminion.Filestore
-from mixminion.Crypto import ceilDiv, getCommonPRNG, sha1, whiten, unwhiten
+from mixminion.Crypto import ceilDiv, getCommonPRNG, sha1, whiten, unwhiten, \
+     unwhiten_stream
 from mixminion.Common import disp64, LOG, previousMidnight, MixError, \
      MixFatalError
 from mixminion.Packet import ENC_FWD_OVERHEAD, PAYLOAD_LEN, \
@@ -22,6 +25,14 @@ __all__ = [ "FragmentPool", "FragmentationParams" ]
 MAX_FRAGMENTS_PER_CHUNK = 16
 # Minimum proportion of extra packets to add to each chunk.
 EXP_FACTOR = 1.3333333333333333
+# Largest number of threads to use when encoding or decoding the chunks of
+# a single message.  (The FEC code doesn't hold the interpreter lock, so
+# these threads can run on separate CPUs.)
+MAX_FEC_THREADS = 4
+
+# When streaming a reassembled message, how many bytes do we read from
+# disk at a time?
+STREAM_BLOCK_SIZE = 1<<16
 
 class FragmentationParams:
     """Class to track the padding, chunking, and fragmentation required
@@ -98,15 +109,16 @@ class FragmentationParams:
             chunks.append( s[i*self.chunkSize:(i+1)*self.chunkSize] )
         del s
 
-        fragments = []
         for i in xrange(self.nChunks):
             blocks = []
             for j in xrange(self.k):
                 blocks.append( chunks[i][j*self.fragCapacity:
                                          (j+1)*self.fragCapacity] )
-            chunks[i] = None
-            for j in xrange(self.n):
-                fragments.append( self.fec.encode(j, blocks) )
+            chunks[i] = blocks
+
+        fragments = []
+        for encoded in _mapChunks(self.fec.encodeChunks, chunks):
+            fragments.extend(encoded)
         return fragments
 
 # ======================================================================
@@ -120,12 +132,13 @@ class FragmentPool:
     # store -- instance of StringMetadataStore.  The messages are either
     #    the contents of invidual fragments or reconstructed chunks.
     #    The metadata are instances of FragmentMetadata.
-    def __init__(self, dir):
+    def __init__(self, dir, manifest=0):
         """Open a FragmentPool storing fragments in 'dir' and records of
-           old messages in 'dir_db'.
+           old messages in 'dir_db'.  If 'manifest' is true, the fragment
+           store keeps a manifest of its contents.
            """
         self.store = mixminion.Filestore.StringMetadataStore(
-            dir,create=1)
+            dir,create=1,manifest=manifest)
         self.db = FragmentDB(dir+"_db")
         self.rescan()
 
@@ -140,6 +153,7 @@ class FragmentPool:
     def close(self):
         """Release open resources for this pool."""
         self.db.close()
+        self.store.close()
         del self.db
         del self.store
         del self.states
@@ -224,6 +238,34 @@ class FragmentPool:
         msg = unwhiten(msg[:s.params.length])
         return msg
 
+    def writeReadyMessage(self, msgid, write):
+        """As getReadyMessage, but instead of returning the message, pass
+           it a block at a time to the function 'write', so that the whole
+           message is never held in memory.  Return true if the message was
+           found and written; return false otherwise."""
+        s = self.states.get(msgid)
+        if not s or not s.isDone():
+            return 0
+
+        hs = s.getChunkHandles()
+        length = s.params.length
+        store = self.store
+        def blocks(hs=hs, length=length, store=store):
+            # Read the chunks in order, truncated to the message length.
+            # Unwhitening makes three passes, so we reopen the files each
+            # time rather than keeping anything in memory.
+            for h in hs:
+                f = store.openMessage(h)
+                while length > 0:
+                    b = f.read(min(length, STREAM_BLOCK_SIZE))
+                    if not b:
+                        break
+                    length -= len(b)
+                    yield b
+                f.close()
+        unwhiten_stream(blocks, write)
+        return 1
+
     def markMessageCompleted(self, msgid, rejected=0):
         """Release all resources associated with the messageid 'msgid', and
            reject future packets for that messageid.  If 'rejected', the
@@ -601,15 +643,30 @@ class MessageState:
            reconstruct them in a given store."""
         if not self.readyChunks:
             return
-        for chunkno in self.readyChunks.keys():
+        # We decode up to MAX_FEC_THREADS chunks at a time, so that we
+        # can use several CPUs without holding too many chunks in memory.
+        chunknos = self.readyChunks.keys()
+        for i in xrange(0, len(chunknos), MAX_FEC_THREADS):
+            self._reconstructChunks(store, chunknos[i:i+MAX_FEC_THREADS])
+
+    def _reconstructChunks(self, store, chunknos):
+        """Helper: reconstruct the ready chunks listed in 'chunknos'."""
+        chs = []
+        frags = []
+        for chunkno in chunknos:
             # Get the first K fragments in the chunk. (list of h,fm)
             ch = self.fragmentsByChunk[chunkno].values()[:self.params.k]
-            minDate = min([fm.insertedDate for h, fm in ch])
+            chs.append(ch)
             # Build a list of (position-within-chunk, fragment-contents).
-            frags = [(self.params.getPosition(fm.idx)[1],
-                      store.messageContents(h)) for h,fm in ch]
-            chunkText = "".join(self.params.getFEC().decode(frags))
-            del frags
+            frags.append([(self.params.getPosition(fm.idx)[1],
+                           store.messageContents(h)) for h,fm in ch])
+        decoded = _mapChunks(self.params.getFEC().decodeChunks, frags)
+        del frags
+
+        for chunkno, ch in zip(chunknos, chs):
+            minDate = min([fm.insertedDate for h, fm in ch])
+            chunkText = "".join(decoded[0])
+            del decoded[0]
             fm2 = FragmentMetadata(messageid=self.messageid,
                                    idx=chunkno, size=self.params.length,
                                    isChunk=1, chunkNum=chunkno,
@@ -695,3 +752,36 @@ def _getFEC(k,n):
         f = _fectab[(k,n)] = mixminion._minionlib.FEC_generate(k,n)
     return f
 
+def _mapChunks(fn, chunks):
+    """Helper: given a function 'fn' (such as FEC.encodeChunks or
+       FEC.decodeChunks) that takes a list of chunks and returns a list of
+       results, return fn(chunks).  If there are several chunks, split them
+       among up to MAX_FEC_THREADS threads."""
+    nThreads = min(MAX_FEC_THREADS, len(chunks))
+    if nThreads <= 1:
+        return fn(chunks)
+
+    per = ceilDiv(len(chunks), nThreads)
+    groups = [ chunks[i:i+per] for i in xrange(0, len(chunks), per) ]
+    results = [ None ] * len(groups)
+    errors = []
+    def run(i, fn=fn, groups=groups, results=results, errors=errors):
+        try:
+            results[i] = fn(groups[i])
+        except:
+            errors.append(sys.exc_info())
+    threads = [ threading.Thread(target=run, args=(i,))
+                for i in xrange(1, len(groups)) ]
+    for t in threads:
+        t.start()
+    # Do the first group in this thread.
+    run(0)
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    r = []
+    for res in results:
+        r.extend(res)
+    return r
@@ -55,8 +55,8 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
        server."""
     # Which MMTP versions do we understand?
     PROTOCOL_VERSIONS = ['0.3']
-    # If we've written WRITEAHEAD packets without receiving any acks, we wait
-    # for an ack before sending any more.
+    # By default, if we've written WRITEAHEAD packets without receiving any
+    # acks, we wait for an ack before sending any more.
     WRITEAHEAD = 6
     # Length of a single transmission unit (control string, packet, checksum)
     MESSAGE_LEN = 6 + (1<<15) + 20
@@ -68,15 +68,24 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     #   server we're trying to connect to.
     # certCache: an instance of PeerCertificateCache to use to check the
     #   peer server's certificate
+    # sessionCache: an instance of TLSSessionCache to use to resume TLS
+    #   sessions with the peer server, or None.
     # packets: a list of DeliverableMessage objects that have not yet been
     #   sent to the TLS connection, in the order they should be sent.
-    # pendingPackets: a list of DeliverableMessage objects that have been
-    #   sent to the TLS connection, but which have not yet been acknowledged.
+    # pendingPackets: a list of (DeliverableMessage, acceptAck, rejectAck)
+    #   tuples for the packets that have been sent to the TLS connection,
+    #   but which have not yet been acknowledged, in the order we sent them.
+    #   The server acknowledges packets in order, so each ack we receive is
+    #   for the first packet on this list.
+    # sendWindow: the largest number of packets we'll send before getting
+    #   acks for them.
+    # keepAlive: flag: should we leave the connection open once all our
+    #   packets are acknowledged, in case we get more packets to send?
+    # idleSince: if keepAlive is set, and we're connected with no packets
+    #   to send, the time when we ran out of packets.  Otherwise None.
     # nPacketsTotal: total number of packets we've ever been asked to send.
     # nPacketsSent: total number of packets sent across the TLS connection
     # nPacketsAcked: total number of acks received from the TLS connection
-    # expectedAcks: list of acceptAck,rejectAck tuples for the packets
-    #   that we've sent but haven't gotten acks for.
     # _isConnected: flag: true if the TLS connection been completed,
     #   and no errors have been encountered.
     # _isFailed: flag: has this connection encountered any errors?
@@ -87,8 +96,15 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     # External interface
     ####
     def __init__(self, targetFamily, targetAddr, targetPort, targetKeyID,
-                 serverName=None, context=None, certCache=None):
-        """Initialize a new MMTPClientConnection."""
+                 serverName=None, context=None, certCache=None,
+                 sendWindow=None, keepAlive=0, sessionCache=None):
+        """Initialize a new MMTPClientConnection.  If 'sendWindow' is
+           provided, it is the largest number of packets to send before
+           we get acks for them; it defaults to WRITEAHEAD.  If
+           'keepAlive' is true, the connection stays open when it runs out
+           of packets, until closeIdle() is called.  If 'sessionCache' is
+           provided, we try to resume our last TLS session with the same
+           server, and remember the session we negotiate."""
         assert targetFamily in (mixminion.NetUtils.AF_INET,
                                 mixminion.NetUtils.AF_INET6)
         if context is None:
@@ -112,19 +128,32 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             if e[0] not in mixminion.NetUtils.IN_PROGRESS_ERRNOS:
                 raise e
 
-        tls = context.sock(sock)
-        mixminion.TLSConnection.TLSConnection.__init__(self, tls, sock,
-                                                       serverName)
-
         if targetKeyID != '\x00' * 20:
             self.targetKeyID = targetKeyID
         else:
             self.targetKeyID = None
         self.certCache = certCache
+        if self.targetKeyID is None:
+            # We can't tell which server we'd be resuming a session with.
+            sessionCache = None
+        self.sessionCache = sessionCache
+
+        tls = context.sock(sock)
+        if sessionCache is not None:
+            session = sessionCache.get(self.targetKeyID)
+            if session is not None:
+                tls.set_session(session)
+        mixminion.TLSConnection.TLSConnection.__init__(self, tls, sock,
+                                                       serverName)
 
+        if sendWindow is None:
+            sendWindow = self.WRITEAHEAD
+        assert sendWindow >= 1
+        self.sendWindow = sendWindow
+        self.keepAlive = keepAlive
+        self.idleSince = None
         self.packets = []
         self.pendingPackets = []
-        self.expectedAcks = []
         self.nPacketsSent = self.nPacketsAcked = self.nPacketsTotal =0
         self._isConnected = 0
         self._isFailed = 0
@@ -140,6 +169,8 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         assert hasattr(deliverableMessage, 'getContents')
         self.packets.append(deliverableMessage)
         self.nPacketsTotal += 1
+        if not deliverableMessage.isJunk():
+            self.idleSince = None
         # If we're connected, maybe start sending the packet we just added.
         self._updateRWState()
 
@@ -166,7 +197,9 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
 
         m = pkt.getContents()
         if m == 'RENEGOTIATE':
-            # Renegotiate has been removed from the spec.
+            # Renegotiate has been removed from the spec.  There's nothing
+            # to send, so there's nothing that can go wrong.
+            pkt.succeeded()
             return
 
         data = "".join([control, m, sha1(m+hashExtra)])
@@ -174,43 +207,84 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         acceptedAck = serverControl + sha1(m+serverHashExtra)
         rejectedAck = "REJECTED\r\n" + sha1(m+"REJECTED")
         assert len(acceptedAck) == len(rejectedAck) == self.ACK_LEN
-        self.expectedAcks.append( (acceptedAck, rejectedAck) )
-        self.pendingPackets.append(pkt)
+        self.pendingPackets.append( (pkt, acceptedAck, rejectedAck) )
         self.beginWriting(data)
         self.nPacketsSent += 1
 
     def _updateRWState(self):
         """Helper: if we have any queued packets that haven't been sent yet,
-           and we aren't waiting for WRITEAHEAD acks, and we're connected,
-           start sending the pending packets.
+           and we have fewer than sendWindow packets waiting for acks, and
+           we're connected, start sending the queued packets.
         """
         if not self._isConnected: return
 
-        while self.nPacketsSent < self.nPacketsAcked + self.WRITEAHEAD:
+        while len(self.pendingPackets) < self.sendWindow:
             if not self.packets:
                 break
             LOG.trace("Queueing new packet for %s",self.address)
             self._startSendingNextPacket()
 
-        if self.nPacketsAcked == self.nPacketsSent:
+        if not self.pendingPackets:
+            if self.idleSince is not None:
+                # We were already idle.
+                return
             LOG.debug("Successfully relayed all packets to %s",self.address)
             self.allPacketsSent()
+            if self.keepAlive:
+                self.idleSince = time.time()
+                return
             self._isConnected = 0
             self._isAlive = 0
             self.startShutdown()
 
+    def isIdle(self):
+        """Return true iff this connection is being kept open, but has no
+           packets left to send."""
+        return (self.idleSince is not None and self._isConnected and
+                not self.pendingPackets and not self.packets)
+
+    def getIdleSince(self):
+        """If this connection is idle, return the time when it last ran out
+           of packets.  Otherwise return None."""
+        if self.isIdle():
+            return self.idleSince
+        return None
+
+    def sendKeepAlive(self):
+        """Send a junk packet on this idle connection, so that the other
+           side doesn't time it out."""
+        assert self.isIdle()
+        LOG.trace("Sending keepalive padding to %s", self.address)
+        self.addPacket(DeliverableString(isJunk=1))
+
+    def closeIdle(self):
+        """If this connection is idle, shut it down.  Return true iff we
+           shut it down."""
+        if not self.isIdle():
+            return 0
+        LOG.debug("Closing idle connection to %s", self.address)
+        self._isConnected = 0
+        self._isAlive = 0
+        self.startShutdown()
+        return 1
+
     def _failPendingPackets(self):
-        "Helper: tell all unacknowledged packets to fail."
+        """Helper: tell all unacknowledged packets to fail, in the order we
+           would have sent them."""
         self._isConnected = 0
         self._isFailed = 1
         self._isAlive = 0
-        pkts = self.pendingPackets + self.packets
+        pending = self.pendingPackets
+        unsent = self.packets
         self.pendingPackets = []
         self.packets = []
-        for p in pkts:
-            if p.isJunk():
+        for p, _, _ in pending:
+            # Only the packets we sent were counted as attempted relays.
+            if not p.isJunk():
                 EventStats.log.failedRelay()
             p.failed(1)
+        for p in unsent:
+            p.failed(1)
 
     ####
     # Implementation: hooks
@@ -222,12 +296,21 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             self.certCache.check(self.tls, self.targetKeyID, self.address)
         except MixProtocolBadAuth, e:
             LOG.warn("Certificate error: %s. Shutting down connection.", e)
+            if self.sessionCache is not None:
+                self.sessionCache.invalidate(self.targetKeyID)
             self._failPendingPackets()
             self.startShutdown()
             return
         else:
             LOG.debug("KeyID is valid from %s", self.address)
 
+        if self.sessionCache is not None:
+            if self.tls.session_reused():
+                LOG.trace("Resumed TLS session with %s", self.address)
+            else:
+                self.sessionCache.set(self.targetKeyID,
+                                      self.tls.get_session())
+
         EventStats.log.successfulConnect()
 
         # The certificate is fine; start protocol negotiation.
@@ -290,27 +373,34 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
             return
 
         while self.inbuflen >= self.ACK_LEN:
-            if not self.expectedAcks:
+            if not self.pendingPackets:
                 LOG.warn("Received acknowledgment from %s with no corresponding message", self.address)
                 self._failPendingPackets()
                 self.startShutdown()
                 return
-            ack = self.getInbuf(self.ACK_LEN, clear=1)
-            good, bad = self.expectedAcks.pop(0)
-            if ack == good:
+            # Compare the ack in place, without copying it out of the
+            # input buffer.  (A buffer only compares equal to another
+            # buffer.)
+            ack = self.peekInbuf(self.ACK_LEN)
+            pkt, good, bad = self.pendingPackets[0]
+            isGood = (ack == buffer(good))
+            isBad = not isGood and ack == buffer(bad)
+            del ack
+            self.consumeInbuf(self.ACK_LEN)
+            if isGood:
                 LOG.debug("Packet delivered to %s",self.address)
                 self.nPacketsAcked += 1
-                if not self.pendingPackets[0].isJunk():
-                    EventStats.log.successfulRelay()
-                self.pendingPackets[0].succeeded()
                 del self.pendingPackets[0]
-            elif ack == bad:
+                if not pkt.isJunk():
+                    EventStats.log.successfulRelay()
+                pkt.succeeded()
+            elif isBad:
                 LOG.warn("Packet rejected by %s", self.address)
                 self.nPacketsAcked += 1
-                if not self.pendingPackets[0].isJunk():
-                    EventStats.log.failedRelay()
-                self.pendingPackets[0].failed(1)
                 del self.pendingPackets[0]
+                if not pkt.isJunk():
+                    EventStats.log.failedRelay()
+                pkt.failed(1)
             else:
                 # The control string and digest are wrong for an accepted
                 # or rejected packet!
@@ -335,7 +425,10 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     def onClosed(self): pass
     def doneWriting(self): pass
     def receivedShutdown(self):
-        LOG.warn("Received unexpected shutdown from %s", self.address)
+        if self.isIdle():
+            LOG.debug("%s closed our idle connection", self.address)
+        else:
+            LOG.warn("Received unexpected shutdown from %s", self.address)
         self._failPendingPackets()
     def shutdownFinished(self): pass
 
@@ -472,6 +565,56 @@ def pingServer(routing, timeout=60):
        isn't up."""
     sendPackets(routing, ["JUNK"], timeout=timeout)
 
+class TLSSessionCache:
+    """A TLSSessionCache remembers the TLS sessions we've negotiated with
+       MMTP servers, so that our next connection to the same server can
+       resume a session instead of doing a full handshake.
+
+       A resumed session carries the certificate chain from its original
+       handshake, so MMTPClientConnection still checks it with a
+       PeerCertificateCache.  Use the same PeerCertificateCache for every
+       connection that shares a TLSSessionCache: it will already have
+       validated the chain, and won't need to see it again.
+
+       When a server rotates its certificate, it forgets its old sessions,
+       so our next connection does a full handshake, and we replace the
+       session we remembered."""
+    ## Fields
+    # sessions: A map from a server's KeyID to the last TLSSession we
+    #   negotiated with that server.
+    # maxSessions: The largest number of sessions to remember.
+    def __init__(self, maxSessions=256):
+        self.sessions = {}
+        self.maxSessions = maxSessions
+
+    def get(self, keyID):
+        """Return the session to resume with the server whose KeyID is
+           'keyID', or None if we don't have one."""
+        return self.sessions.get(keyID)
+
+    def set(self, keyID, session):
+        """Remember 'session' as the session to resume with the server
+           whose KeyID is 'keyID'."""
+        if session is None:
+            self.invalidate(keyID)
+            return
+        if (not self.sessions.has_key(keyID) and
+            len(self.sessions) >= self.maxSessions):
+            # Forget an arbitrary session to make room.
+            self.sessions.popitem()
+        self.sessions[keyID] = session
+
+    def invalidate(self, keyID):
+        """Forget our session with the server whose KeyID is 'keyID'."""
+        try:
+            del self.sessions[keyID]
+        except KeyError:
+            pass
+
+    def clear(self):
+        """Forget all of our sessions."""
+        self.sessions.clear()
+
 class PeerCertificateCache:
     """A PeerCertificateCache validates certificate chains from MMTP servers,
        and remembers which chains we've already seen and validated."""
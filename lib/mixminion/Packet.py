@@ -12,12 +12,13 @@ __all__ = [ 'compressData', 'CompressedDataTooLong', 'DROP_TYPE',
             'ENC_FWD_OVERHEAD', 'ENC_SUBHEADER_LEN',
             'encodeMailHeaders', 'encodeMessageHeaders',
             'FRAGMENT_PAYLOAD_OVERHEAD', 'FWD_HOST_TYPE', 'FWD_IPV4_TYPE',
-            'FragmentPayload',
+            'FragmentPayload', 'StreamDecompressor',
             'FRAGMENT_MESSAGEID_LEN', 'FRAGMENT_TYPE',
             'HEADER_LEN', 'IPV4Info', 'MAJOR_NO', 'MBOXInfo',
             'MBOX_TYPE', 'MINOR_NO', 'MIN_EXIT_TYPE',
             'MIN_SUBHEADER_LEN', 'MMTPHostInfo', 'Packet',
-            'OAEP_OVERHEAD', 'PAYLOAD_LEN', 'ParseError', 'ReplyBlock',
+            'OAEP_OVERHEAD', 'PacketBuffer', 'PAYLOAD_LEN', 'ParseError',
+            'ReplyBlock',
             'ReplyBlock', 'SECRET_LEN', 'SINGLETON_PAYLOAD_OVERHEAD',
             'SMTPInfo', 'SMTP_TYPE', 'SWAP_FWD_IPV4_TYPE',
             'SWAP_FWD_HOST_TYPE', 'SingletonPayload',
@@ -30,6 +31,7 @@ __all__ = [ 'compressData', 'CompressedDataTooLong', 'DROP_TYPE',
             'uncompressData'
             ]
 
+import array
 import binascii
 import re
 import struct
@@ -40,7 +42,7 @@ from socket import inet_ntoa, inet_aton
 from mixminion.Common import MixError, MixFatalError, encodeBase64, \
      floorDiv, formatBase64, formatTime, isSMTPMailbox, LOG, armorText, \
      unarmorText, isPlausibleHostname
-from mixminion.Crypto import sha1
+from mixminion.Crypto import sha1, sprp_crypt_inplace
 
 if sys.version_info[:3] < (2,2,0):
     import mixminion._zlibutil as zlibutil
@@ -130,6 +132,64 @@ class Packet:
         """Return the 32K string value of this packet."""
         return "".join([self.header1,self.header2,self.payload])
 
+class PacketBuffer:
+    """A mutable Mixminion packet, held in a single 32K array so that its
+       headers and payload can be decrypted in place, and so that getting
+       the packed result takes only one copy.
+
+       Unlike Packet, a PacketBuffer hands out read-only buffer objects
+       for its parts rather than new strings; callers who need to keep a
+       part around after modifying the packet should call str() on it.
+       """
+    ## Fields:
+    # buf -- an array of PACKET_LEN characters, holding header1, then
+    #    header2, then the payload.
+    def __init__(self, s):
+        """Create a new PacketBuffer from a 32K string."""
+        if len(s) != PACKET_LEN:
+            raise ParseError("Bad packet length")
+        self.buf = array.array('c', s)
+
+    def getHeader1(self):
+        """Return a read-only buffer for the first header."""
+        return buffer(self.buf, 0, HEADER_LEN)
+
+    def getHeader2(self):
+        """Return a read-only buffer for the second header."""
+        return buffer(self.buf, HEADER_LEN, HEADER_LEN)
+
+    def getPayload(self):
+        """Return a read-only buffer for the payload."""
+        return buffer(self.buf, HEADER_LEN*2)
+
+    def setHeader1(self, header):
+        """Replace the first header with the 2K string 'header'."""
+        assert len(header) == HEADER_LEN
+        self.buf[:HEADER_LEN] = array.array('c', header)
+
+    def swapHeaders(self):
+        """Exchange the first and second headers."""
+        buf = self.buf
+        header1 = buf[:HEADER_LEN]
+        buf[:HEADER_LEN] = buf[HEADER_LEN:HEADER_LEN*2]
+        buf[HEADER_LEN:HEADER_LEN*2] = header1
+
+    def decryptHeader2(self, keys):
+        """Decrypt the second header in place with LIONESS, using the
+           four 20-byte keys in 'keys'."""
+        sprp_crypt_inplace(self.buf, keys, 0,
+                           HEADER_LEN, HEADER_LEN)
+
+    def decryptPayload(self, keys):
+        """Decrypt the payload in place with LIONESS, using the four
+           20-byte keys in 'keys'."""
+        sprp_crypt_inplace(self.buf, keys, 0,
+                           HEADER_LEN*2, PAYLOAD_LEN)
+
+    def pack(self):
+        """Return the 32K string value of this packet."""
+        return self.buf.tostring()
+
 def parseHeader(s):
     """Convert a 2K string into a Header object"""
     if len(s) != HEADER_LEN:
@@ -999,6 +1059,73 @@ def uncompressData(payload, maxLength=None):
     except (IOError, ValueError), e:
         raise ParseError("Error in compressed data: %s"%e)
 
+class StreamDecompressor:
+    """Incremental version of uncompressData, for messages too large to
+       hold in memory.  Compressed data is passed to 'feed' a block at a
+       time; uncompressed data is passed to the function 'write' as it is
+       produced.  If the expanded data is longer than maxLength, 'feed'
+       raises CompressedDataTooLong; if the data is not valid compressed
+       data, 'feed' or 'close' raises ParseError.
+    """
+    ## Fields:
+    # write: function to receive uncompressed data.
+    # maxLength: the largest number of bytes we will produce, or None.
+    # zobj: a zlib decompression object.
+    # header: the first bytes of compressed data we've seen, until we have
+    #    enough to check the zlib header.  None once we've checked it.
+    # nIn, nOut: the number of bytes consumed and produced so far.
+    def __init__(self, write, maxLength=None):
+        """Create a new StreamDecompressor to send uncompressed data to
+           'write', and refuse to produce more than 'maxLength' bytes."""
+        self.write = write
+        self.maxLength = maxLength
+        self.zobj = zlib.decompressobj(zlib.MAX_WBITS)
+        self.header = ""
+        self.nIn = self.nOut = 0
+
+    def feed(self, s):
+        """Uncompress the next block of data 's'."""
+        self.nIn += len(s)
+        if self.header is not None:
+            self.header += s
+            if len(self.header) < 2:
+                return
+            if self.header[0:2] != '\x78\xDA':
+                raise ParseError("Invalid zlib header")
+            s = self.header
+            self.header = None
+        try:
+            if self.maxLength is None:
+                d = self.zobj.decompress(s)
+            else:
+                # Ask for one more byte than we allow, so that we can tell
+                # whether the data expands past the limit.
+                d = self.zobj.decompress(s, self.maxLength-self.nOut+1)
+                if self.nOut + len(d) > self.maxLength:
+                    raise CompressedDataTooLong()
+        except zlib.error:
+            raise ParseError("Error in compressed data")
+        except (IOError, ValueError), e:
+            raise ParseError("Error in compressed data: %s"%e)
+        if d:
+            self.nOut += len(d)
+            self.write(d)
+
+    def close(self):
+        """Finish uncompressing; raise ParseError if the data was
+           truncated or otherwise invalid.  Return the number of
+           uncompressed bytes produced."""
+        if self.nIn < 6 or self.header is not None:
+            raise ParseError("Invalid zlib header")
+        try:
+            # Get any leftovers, which shouldn't exist.
+            nil = self.zobj.flush()
+        except zlib.error:
+            raise ParseError("Error in compressed data")
+        if nil != '':
+            raise ParseError("Error in compressed data")
+        return self.nOut
+
 def _validateZlib():
     """Internal function:  Make sure that zlib is a recognized version, and
        that it compresses things as expected.  (This check is important,
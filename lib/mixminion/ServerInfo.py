@@ -8,8 +8,11 @@
    """
 
 __all__ = [ 'ServerInfo', 'ServerDirectory', 'displayServerByRouting',
-            'getNicknameByKeyID', 'SignedDirectory', 'parseDirectory' ]
+            'getNicknameByKeyID', 'SignedDirectory', 'parseDirectory',
+            'applyDirectoryDiff', 'getDirectoryDiffName',
+            'getDescriptorsByDigest' ]
 
+import binascii
 import re
 import time
 
@@ -307,6 +310,18 @@ class ServerInfo(mixminion.Config._ConfigFile):
            descriptor."""
         return self['Server']['Digest']
 
+    def getPublished(self):
+        """Return the time at which this descriptor was published."""
+        return self['Server']['Published']
+
+    def getValidAfter(self):
+        """Return the time at which this descriptor becomes valid."""
+        return self['Server']['Valid-After']
+
+    def getValidUntil(self):
+        """Return the time at which this descriptor stops being valid."""
+        return self['Server']['Valid-Until']
+
     def getHostname(self):
         """Return this server's Hostname."""
         return self['Incoming/MMTP'].get("Hostname")
@@ -456,31 +471,29 @@ class ServerInfo(mixminion.Config._ConfigFile):
     def getIntervalSet(self):
         """Return an IntervalSet covering all the time at which this
            ServerInfo is valid."""
-        return IntervalSet([(self['Server']['Valid-After'],
-                             self['Server']['Valid-Until'])])
+        return IntervalSet([(self.getValidAfter(), self.getValidUntil())])
 
     def isExpiredAt(self, when):
         """Return true iff this ServerInfo expires before time 'when'."""
-        return self['Server']['Valid-Until'] < when
+        return self.getValidUntil() < when
 
     def isValidAt(self, when):
         """Return true iff this ServerInfo is valid at time 'when'."""
-        return (self['Server']['Valid-After'] <= when <=
-                self['Server']['Valid-Until'])
+        return self.getValidAfter() <= when <= self.getValidUntil()
 
     def isValidFrom(self, startAt, endAt):
         """Return true iff this ServerInfo is valid at all time from 'startAt'
            to 'endAt'."""
         assert startAt <= endAt
-        return (self['Server']['Valid-After'] <= startAt and
-                endAt <= self['Server']['Valid-Until'])
+        return (self.getValidAfter() <= startAt and
+                endAt <= self.getValidUntil())
 
     def isValidAtPartOf(self, startAt, endAt):
         """Return true iff this ServerInfo is valid at some time between
            'startAt' and 'endAt'."""
         assert startAt <= endAt
-        va = self['Server']['Valid-After']
-        vu = self['Server']['Valid-Until']
+        va = self.getValidAfter()
+        vu = self.getValidUntil()
         return ((startAt <= va and va <= endAt) or
                 (startAt <= vu and vu <= endAt) or
                 (va <= startAt and endAt <= vu))
@@ -489,8 +502,8 @@ class ServerInfo(mixminion.Config._ConfigFile):
         """Return true iff this ServerInfo was published after 'other',
            where 'other' is either a time or a ServerInfo."""
         if isinstance(other, ServerInfo):
-            other = other['Server']['Published']
-        return self['Server']['Published'] > other
+            other = other.getPublished()
+        return self.getPublished() > other
 
     def isSupersededBy(self, others):
         """Return true iff this ServerInfo is superseded by the other
@@ -539,7 +552,8 @@ class ServerDirectory:
     #    servers in this directory.
     # header: a _DirectoryHeader object for the non-serverinfo part of this
     #    directory.
-    def __init__(self, string=None, fname=None, validatedDigests=None):
+    def __init__(self, string=None, fname=None, validatedDigests=None,
+                 knownServers=None):
         """Create a new ServerDirectory object, either from a literal <string>
            (if specified) or a filename [possibly gzipped].
 
@@ -547,6 +561,11 @@ class ServerDirectory:
            are the digests of already-validated descriptors.  Any descriptor
            whose (calculated) digest matches doesn't need to be validated
            again.
+
+           If knownServers is provided, it must be a dict mapping digests
+           to already-validated ServerInfo objects.  Any descriptor whose
+           (calculated) digest matches isn't parsed again; we use the
+           existing object instead.
         """
         if string:
             contents = string
@@ -570,9 +589,8 @@ class ServerDirectory:
         self.header = _DirectoryHeader(headercontents, digest)
         self.goodServerNames = [name.lower() for name in
                    self.header['Directory']['Recommended-Servers'] ]
-        servers = [ ServerInfo(string=s,
-                               validatedDigests=validatedDigests)
-                    for s in servercontents ]
+        servers = _parseServerInfos(servercontents, validatedDigests,
+                                    knownServers)
         self.allServers = servers[:]
         goodServers = [ s for s in servers
                         if s.getNickname().lower() in self.goodServerNames ]
@@ -606,9 +624,11 @@ class SignedDirectory:
     # signers
     # goodServerNames
     def __init__(self, string=None, fname=None, validatedDigests=None,
-                 _keepServerContents=0):
+                 _keepServerContents=0, knownServers=None):
         """DOCDOC
            raises ConfigError.
+
+           validatedDigests and knownServers are as for ServerDirectory.
         """
         if string:
             contents = string
@@ -639,11 +659,11 @@ class SignedDirectory:
         # Parse the DirectoryInfo
         self.dirInfo = _DirectoryInfo(info)
         # Parse the Server descriptors.
-        self.servers = [ ]
-        for s in servers:
-            si = ServerInfo(string=s, validatedDigests=validatedDigests,
-                            _keepContents=_keepServerContents)
-            self.servers.append(si)
+        if _keepServerContents:
+            # Objects we've parsed before may not have kept their contents.
+            knownServers = None
+        self.servers = _parseServerInfos(servers, validatedDigests,
+                                         knownServers, _keepServerContents)
         self.goodServerNames = [ name.lower()
              for name in self.dirInfo['Directory-Info']['Recommended-Servers'] ]
 
@@ -695,7 +715,25 @@ class SignedDirectory:
     def get(self, item, default=None):
         return self.header.get(item, default)
 
-def parseDirectory(fname, validatedDigests=None):
+def _parseServerInfos(contents, validatedDigests=None, knownServers=None,
+                      _keepContents=0):
+    """Helper: given a list of server descriptors as strings, return a
+       list of ServerInfo objects.  If knownServers is provided, reuse any
+       ServerInfo from it whose digest matches a descriptor's, rather than
+       parsing and checking that descriptor again.  (Computing a digest is
+       far cheaper than parsing a descriptor and its keys.)"""
+    result = []
+    for s in contents:
+        if knownServers:
+            si = knownServers.get(getServerInfoDigest(s))
+            if si is not None:
+                result.append(si)
+                continue
+        result.append(ServerInfo(string=s, validatedDigests=validatedDigests,
+                                 _keepContents=_keepContents))
+    return result
+
+def parseDirectory(fname, validatedDigests=None, knownServers=None):
     """DOCDOC"""
     try:
         s = readPossiblyGzippedFile(fname)
@@ -706,7 +744,8 @@ def parseDirectory(fname, validatedDigests=None):
         tp = ServerDirectory
     else:
         tp = SignedDirectory
-    return tp(fname=fname, string=s, validatedDigests=validatedDigests)
+    return tp(fname=fname, string=s, validatedDigests=validatedDigests,
+              knownServers=knownServers)
 
 class _DirectoryHeader(mixminion.Config._ConfigFile):
     """Internal object: used to parse, validate, and store fields in a
@@ -961,6 +1000,150 @@ def _getDirectoryDigestImpl(directory, rsa=None):
     return _getDigestImpl(directory, _dir_special_line_re,
                           "DirectoryDigest", "DirectorySignature", rsa)
 
+#----------------------------------------------------------------------
+# Directory diffs.
+#
+# A directory diff lets a client that holds one directory build the next
+# one without downloading the descriptors it already has.  It is a text
+# file starting with a "Mixminion-Directory-Diff" line and the digests of
+# the (cleaned) base and resulting directories, followed by entries of two
+# kinds:
+#     "Text: <n>" and a newline, followed by n bytes of literal text; and
+#     "Keep: <descriptor digest>", to copy a descriptor from the base.
+# The resulting directory is the concatenation of all the entries.
+#
+# The directory server publishes diffs from several recent directories,
+# each under a name that includes the digest of its base (see
+# getDirectoryDiffName).  A client asks only for the diff from the
+# directory it has; if there is none, it downloads the whole directory.
+
+DIRECTORY_DIFF_VERSION = "0.1"
+
+def getDirectoryDiffBase(contents):
+    """Given the contents of a directory, return the digest that
+       identifies it as the base of a directory diff."""
+    return sha1(_cleanForDigest(contents))
+
+def getDirectoryDiffName(name, baseDigest):
+    """Given the filename or URL where a directory is published, and the
+       digest of an older directory (as returned by getDirectoryDiffBase),
+       return the filename or URL where we publish the diff from the older
+       directory to the current one."""
+    tag = "-diff-%s" % binascii.b2a_hex(baseDigest)
+    if name.endswith(".gz"):
+        return name[:-3]+tag+".gz"
+    else:
+        return name+tag
+
+def _splitDirectoryForDiff(contents):
+    """Helper: given the cleaned contents of a directory, return a tuple
+       of the text before the first server descriptor, and a list of the
+       server descriptors' texts.  The concatenation of the two is
+       'contents'."""
+    idx = contents.find("\n[Server]\n")
+    if idx < 0:
+        return contents, []
+    header = contents[:idx+1]
+    contents = contents[idx+1:]
+    servers = []
+    while 1:
+        eos = contents.find("\n[Server]\n")
+        if eos < 0:
+            servers.append(contents)
+            break
+        servers.append(contents[:eos+1])
+        contents = contents[eos+1:]
+    return header, servers
+
+def getDescriptorsByDigest(contents):
+    """Given the contents of a directory, return a map from the digest of
+       each server descriptor in the directory to the text of that
+       descriptor."""
+    _, servers = _splitDirectoryForDiff(_cleanForDigest(contents))
+    byDigest = {}
+    for s in servers:
+        byDigest[getServerInfoDigest(s)] = s
+    return byDigest
+
+def applyDirectoryDiff(base, diff):
+    """Given the contents of a directory 'base' and of a directory diff
+       'diff', return the (cleaned) contents of the directory that the
+       diff describes.  Raise ConfigError if the diff is malformed, or if
+       it doesn't apply to 'base'.
+
+       The result still needs to be parsed and checked like any other
+       directory we download.
+    """
+    base = _cleanForDigest(base)
+    byDigest = getDescriptorsByDigest(base)
+
+    pos = 0
+    fields = {}
+    for name in "Mixminion-Directory-Diff", "Base-Digest", "Result-Digest":
+        eol = diff.find("\n", pos)
+        if eol < 0:
+            raise ConfigError("Truncated directory diff")
+        k, v = _parseDiffLine(diff[pos:eol])
+        if k != name:
+            raise ConfigError("Expected %s in directory diff"%name)
+        fields[k] = v
+        pos = eol+1
+    if fields["Mixminion-Directory-Diff"] != DIRECTORY_DIFF_VERSION:
+        raise ConfigError("Unrecognized directory diff version %s"%
+                          fields["Mixminion-Directory-Diff"])
+    baseDigest = getDirectoryDiffBase(base)
+    if _decodeDiffDigest(fields["Result-Digest"]) == baseDigest:
+        # We already have the new directory.
+        return base
+    if _decodeDiffDigest(fields["Base-Digest"]) != baseDigest:
+        raise ConfigError("Directory diff is not for our directory")
+
+    result = []
+    while pos < len(diff):
+        eol = diff.find("\n", pos)
+        if eol < 0:
+            raise ConfigError("Truncated directory diff")
+        k, v = _parseDiffLine(diff[pos:eol])
+        pos = eol+1
+        if k == "Text":
+            try:
+                n = int(v)
+            except ValueError:
+                raise ConfigError("Bad length in directory diff")
+            if n < 0 or pos+n > len(diff):
+                raise ConfigError("Truncated directory diff")
+            result.append(diff[pos:pos+n])
+            pos += n
+        elif k == "Keep":
+            try:
+                result.append(byDigest[_decodeDiffDigest(v)])
+            except KeyError:
+                raise ConfigError("Directory diff refers to unknown server")
+        else:
+            raise ConfigError("Unrecognized entry %r in directory diff"%k)
+
+    result = "".join(result)
+    if sha1(result) != _decodeDiffDigest(fields["Result-Digest"]):
+        raise ConfigError("Directory diff did not produce expected result")
+    return result
+
+def _parseDiffLine(line):
+    """Helper: split a 'Key: Value' line from a directory diff."""
+    idx = line.find(":")
+    if idx < 0:
+        raise ConfigError("Malformed line in directory diff")
+    return line[:idx], line[idx+1:].strip()
+
+def _decodeDiffDigest(s):
+    """Helper: decode a base-64 digest from a directory diff."""
+    try:
+        d = binascii.a2b_base64(s)
+    except binascii.Error:
+        raise ConfigError("Malformed digest in directory diff")
+    if len(d) != DIGEST_LEN:
+        raise ConfigError("Malformed digest in directory diff")
+    return d
+
 def _getMultisignedDirectoryDigest(directory):
     try:
         if directory.startswith("[Directory-Info]"):
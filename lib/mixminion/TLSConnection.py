@@ -5,6 +5,7 @@
 """
 
 #XXXX implement renegotiate
+import array
 import sys
 import time
 
@@ -13,6 +14,9 @@ from mixminion.Common import LOG, stringContains
 
 # Number of bytes to try reading at once.
 _READLEN = 1024
+# Number of bytes to allocate for a new connection's input buffer.  The
+# buffer grows as needed.
+_INBUF_INITIAL_LEN = 4096
 
 class _Closing(Exception):
     """Helper class: exception raised by state functions that want the
@@ -43,8 +47,11 @@ class TLSConnection:
     #   currently waiting for socket.connect.)
     # lastActivity -- When did this connection last get any activity?
     #
-    # inbuf -- a list of strings received from self.tls
-    # inbuflen -- the total length of the strings in self.inbuf
+    # inbuf -- an array holding the bytes received from self.tls.  The
+    #   received bytes that we haven't consumed yet are in
+    #   inbuf[inbufStart:inbufStart+inbuflen]; the rest is free space.
+    # inbufStart -- the index of the first unconsumed byte in self.inbuf.
+    # inbuflen -- the number of unconsumed bytes in self.inbuf.
     # outbuf -- a list of strings to write to self.tls
     # outbuflen -- the total length of the strings in self.outbuf
     #
@@ -77,7 +84,8 @@ class TLSConnection:
 
         self.__blockedWriteLen = 0
 
-        self.inbuf = []
+        self.inbuf = array.array('c', "\000"*_INBUF_INITIAL_LEN)
+        self.inbufStart = 0
         self.inbuflen = 0
         self.outbuf = []
         self.outbuflen = 0
@@ -169,46 +177,41 @@ class TLSConnection:
             return 1
         return 0
 
+    def getLastActivity(self):
+        """Return the last time this connection saw any activity."""
+        return self.lastActivity
+
     def getInbuf(self, maxBytes=None, clear=0):
         """Return up to 'maxBytes' bytes from the front of the input buffer.
            If 'maxBytes' is not provided, return a string containing the
            entire input buffer.  If 'clear' is true, remove the bytes from
            the input buffer.
            """
-        if maxBytes is None or maxBytes >= self.inbuflen:
-            # We're returning the entire input buffer.
-            if len(self.inbuf) > 1:
-                self.inbuf = [ "".join(self.inbuf) ]
-            elif len(self.inbuf) == 0:
-                return ""
-            r = self.inbuf[0]
-            if clear:
-                del self.inbuf[:]
-                self.inbuflen = 0
-            return r
+        if maxBytes is None or maxBytes > self.inbuflen:
+            maxBytes = self.inbuflen
+        r = str(self.peekInbuf(maxBytes))
+        if clear:
+            self.consumeInbuf(maxBytes)
+        return r
+
+    def peekInbuf(self, nBytes):
+        """Return a read-only buffer object for the first 'nBytes' bytes of
+           the input buffer, which must hold at least that many.  The
+           buffer object is only valid until the next time we read from
+           the network; slice it or call str() on it to keep its
+           contents."""
+        assert nBytes <= self.inbuflen
+        return buffer(self.inbuf, self.inbufStart, nBytes)
+
+    def consumeInbuf(self, nBytes):
+        """Remove the first 'nBytes' bytes from the input buffer, which must
+           hold at least that many."""
+        assert nBytes <= self.inbuflen
+        self.inbuflen -= nBytes
+        if self.inbuflen:
+            self.inbufStart += nBytes
         else:
-            # maxBytes < self.inbuflen; There are more bytes than we
-            # asked for.
-            n = 0
-            ln = 0
-            while 1:
-                # Expand until self.inbuf[:n] is ln bytes long, and
-                # ln is long enough to return maxBytes bytes.
-                ln += len(self.inbuf[n])
-                n += 1
-                if ln >= maxBytes:
-                    self.inbuf[:n] = [ "".join(self.inbuf[:n]) ]
-                    assert len(self.inbuf[0]) == ln
-                    r = self.inbuf[0][:maxBytes]
-                    if clear:
-                        if ln > maxBytes:
-                            self.inbuf[0] = self.inbuf[0][maxBytes:]
-                        else:
-                            del self.inbuf[0]
-                        self.inbuflen -= maxBytes
-                    return r
-
-            raise AssertionError # unreached; appease pychecker
+            self.inbufStart = 0
 
     def getInbufLine(self, maxBytes=None, terminator="\r\n", clear=0,
                      allowExtra=0):
@@ -236,8 +239,7 @@ class TLSConnection:
 
     def clearInbuf(self):
         """Remove all pending data from the input buffer."""
-        del self.inbuf[:]
-        self.inbuflen = 0
+        self.inbufStart = self.inbuflen = 0
 
     def isShutdown(self):
         """Return true iff this TLSConnection has been completely shut down,
@@ -387,6 +389,24 @@ class TLSConnection:
             self.doneWriting()
         return cap
 
+    def __makeInbufSpace(self, n):
+        """Helper: make sure that there are at least 'n' bytes of free space
+           at the end of self.inbuf, by moving the unconsumed bytes to the
+           front, or by growing the array if we must."""
+        start, length, buf = self.inbufStart, self.inbuflen, self.inbuf
+        if start + length + n <= len(buf):
+            return
+        if length + n <= len(buf):
+            buf[:length] = buf[start:start+length]
+        else:
+            size = len(buf)*2
+            while size < length + n:
+                size *= 2
+            newbuf = array.array('c', buffer(buf, start, length))
+            newbuf.fromstring("\000"*(size-length))
+            self.inbuf = newbuf
+        self.inbufStart = 0
+
     def __doRead(self, cap):
         "Helper function: read as much data as we can."
         self.__readBlockedOnWrite = 0
@@ -395,20 +415,25 @@ class TLSConnection:
         #     [2] we get a shutdown.)
         while self.__reading and cap > 0:
             try:
-                s = self.tls.read(min(_READLEN,cap))
-                if s == 0:
+                # Read straight into the free space at the end of the inbuf.
+                n = min(_READLEN,cap)
+                self.__makeInbufSpace(n)
+                r = self.tls.readinto(self.inbuf,
+                                      self.inbufStart+self.inbuflen, n)
+                if r == 0:
                     # The other side sent us a shutdown; we'll shutdown too.
                     self.receivedShutdown()
                     LOG.trace("read returned 0: shutting down connection to %s"
                               , self.address)
                     self.startShutdown()
                     break
+                elif r is None:
+                    break
                 else:
-                    # We got some data; add it to the inbuf.
-                    LOG.trace("Read got %s bytes from %s",len(s), self.address)
-                    self.inbuf.append(s)
-                    self.inbuflen += len(s)
-                    cap -= len(s)
+                    # We got some data; it's already in the inbuf.
+                    LOG.trace("Read got %s bytes from %s",r, self.address)
+                    self.inbuflen += r
+                    cap -= r
                     if (not self.tls.pending()) and cap > 0:
                         # Only call onRead when we've got all the pending
                         # data from self.tls, or we've just run out of
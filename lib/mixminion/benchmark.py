@@ -16,16 +16,18 @@ import gc
 import os
 import stat
 import cPickle
+import operator
 import threading
 from time import time
 
 import mixminion._minionlib as _ml
+import mixminion.server.HashLog
 import mixminion.server.ServerQueue
 
 from mixminion.BuildMessage import _buildHeader, buildForwardPacket, \
      compressData, uncompressData, encodeMessage, decodePayload
 from mixminion.Common import secureDelete, installSIGCHLDHandler, \
-     waitForChildren, formatBase64, Lockfile
+     waitForChildren, formatBase64, Lockfile, getSecureDeleteStats, writeFile
 from mixminion.Crypto import *
 from mixminion.Crypto import OAEP_PARAMETER
 from mixminion.Crypto import _add_oaep_padding, _check_oaep_padding
@@ -310,12 +312,12 @@ def rsaTiming():
 
 def hashlogTiming():
     print "#==================== HASH LOGS ======================="
-    for load in (100, 1000, 10000, 100000):
+    for load in (100, 1000, 10000, 100000, 1000000, 10000000):
         fname = mix_mktemp(".db")
         try:
             _hashlogTiming(fname,load)
         finally:
-            for suffix in ("", ".dat", ".bak", ".dir"):
+            for suffix in (".tbl", ".log"):
                 try:
                     os.unlink(fname+suffix)
                 except OSError:
@@ -329,22 +331,34 @@ def _hashlogTiming(fname, load):
     print "Testing hash log (%s entries)"%load
     if load > 20000:
         print "This may take a few minutes..."
-    h = HashLog(fname, "A")
-    hashes = [ prng.getBytes(20) for _ in xrange(load) ]
+    # (At one packet per second, a key that lives for 'load' seconds sees
+    # 'load' packets.)
+    h = HashLog(fname, "A", load/mixminion.server.HashLog.EXPECTED_PACKET_RATE)
 
     # XXXX Check under different circumstances -- different sync patterns.
-    t = time()
-    for n in xrange(len(hashes)):
-        h.logHash(hashes[n])
+    # (We generate and add hashes in batches, so that we don't need to
+    # hold millions of them in memory at once.)
+    t = 0
+    firstHashes = None
+    for start in xrange(0, load, 10000):
+        hashes = [ prng.getBytes(20) for _ in xrange(min(10000,load-start)) ]
+        if firstHashes is None:
+            firstHashes = hashes[:1000]
+        t0 = time()
+        for hash_ in hashes:
+            h.logHash(hash_)
+        t += time()-t0
+    t0 = time()
     h.sync()
-    t = time()-t
+    t += time()-t0
     print "Add entry (up to %s entries)" %load, timestr(t/float(load))
 
     t = time()
-    for hash_ in hashes[0:1000]:
+    for hash_ in firstHashes:
         h.seenHash(hash_)
     t = time()-t
     print "Check entry [hit] (%s entries)" %load, timestr(t/1000.0)
+    print "Lookups per second [hit] (%s entries): %d" %(load, 1000/t)
 
     hashes =[ prng.getBytes(20) for _ in xrange(1000) ]
     t = time()
@@ -352,6 +366,7 @@ def _hashlogTiming(fname, load):
         h.seenHash(hash_)
     t = time()-t
     print "Check entry [miss] (%s entries)" %load, timestr(t/1000.0)
+    print "Lookups per second [miss] (%s entries): %d" %(load, 1000/t)
 
     hashes =[ prng.getBytes(20) for _ in xrange(1000) ]
     t = time()
@@ -363,7 +378,7 @@ def _hashlogTiming(fname, load):
 
     h.close()
     size = 0
-    for suffix in ("", ".dat", ".bak", ".dir"):
+    for suffix in (".tbl", ".log"):
         if not os.path.exists(fname+suffix):
             continue
         size += os.stat(fname+suffix)[stat.ST_SIZE]
@@ -729,6 +744,16 @@ def fileOpsTiming():
     t = time()-t1
     print "          (sync)", timestr(t/100)
 
+    for i in xrange(64):
+        writeFile(os.path.join(dname, "big%s"%i), s32K*32, binary=1)
+    lst = [ os.path.join(dname,"big%s"%i) for i in range(64) ]
+    stats = getSecureDeleteStats()
+    secureDelete(lst, blocking=1)
+    files, nBytes, secs = map(operator.sub, getSecureDeleteStats(), stats)
+    if secs and files:
+        print "secureDelete (64x1MB, internal): %.1f MB/s" % (
+            nBytes/(secs*(1<<20)))
+
 #----------------------------------------------------------------------
 def fecTiming():
     print "#================= FEC =========================="
@@ -753,6 +778,26 @@ def fecTiming():
         tm = timeit_(lambda f=fec, m=missing_max: f.decode(m), it)
         print "            Decode (k-n missing):", timestr(tm)
         print "          (time/(k*28KB*(n-k))) =", timestr(tm/(k*28*(n-k))), "/ KB"
+
+    # Throughput, for the parameters that Fragments actually uses, with
+    # each implementation of the inner loop that this CPU supports.
+    default = _ml.FEC_getImplementation()
+    for impl in ("avx2", "ssse3", "scalar"):
+        try:
+            _ml.FEC_setImplementation(impl)
+        except _ml.FECError:
+            continue
+        for k,n,it in [(2,3,300), (4,6,150), (8,11,75), (16,22,40)]:
+            msg = [ r.getBytes(28*1024) for i in xrange(k) ]
+            fec = _ml.FEC_generate(k,n)
+            chunk = [ msg ]
+            tm = timeit_(lambda f=fec, c=chunk: f.encodeChunks(c), it)
+            mb = k*28*1024/float(1<<20)
+            print "FEC %s (%s/%s): encode %.1f MB/s;"%(impl,k,n,mb/tm),
+            frags = [ (i, fec.encode(i,msg)) for i in xrange(n-k,n) ]
+            tm = timeit_(lambda f=fec, m=frags: f.decode(m), it)
+            print "decode (%s missing) %.1f MB/s"%(n-k, mb/tm)
+    _ml.FEC_setImplementation(default)
 #----------------------------------------------------------------------
 def testLeaks1():
     print "Trying to leak (sha1,aes,xor,seed,oaep)"
@@ -196,6 +196,44 @@ def generateConsensusDirectory(identity, voters, validAfter, directories,
 
     return val
 
+def generateDirectoryDiff(oldDirectory, newDirectory):
+    """Return a directory diff (as described in mixminion.ServerInfo) that
+       lets a client holding the directory 'oldDirectory' construct the
+       directory 'newDirectory'.  Both arguments are strings.  Descriptors
+       that appear unchanged in both directories are referred to by digest;
+       everything else is included literally.
+    """
+    SI = mixminion.ServerInfo
+    old = SI._cleanForDigest(oldDirectory)
+    new = SI._cleanForDigest(newDirectory)
+
+    _, oldServers = SI._splitDirectoryForDiff(old)
+    oldByDigest = {}
+    for s in oldServers:
+        oldByDigest[SI.getServerInfoDigest(s)] = s
+
+    header, servers = SI._splitDirectoryForDiff(new)
+    out = [ "Mixminion-Directory-Diff: %s\n"%SI.DIRECTORY_DIFF_VERSION,
+            "Base-Digest: %s\n"%formatBase64(sha1(old)),
+            "Result-Digest: %s\n"%formatBase64(sha1(new)) ]
+    text = [ header ]
+    for s in servers:
+        d = SI.getServerInfoDigest(s)
+        # Only refer to descriptors whose text is exactly the same, so that
+        # the client reconstructs exactly the directory we signed.
+        if oldByDigest.get(d) == s:
+            if text:
+                t = "".join(text)
+                out.append("Text: %s\n%s"%(len(t), t))
+                text = []
+            out.append("Keep: %s\n"%formatBase64(d))
+        else:
+            text.append(s)
+    if text:
+        t = "".join(text)
+        out.append("Text: %s\n%s"%(len(t), t))
+    return "".join(out)
+
 MAX_WINDOW = 30*24*60*60
 
 class BadVote(Exception):
@@ -7,18 +7,28 @@
 
 __all__ = [ ]
 
+import binascii
 import gzip
 import os
-import shutil
 import sys
 import time
-from mixminion.Common import createPrivateDir, formatTime, iterFileLines, LOG, \
-     UIError
+import zlib
+
+import mixminion.ServerInfo
+import mixminion.directory.DirFormats
+
+from mixminion.Common import createPrivateDir, formatFnameTime, formatTime, \
+     iterFileLines, LOG, UIError, readFile, readPossiblyGzippedFile, \
+     tryUnlink, writeFile
 from mixminion.Config import ConfigError
 from mixminion.Crypto import init_crypto, pk_fingerprint, pk_generate, \
      pk_PEM_load, pk_PEM_save
 from mixminion.directory.Directory import Directory, DirectoryConfig
 
+# How many of the directories we published most recently do we publish
+# diffs from?
+DIFF_HISTORY = 8
+
 USAGE = """\
 Usage: mixminion dir <command>
    Where 'command' is one of:
@@ -168,17 +178,67 @@ def cmd_generate(args):
     print "Directory generated; publishing."
 
     fname = serverList.getDirectoryFilename()
+    contents = readFile(fname)
+
+    # We keep copies of the last DIFF_HISTORY directories we published, so
+    # that we can publish a diff from each of them to the new one.
+    historyDir = os.path.join(d.directoryBase, "published")
+    createPrivateDir(historyDir)
+    history = _readPublishedHistory(historyDir)
+    if not history and os.path.exists(location):
+        # We haven't kept any history yet; start with whatever's published.
+        try:
+            history = [ (None, readPossiblyGzippedFile(location)) ]
+        except (IOError, zlib.error), e:
+            print "Couldn't read old directory (%s); not making a diff."%e
+
+    _publish(contents, location)
+
+    for _, oldContents in history:
+        diff = mixminion.directory.DirFormats.generateDirectoryDiff(
+            oldContents, contents)
+        base = mixminion.ServerInfo.getDirectoryDiffBase(oldContents)
+        _publish(diff, mixminion.ServerInfo.getDirectoryDiffName(location,
+                                                                 base))
+        print "Published diff from %s (%s bytes)."%(
+            binascii.b2a_hex(base)[:8], len(diff))
+
+    # Remember the new directory, and forget the ones too old to keep.
+    writeFile(os.path.join(historyDir, "dir-"+formatFnameTime(now)),
+              contents)
+    history = _readPublishedHistory(historyDir)
+    keep = {}
+    for _, c in history[-DIFF_HISTORY:]:
+        keep[mixminion.ServerInfo.getDirectoryDiffBase(c)] = 1
+    for fn, c in history[:-DIFF_HISTORY]:
+        base = mixminion.ServerInfo.getDirectoryDiffBase(c)
+        if not keep.has_key(base):
+            tryUnlink(mixminion.ServerInfo.getDirectoryDiffName(location,
+                                                                base))
+        tryUnlink(fn)
 
+    print "Published."
+
+def _readPublishedHistory(historyDir):
+    """Helper: return a list of (filename, contents) for the directories we
+       have kept in 'historyDir', oldest first."""
+    names = [ fn for fn in os.listdir(historyDir) if fn.startswith("dir-") ]
+    names.sort()
+    return [ (os.path.join(historyDir, fn),
+              readFile(os.path.join(historyDir, fn)))
+             for fn in names ]
+
+def _publish(contents, location):
+    """Helper: write 'contents' to 'location', compressing it if the
+       filename ends with .gz."""
     if location.endswith(".gz"):
-        fIn = open(fname)
         fOut = gzip.GzipFile(location, 'wb')
-        fOut.write(fIn.read())
-        fIn.close()
+        fOut.write(contents)
         fOut.close()
     else:
-        shutil.copy(fname, location)
-
-    print "Published."
+        f = open(location, 'wb')
+        f.write(contents)
+        f.close()
 
 def cmd_fingerprint(args):
     """[Entry point] Print the fingerprint for this directory's key."""
@@ -5,29 +5,48 @@
    Persistent memory for the hashed secrets we've seen.  Used by
    PacketHandler to prevent replay attacks."""
 
+import array
+import binascii
+import mmap
 import os
+import stat
+import struct
 import threading
 import mixminion.Filestore
-from mixminion.Common import MixFatalError, LOG, secureDelete
+from mixminion.Common import MixFatalError, LOG, createPrivateDir, readFile, \
+     replaceFile, secureDelete
 from mixminion.Packet import DIGEST_LEN
 
-__all__ = [ 'HashLog', 'getHashLog', 'deleteHashLog' ]
-
-# FFFF Mechanism to force a different default db module.
+__all__ = [ 'BloomFilter', 'HashLog', 'getHashLog', 'deleteHashLog' ]
 
 # FFFF Two-copy journaling to protect against catastrophic failure that
 # FFFF underlying DB code can't handle.
 
+# How many packets per second do we guess that a key will see over its
+# lifetime?  We use this to size the Bloom filter in front of each HashLog.
+# Guessing low is safe: the filter just gives more false positives.
+EXPECTED_PACKET_RATE = 1.0
+# How many entries should we size a HashLog's Bloom filter for when we
+# don't know the key's lifetime?
+DEFAULT_BLOOM_ENTRIES = 1<<20
+
 # Lock to protect _OPEN_HASHLOGS
 _HASHLOG_DICT_LOCK = threading.RLock()
 # Map from (filename) to (keyid,open HashLog). Needed to implement getHashLog.
 _OPEN_HASHLOGS = {}
 
-def getHashLog(filename, keyid):
+def getHashLog(filename, keyid, lifetime=None):
     """Given a filename and keyid, return a HashLog object with that fname
        and ID, opening a new one if necessary.  This function is needed to
        implement key rotation: we want to assemble a list of current
-       hashlogs, but we can't open the same HashLog database twice at once."""
+       hashlogs, but we can't open the same HashLog database twice at once.
+
+       If 'lifetime' is provided, it is the number of seconds for which
+       the corresponding key is valid; we use it to size the log's Bloom
+       filter.
+
+       If we find a hashlog in the old anydbm-based format, we convert it
+       to the current format."""
     try:
         _HASHLOG_DICT_LOCK.acquire()
         try:
@@ -37,7 +56,10 @@ def getHashLog(filename, keyid):
             LOG.trace("getHashLog() returning open hashlog at %s",filename)
         except KeyError:
             LOG.trace("getHashLog() opening hashlog at %s",filename)
-            hl = HashLog(filename, keyid)
+            if _getOldHashLogFiles(filename):
+                hl = _migrateOldHashLog(filename, keyid, lifetime)
+            else:
+                hl = HashLog(filename, keyid, lifetime)
             _OPEN_HASHLOGS[filename] = (keyid, hl)
         return hl
     finally:
@@ -54,10 +76,12 @@ def deleteHashLog(filename):
         except KeyError:
             LOG.trace("deleteHashLog() removing closed hashlog at %s",filename)
             pass
-        remove = []
+        # Remove the files for the current format, and for the old
+        # anydbm-based format in case we never converted it.
+        remove = _getOldHashLogFiles(filename)
         parent,name = os.path.split(filename)
         prefix1 = name+"."
-        prefix2 = name+"."
+        prefix2 = name+"_"
         if os.path.exists(parent):
             for fn in os.listdir(parent):
                 if fn.startswith(prefix1) or fn.startswith(prefix2):
@@ -67,7 +91,97 @@ def deleteHashLog(filename):
     finally:
         _HASHLOG_DICT_LOCK.release()
 
-class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
+def _getOldHashLogFiles(filename):
+    """Helper: return a list of the existing files that make up the
+       hashlog at 'filename' in the old anydbm-based format."""
+    # The anydbm modules each add different suffixes, if any.
+    names = [ filename+suffix for suffix in
+              ("", ".db", ".dat", ".dir", ".pag", ".bak", "_jrnl") ]
+    return [ fn for fn in names if os.path.exists(fn) ]
+
+def _migrateOldHashLog(filename, keyid, lifetime):
+    """Helper: convert the old anydbm-based hashlog at 'filename' to the
+       current format, remove the old files, and return a new HashLog.
+       (If we were interrupted while converting the log before, we just
+       start over.)"""
+    LOG.info("Converting hash log at %s to new format", filename)
+    old = mixminion.Filestore.BooleanJournaledDBBase(filename,
+                                                     "digest hash", 20)
+    try:
+        if old.log.has_key("KEYID") and old.log["KEYID"] != keyid:
+            raise MixFatalError("Log KEYID does not match current KEYID")
+        hl = HashLog(filename, keyid, lifetime)
+        # Keys are hex-encoded in the old format.
+        for k in old.log.keys():
+            if len(k) == DIGEST_LEN*2:
+                hl.logHash(binascii.a2b_hex(k))
+        hl.sync()
+    finally:
+        old.close()
+    secureDelete(_getOldHashLogFiles(filename), blocking=1)
+    return hl
+
+class BloomFilter:
+    """A BloomFilter is an in-memory set of 20-byte digests that answers
+       'definitely not present' or 'possibly present'.  It never gives a
+       false negative.
+
+       Because the digests we store are already the output of a hash
+       function, we don't hash them again: we use each of their five
+       32-bit words as a bit index."""
+    # Number of bits to allocate for each entry we expect to hold.  With
+    # 5 bit indices per entry, this gives a false positive rate of about
+    # 0.15% when the filter is full.
+    BITS_PER_ENTRY = 16
+    # Largest number of bits we'll allocate.
+    MAX_BITS = 1<<30
+    ## Fields:
+    # bits -- an array of bytes holding the filter's bits.
+    # mask -- one less than the number of bits in the filter.  The number
+    #    of bits is always a power of two.
+    def __init__(self, nEntries):
+        """Create a new empty BloomFilter with room for about 'nEntries'
+           entries."""
+        nBits = 1<<13
+        while nBits < nEntries*self.BITS_PER_ENTRY and nBits < self.MAX_BITS:
+            nBits <<= 1
+        self.mask = nBits - 1
+        self.bits = array.array('B', [0]) * (nBits >> 3)
+
+    def add(self, digest):
+        """Insert the 20-byte string 'digest' into this filter."""
+        bits = self.bits
+        mask = self.mask
+        for idx in struct.unpack("!5L", digest):
+            idx = idx & mask
+            bits[idx >> 3] |= 1 << (idx & 7)
+
+    def mightContain(self, digest):
+        """Return false if the 20-byte string 'digest' has never been
+           inserted into this filter; return true if it probably has."""
+        bits = self.bits
+        mask = self.mask
+        for idx in struct.unpack("!5L", digest):
+            idx = idx & mask
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return 0
+        return 1
+
+# Magic string at the start of every hash table file.
+_TABLE_MAGIC = "MMHASHT1"
+# Layout of the start of a hash table file: the magic string, the number of
+# slots, the number of entries, a flags word, and the length of the keyid.
+_HEADER_PATTERN = "!8sLLLL"
+_HEADER_FIXED_LEN = struct.calcsize(_HEADER_PATTERN)
+# Total length of the header, including the keyid and padding.
+_HEADER_LEN = 64
+# Flag: set if the all-zero digest is in the table.  (We can't store that
+# digest in a slot, since an all-zero slot means 'empty'.)
+_FLAG_HAS_ZERO = 1
+# The all-zero digest; also the value of an empty slot.
+_ZERO_DIGEST = "\000"*DIGEST_LEN
+
+class HashLog:
     """A HashLog is a file containing a list of message digests that we've
        already processed.
 
@@ -83,36 +197,262 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
        the network.  On a restart, we reinsert all messages waiting in 'B'
        into the log.)
 
-       HashLogs are implemented using Python's anydbm interface.  This defaults
-       to using Berkeley DB, GDBM, or --if you have none of these-- a flat
-       text file."""
-    def __init__(self, filename, keyid):
-        mixminion.Filestore.BooleanJournaledDBBase.__init__(self,
-                 filename, "digest hash", 20)
+       HashLogs are stored as an open-addressed hash table of fixed-size
+       digests, which we access through mmap.  New digests are kept in
+       memory and appended to a log file in batches; on the next sync, we
+       write them into the table and truncate the log.  When the table gets
+       more than half full, we copy it into a new table twice as large.
 
+       Since nearly every packet we see is new, we keep a BloomFilter of
+       every digest in the log, and only look in the table when the
+       filter says we might have seen a digest before."""
+    ## Fields:
+    # filename -- the prefix for this log's files.
+    # keyid -- the keyid of the key that this log corresponds to.
+    # bloom -- a BloomFilter holding every digest in this log.
+    # journal -- map from every digest added since the last sync to 1.
+    # tableFileName -- the name of the file holding the hash table.
+    # table -- an mmap object for the hash table file.
+    # nSlots -- the number of slots in the table; always a power of two.
+    # nEntries -- the number of digests stored in the table's slots.
+    # hasZero -- true iff the table contains the all-zero digest.
+    # journalFileName -- the name of the file where we append new digests.
+    # journalFile -- a JournalFile for journalFileName, in group-commit mode.
+    # _lock -- a threading.RLock to protect all of the above.
+
+    # Number of slots in a newly created table.
+    MIN_SLOTS = 1<<12
+    def __init__(self, filename, keyid, lifetime=None):
+        """Open a HashLog stored in files beginning with 'filename', for the
+           key whose keyid is 'keyid'.  If 'lifetime' is provided, it is the
+           number of seconds for which the key is valid."""
+        self._lock = threading.RLock()
+        self.filename = filename
         self.keyid = keyid
+        self.tableFileName = filename+".tbl"
+        self.journalFileName = filename+".log"
+        createPrivateDir(os.path.split(filename)[0])
+
+        LOG.debug("Opening digest hash table at %s", self.tableFileName)
+        if not os.path.exists(self.tableFileName):
+            self._createTable(self.tableFileName, self.MIN_SLOTS)
+        self._openTable()
+
+        # If there's a journal file, snarf it into memory.  (If we crashed
+        # in the middle of a write, ignore the partial digest at the end.)
+        self.journal = {}
+        if os.path.exists(self.journalFileName):
+            j = readFile(self.journalFileName, 1)
+            for i in xrange(0, len(j)-DIGEST_LEN+1, DIGEST_LEN):
+                self.journal[j[i:i+DIGEST_LEN]] = 1
+        # We only promise that a digest is on disk after sync(), so we can
+        # write the journal in batches.
+        self.journalFile = mixminion.Filestore.JournalFile(
+            self.journalFileName, groupCommit=1)
+
+        self._rebuildBloomFilter(lifetime)
+        self.sync()
+
+    def _createTable(self, fname, nSlots, nEntries=0, flags=0):
+        """Helper: create a new empty hash table with 'nSlots' slots in the
+           file 'fname'."""
+        keyid = self.keyid
+        if len(keyid) > _HEADER_LEN - _HEADER_FIXED_LEN:
+            raise MixFatalError("KEYID too long for hash log")
+        header = struct.pack(_HEADER_PATTERN, _TABLE_MAGIC, nSlots,
+                             nEntries, flags, len(keyid)) + keyid
+        header += "\000"*(_HEADER_LEN-len(header))
+        f = open(fname, 'wb')
         try:
-            if self.log["KEYID"] != keyid:
-                raise MixFatalError("Log KEYID does not match current KEYID")
-        except KeyError:
-            self.log["KEYID"] = keyid
-            self._syncLog()
+            f.write(header)
+            # Leave the rest of the file sparse, if the filesystem allows.
+            f.seek(_HEADER_LEN + nSlots*DIGEST_LEN - 1)
+            f.write("\000")
+        finally:
+            f.close()
+        os.chmod(fname, 0600)
+
+    def _openTable(self, fname=None):
+        """Helper: map the hash table file 'fname' (by default, our
+           table file) into memory and read its header."""
+        if fname is None:
+            fname = self.tableFileName
+        fd = os.open(fname, os.O_RDWR|getattr(os,'O_BINARY',0))
+        try:
+            size = os.fstat(fd)[stat.ST_SIZE]
+            if size < _HEADER_LEN:
+                raise MixFatalError("Hash table %s is truncated" % fname)
+            self.table = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, nSlots, nEntries, flags, keyidLen = struct.unpack(
+            _HEADER_PATTERN, self.table[:_HEADER_FIXED_LEN])
+        if magic != _TABLE_MAGIC:
+            raise MixFatalError("%s is not a digest hash table" % fname)
+        if size != _HEADER_LEN + nSlots*DIGEST_LEN or nSlots & (nSlots-1):
+            raise MixFatalError("Hash table %s has the wrong size" % fname)
+        keyid = self.table[_HEADER_FIXED_LEN:_HEADER_FIXED_LEN+keyidLen]
+        if keyid != self.keyid:
+            raise MixFatalError("Log KEYID does not match current KEYID")
+        self.nSlots = nSlots
+        self.nEntries = nEntries
+        self.hasZero = flags & _FLAG_HAS_ZERO
+
+    def _writeHeader(self):
+        """Helper: store the current entry count and flags in the table's
+           header."""
+        flags = 0
+        if self.hasZero:
+            flags |= _FLAG_HAS_ZERO
+        self.table[:_HEADER_FIXED_LEN] = struct.pack(_HEADER_PATTERN,
+              _TABLE_MAGIC, self.nSlots, self.nEntries, flags, len(self.keyid))
+
+    def _tableDigests(self):
+        """Helper: return a list of all the digests in the table."""
+        table = self.table
+        result = []
+        for off in xrange(_HEADER_LEN, _HEADER_LEN+self.nSlots*DIGEST_LEN,
+                          DIGEST_LEN):
+            d = table[off:off+DIGEST_LEN]
+            if d != _ZERO_DIGEST:
+                result.append(d)
+        if self.hasZero:
+            result.append(_ZERO_DIGEST)
+        return result
+
+    def _tableContains(self, digest):
+        """Helper: return true iff 'digest' is stored in the table."""
+        if digest == _ZERO_DIGEST:
+            return self.hasZero
+        table = self.table
+        mask = self.nSlots - 1
+        idx = struct.unpack("!L", digest[-4:])[0] & mask
+        while 1:
+            off = _HEADER_LEN + idx*DIGEST_LEN
+            d = table[off:off+DIGEST_LEN]
+            if d == digest:
+                return 1
+            elif d == _ZERO_DIGEST:
+                return 0
+            idx = (idx+1) & mask
+
+    def _tableInsert(self, digest):
+        """Helper: store 'digest' in the table, if it isn't there already.
+           The table must have at least one empty slot."""
+        if digest == _ZERO_DIGEST:
+            self.hasZero = 1
+            return
+        table = self.table
+        mask = self.nSlots - 1
+        idx = struct.unpack("!L", digest[-4:])[0] & mask
+        while 1:
+            off = _HEADER_LEN + idx*DIGEST_LEN
+            d = table[off:off+DIGEST_LEN]
+            if d == digest:
+                return
+            elif d == _ZERO_DIGEST:
+                table[off:off+DIGEST_LEN] = digest
+                self.nEntries += 1
+                return
+            idx = (idx+1) & mask
+
+    def _growTable(self, nWanted):
+        """Helper: replace the table with a new one large enough to hold
+           'nWanted' entries while staying no more than half full."""
+        nSlots = self.nSlots
+        while nSlots < nWanted*2:
+            nSlots <<= 1
+        LOG.debug("Resizing digest hash table at %s to %s slots",
+                  self.tableFileName, nSlots)
+        digests = self._tableDigests()
+        self.table.close()
+        tmpName = self.tableFileName+".tmp"
+        self._createTable(tmpName, nSlots)
+        # Fill the new table and get it onto disk before it replaces the
+        # old one, so that a crash can't leave us with a partial table.
+        self._openTable(tmpName)
+        for d in digests:
+            self._tableInsert(d)
+        self._writeHeader()
+        self.table.flush()
+        self.table.close()
+        if hasattr(os, 'fsync'):
+            fd = os.open(tmpName, os.O_RDWR|getattr(os,'O_BINARY',0))
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        replaceFile(tmpName, self.tableFileName)
+        self._openTable()
+
+    def _rebuildBloomFilter(self, lifetime):
+        """Helper: create self.bloom and fill it with every digest in the
+           table and the journal."""
+        if lifetime is None:
+            nEntries = DEFAULT_BLOOM_ENTRIES
+        else:
+            nEntries = int(lifetime * EXPECTED_PACKET_RATE)
+        nStored = self.nEntries + len(self.journal)
+        self.bloom = BloomFilter(max(nEntries, nStored*2))
+        for d in self._tableDigests():
+            self.bloom.add(d)
+        for d in self.journal.keys():
+            self.bloom.add(d)
 
     def seenHash(self, hash):
-        return self.has_key(hash)
+        """Return true iff 'hash' has been logged in this HashLog."""
+        self._lock.acquire()
+        try:
+            if not self.bloom.mightContain(hash):
+                return 0
+            return self.journal.has_key(hash) or self._tableContains(hash)
+        finally:
+            self._lock.release()
 
     def logHash(self, hash):
+        """Add 'hash' to this HashLog."""
         assert len(hash) == DIGEST_LEN
-        self[hash] = 1
+        self._lock.acquire()
+        try:
+            self.bloom.add(hash)
+            self.journal[hash] = 1
+            self.journalFile.append(hash)
+        finally:
+            self._lock.release()
+
+    def sync(self):
+        """Write every digest logged since the last sync into the hash
+           table, flush the table to disk, and clear the journal."""
+        self._lock.acquire()
+        try:
+            if self.journal:
+                nWanted = self.nEntries + len(self.journal)
+                if nWanted*2 > self.nSlots:
+                    self._growTable(nWanted)
+                for d in self.journal.keys():
+                    self._tableInsert(d)
+                self._writeHeader()
+            self.table.flush()
+            self.journalFile.truncate()
+            self.journal = {}
+        finally:
+            self._lock.release()
 
     def close(self):
+        """Sync this HashLog to disk and release its resources."""
         try:
             _HASHLOG_DICT_LOCK.acquire()
-            mixminion.Filestore.JournaledDBBase.close(self)
+            self._lock.acquire()
+            try:
+                self.sync()
+                self.table.close()
+                self.table = None
+                self.journalFile.close()
+            finally:
+                self._lock.release()
             try:
                 del _OPEN_HASHLOGS[self.filename]
             except KeyError:
                 pass
         finally:
             _HASHLOG_DICT_LOCK.release()
-
@@ -18,6 +18,7 @@
 #    whenever they change.  This latter approach turns out to be far
 #    easier to use with TLS.
 
+import bisect
 import errno
 import socket
 import select
@@ -34,7 +35,8 @@ from mixminion.Common import MixError, MixFatalError, MixProtocolError, \
      LOG, stringContains, floorDiv, UIError
 from mixminion.Crypto import sha1, getCommonPRNG
 from mixminion.Packet import PACKET_LEN, DIGEST_LEN, IPV4Info, MMTPHostInfo
-from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection
+from mixminion.MMTPClient import PeerCertificateCache, \
+     MMTPClientConnection, TLSSessionCache
 from mixminion.NetUtils import getProtocolSupport, AF_INET, AF_INET6
 import mixminion.server.EventStats as EventStats
 from mixminion.Filestore import CorruptedFile
@@ -53,6 +55,15 @@ class SelectAsyncServer:
     # self.connections: a map from fd to Connection objects.
     # self.state: a map from fd to the latest wantRead,wantWrite tuples
     #    returned by the connection objects' process or getStatus methods.
+    # self._timeout: The number of seconds of inactivity to allow on a
+    #    connection before shutting it down, or None.
+    # self.activityList: a sorted list of (lastActivity, fd) tuples, for
+    #    the connections that can time out.  An entry may be out of date:
+    #    we only fix it when we reach it in tryTimeout.  An entry whose
+    #    time doesn't match the one in self.lastActivityOf is stale, and
+    #    is ignored.
+    # self.lastActivityOf: a map from fd to the activity time recorded
+    #    for it in activityList.
 
     # self.bandwidthPerTick: How many bytes of bandwidth do we use per tick,
     #    on average?
@@ -72,6 +83,8 @@ class SelectAsyncServer:
         self._timeout = None
         self.connections = {}
         self.state = {}
+        self.activityList = []
+        self.lastActivityOf = {}
         self.bandwidthPerTick = self.bucket = self.maxBucket = None
 
     def process(self,timeout):
@@ -131,6 +144,7 @@ class SelectAsyncServer:
             if not isopen:
                 del self.connections[fd]
                 del self.state[fd]
+                self._removeTimeout(fd)
                 continue
             self.state[fd] = (wr,ww)
 
@@ -141,6 +155,7 @@ class SelectAsyncServer:
         if not isopen: return
         self.connections[fd] = c
         self.state[fd] = (wr,ww)
+        self._addTimeout(fd, c)
 
     def remove(self, c, fd=None):
         """Remove a connection from this server."""
@@ -148,6 +163,25 @@ class SelectAsyncServer:
             fd = c.fileno()
         del self.connections[fd]
         del self.state[fd]
+        self._removeTimeout(fd)
+
+    def _addTimeout(self, fd, c):
+        """Helper: start tracking the activity time of the connection 'c'
+           on 'fd', so that tryTimeout can find it."""
+        t = c.getLastActivity()
+        if t is None or self.lastActivityOf.get(fd) == t:
+            return
+        self.lastActivityOf[fd] = t
+        bisect.insort(self.activityList, (t, fd))
+
+    def _removeTimeout(self, fd):
+        """Helper: stop tracking the activity time of the connection on
+           'fd'.  (We leave its entry in activityList to be discarded
+           later.)"""
+        try:
+            del self.lastActivityOf[fd]
+        except KeyError:
+            pass
 
     def tryTimeout(self, now=None):
         """Timeout any connection that is too old."""
@@ -157,11 +191,33 @@ class SelectAsyncServer:
             now = time.time()
         # All connections older than 'cutoff' get purged.
         cutoff = now - self._timeout
-        # Maintain a set of filenos for connections we've checked, so we don't
-        # check any more than once.
-        for fd, con in self.connections.items():
+        # Only look at the entries in activityList that are old enough.
+        # Connections that have seen activity since we recorded their
+        # entries get new ones.
+        idx = bisect.bisect(self.activityList, (cutoff, sys.maxint))
+        expired = self.activityList[:idx]
+        del self.activityList[:idx]
+        for t, fd in expired:
+            if self.lastActivityOf.get(fd) != t:
+                continue
+            del self.lastActivityOf[fd]
+            con = self.connections[fd]
             if con.tryTimeout(cutoff):
                 self.remove(con,fd)
+            else:
+                self._addTimeout(fd, con)
+
+    def getFirstActivityTime(self):
+        """Return the earliest recorded activity time for any connection
+           that can time out, or None if there are no such connections.
+           (Since entries are only updated lazily, the connection may have
+           been active since then.)"""
+        while self.activityList:
+            t, fd = self.activityList[0]
+            if self.lastActivityOf.get(fd) == t:
+                return t
+            del self.activityList[0]
+        return None
 
     def setBandwidth(self, n, maxBucket=None):
         """Set bandwidth limitations for this server
@@ -237,6 +293,7 @@ class PollAsyncServer(SelectAsyncServer):
                 #print "unregister",fd
                 self.poll.unregister(fd)
                 del self.connections[fd]
+                self._removeTimeout(fd)
                 continue
             #print "register",fd
             self.poll.register(fd,self.EVENT_MASK[wr,ww])
@@ -249,14 +306,109 @@ class PollAsyncServer(SelectAsyncServer):
         mask = self.EVENT_MASK[(wr,ww)]
         #print "register",fd
         self.poll.register(fd, mask)
+        self._addTimeout(fd, c)
     def remove(self,c,fd=None):
         if fd is None:
             fd = c.fileno()
         #print "unregister",fd
         self.poll.unregister(fd)
         del self.connections[fd]
+        self._removeTimeout(fd)
+
+class EpollAsyncServer(SelectAsyncServer):
+    """Subclass of SelectAsyncServer that uses Linux's 'epoll' where
+       available.  The kernel remembers which events we want on each fd, so
+       we only tell it when a connection's interests change; and each call
+       to process costs time proportional to the number of ready fds, not
+       to the number of open connections."""
+    ## Fields:
+    # epoll: a select.epoll object.
+    # masks: a map from fd to the event mask we've registered for it.
+    def __init__(self):
+        SelectAsyncServer.__init__(self)
+        self.epoll = select.epoll()
+        self.masks = {}
+        self.EVENT_MASK = {(0,0):0,
+                           (1,0): select.EPOLLIN+select.EPOLLERR,
+                           (0,1): select.EPOLLOUT+select.EPOLLERR,
+                           (0,2): select.EPOLLOUT+select.EPOLLERR,
+                           (1,1): select.EPOLLIN+select.EPOLLOUT+select.EPOLLERR,
+                           (1,2): select.EPOLLIN+select.EPOLLOUT+select.EPOLLERR }
+    def process(self,timeout):
+        if self.bucket is not None and self.bucket <= 0:
+            time.sleep(timeout)
+            return
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return
+            else:
+                raise e
+        if not events:
+            return
+        if self.bucket is None:
+            cap = None
+        else:
+            cap = floorDiv(self.bucket,len(events))
+        for fd, mask in events:
+            try:
+                c = self.connections[fd]
+            except KeyError:
+                # An earlier connection in this batch removed this one.
+                continue
+            wr,ww,isopen,n = c.process(mask&select.EPOLLIN,
+                                       mask&select.EPOLLOUT,
+                                       mask&(select.EPOLLERR|select.EPOLLHUP),
+                                       cap)
+            if cap is not None:
+                self.bucket -= n
+            if not isopen:
+                self._unregister(fd)
+                del self.connections[fd]
+                self._removeTimeout(fd)
+                continue
+            mask = self.EVENT_MASK[wr,ww]
+            if self.masks[fd] != mask:
+                self.epoll.modify(fd, mask)
+                self.masks[fd] = mask
+
+    def _unregister(self, fd):
+        """Helper: stop watching 'fd'."""
+        del self.masks[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # The kernel forgets about fds once they're closed, so if the
+            # connection has closed its socket, there's nothing to do.
+            pass
+
+    def register(self,c):
+        fd = c.fileno()
+        wr, ww, isopen = c.getStatus()
+        if not isopen: return
+        self.connections[fd] = c
+        mask = self.EVENT_MASK[(wr,ww)]
+        try:
+            self.epoll.register(fd, mask)
+        except IOError, e:
+            # We may be re-registering a connection to change its mask.
+            if e.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fd, mask)
+        self.masks[fd] = mask
+        self._addTimeout(fd, c)
+    def remove(self,c,fd=None):
+        if fd is None:
+            fd = c.fileno()
+        self._unregister(fd)
+        del self.connections[fd]
+        self._removeTimeout(fd)
 
-if hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
+if hasattr(select,'epoll'):
+    # Prefer 'epoll' on Linux, where we have it.
+    AsyncServer = EpollAsyncServer
+elif hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
     # Prefer 'poll' to 'select', except on MacOS and other platforms where
     # where 'poll' is just a wrapper around 'select'.  (The poll wrapper is
     # sometimes buggy.)
@@ -281,6 +433,10 @@ class Connection:
         """If this connection has seen no activity since 'cutoff', and it
            is subject to aging, shut it down."""
         pass
+    def getLastActivity(self):
+        """Return the last time this connection saw any activity, or None
+           if it is not subject to aging."""
+        return None
 
 class ListenConnection(Connection):
     """A ListenConnection listens on a given port/ip combination, and calls
@@ -406,10 +562,14 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
 
     def onDataRead(self):
         while self.inbuflen >= self.MESSAGE_LEN:
-            data = self.getInbuf(self.MESSAGE_LEN, clear=1)
+            # Slice the pieces straight out of the input buffer, so that we
+            # copy the packet only once.
+            data = self.peekInbuf(self.MESSAGE_LEN)
             control = data[:SEND_CONTROL_LEN]
             pkt = data[SEND_CONTROL_LEN:-DIGEST_LEN]
             digest = data[-DIGEST_LEN:]
+            del data
+            self.consumeInbuf(self.MESSAGE_LEN)
             if control == JUNK_CONTROL:
                 expectedDigest = sha1(pkt+"JUNK")
                 replyDigest = sha1(pkt+"RECEIVED JUNK")
@@ -558,6 +718,8 @@ class MMTPAsyncServer(AsyncServer):
     # clientConByAddr: A map from 3-tuples returned by MMTPClientConnection.
     #     getAddr, to MMTPClientConnection objects.
     # certificateCache: A PeerCertificateCache object.
+    # sessionCache: A TLSSessionCache object to resume sessions with other
+    #     servers, or None if we always do a full handshake.
     # listeners: A list of ListenConnection objects.
     # _timeout: The number of seconds of inactivity to allow on a connection
     #     before formerly shutting it down.
@@ -569,6 +731,16 @@ class MMTPAsyncServer(AsyncServer):
     #     to have outgoing at any time.  If we try to deliver packets
     #     to a new server, but we already have this many open outgoing
     #     connections, we put the packets in pendingPackets.
+    # sendWindow: Number of packets we send on a client connection before
+    #     we wait for acks.
+    # maxIdleTime: Number of seconds to keep a client connection open after
+    #     it runs out of packets, in case we have more packets for the same
+    #     server.  0 if we close connections as soon as they're done.
+    # maxIdleConnections: Largest number of idle client connections to keep
+    #     open.  When we need to close one, we close the one that has been
+    #     idle the longest.
+    # nextIdleCheck: The next time at which to look for idle connections
+    #     to close or keep alive.
     # pendingPackets: A list of tuples to serve as arguments for _sendPackets.
 
     def __init__(self, config, servercontext):
@@ -579,6 +751,15 @@ class MMTPAsyncServer(AsyncServer):
         self._lock = threading.Lock()
         self.maxClientConnections = config['Outgoing/MMTP'].get(
             'MaxConnections', 16)
+        self.sendWindow = config['Outgoing/MMTP'].get('SendWindow', 6)
+        maxIdle = config['Outgoing/MMTP'].get('MaxIdleTime')
+        if maxIdle:
+            self.maxIdleTime = maxIdle.getSeconds()
+        else:
+            self.maxIdleTime = 0
+        self.maxIdleConnections = config['Outgoing/MMTP'].get(
+            'MaxIdleConnections', 8)
+        self.nextIdleCheck = 0
         maxbw = config['Server'].get('MaxBandwidth', None)
         maxbwspike = config['Server'].get('MaxBandwidthSpike', None)
         self.setBandwidth(maxbw, maxbwspike)
@@ -619,6 +800,10 @@ class MMTPAsyncServer(AsyncServer):
         self._timeout = config['Server']['Timeout'].getSeconds()
         self.clientConByAddr = {}
         self.certificateCache = PeerCertificateCache()
+        if config['Outgoing/MMTP'].get('ResumeSessions'):
+            self.sessionCache = TLSSessionCache()
+        else:
+            self.sessionCache = None
         self.dnsCache = None
         self.msgQueue = MessageQueue()
         self.pendingPackets = []
@@ -636,7 +821,9 @@ class MMTPAsyncServer(AsyncServer):
 
     def setServerContext(self, servercontext):
         """Change the TLS context used for newly received connections.
-           Used to rotate keys."""
+           Used to rotate keys.  (The old context's session cache goes
+           away with it, so clients can't resume sessions that used the
+           old certificate.)"""
         self._lock.acquire()
         self.serverContext = servercontext
         self._lock.release()
@@ -646,7 +833,10 @@ class MMTPAsyncServer(AsyncServer):
            last done so at time 'now'."""
         if now is None:
             now = time.time()
-        return now + self._timeout
+        first = self.getFirstActivityTime()
+        if first is None:
+            return now + self._timeout
+        return max(now, first + self._timeout)
 
     def _newMMTPConnection(self, sock):
         """helper method.  Creates and registers a new server connection when
@@ -732,7 +922,9 @@ class MMTPAsyncServer(AsyncServer):
 
            This function should only be called from the main thread.
         """
-        while len(self.clientConByAddr) < self.maxClientConnections and self.pendingPackets:
+        while self.pendingPackets and (
+            len(self.clientConByAddr) < self.maxClientConnections or
+            self._getIdleConnections()):
             args = self.pendingPackets.pop(0)
             LOG.debug("Sending %s delayed packets...",len(args[5]))
             self._sendPackets(*args)
@@ -764,9 +956,12 @@ class MMTPAsyncServer(AsyncServer):
                           len(deliverable), con.address)
                 for d in deliverable:
                     con.addPacket(d)
+                # The connection may have been idle, waiting only to read.
+                self.register(con)
                 return
 
-        if len(self.clientConByAddr) >= self.maxClientConnections:
+        if (len(self.clientConByAddr) >= self.maxClientConnections and
+            not self._closeIdleConnections(1)):
             LOG.debug("We already have %s open client connections; delaying %s packets for %s",
                       len(self.clientConByAddr), len(deliverable), serverName)
             self.pendingPackets.append((family,ip,port,keyID,deliverable,serverName))
@@ -775,10 +970,13 @@ class MMTPAsyncServer(AsyncServer):
         try:
             # There isn't any connection to the right server. Open one...
             addr = (ip, port, keyID)
-            finished = lambda addr=addr, self=self: self.__clientFinished(addr)
             con = _ClientCon(
                 family, ip, port, keyID, serverName=serverName,
-                context=self.clientContext, certCache=self.certificateCache)
+                context=self.clientContext, certCache=self.certificateCache,
+                sendWindow=self.sendWindow, keepAlive=(self.maxIdleTime>0),
+                sessionCache=self.sessionCache)
+            finished = lambda addr=addr, con=con, self=self: \
+                       self.__clientFinished(addr, con)
             nickname = mixminion.ServerInfo.getNicknameByKeyID(keyID)
             if nickname is not None:
                 # If we recognize this server, then we'll want to tell
@@ -805,14 +1003,57 @@ class MMTPAsyncServer(AsyncServer):
             self.register(con)
             self.clientConByAddr[addr] = con
 
-    def __clientFinished(self, addr):
-        """Called when a client connection runs out of packets to send,
-           or halts."""
-        try:
+    def __clientFinished(self, addr, con):
+        """Called when the client connection 'con' to 'addr' halts."""
+        # (If we closed 'con' for being idle, we've already forgotten it,
+        # and may have opened another connection to the same address.)
+        if self.clientConByAddr.get(addr) is con:
             del self.clientConByAddr[addr]
-        except KeyError:
-            LOG.warn("Didn't find client connection to %s in address map",
-                     addr)
+
+    def _getIdleConnections(self):
+        """Return a list of (idleSince, addr, connection) tuples for all of
+           the idle client connections, least recently used first."""
+        idle = []
+        for addr, con in self.clientConByAddr.items():
+            since = con.getIdleSince()
+            if since is not None:
+                idle.append((since, addr, con))
+        idle.sort()
+        return idle
+
+    def _closeIdleConnections(self, n):
+        """Shut down the 'n' least recently used idle client connections.
+           Return the number we shut down."""
+        idle = self._getIdleConnections()[:n]
+        for _, addr, con in idle:
+            self._closeIdleConnection(addr, con)
+        return len(idle)
+
+    def _closeIdleConnection(self, addr, con):
+        """Helper: shut down the idle client connection 'con' to 'addr'."""
+        # Forget about the connection now, so that we can open another
+        # in its place before it finishes shutting down.
+        del self.clientConByAddr[addr]
+        con.closeIdle()
+        self.register(con)
+
+    def _checkIdleConnections(self, now):
+        """Close all client connections that have been idle for too long,
+           or that are over our limit for idle connections.  Send padding
+           on the others if they're at risk of timing out."""
+        idle = self._getIdleConnections()
+        nExtra = len(idle) - self.maxIdleConnections
+        cutoff = now - self.maxIdleTime
+        for since, addr, con in idle:
+            if nExtra > 0 or since < cutoff:
+                nExtra -= 1
+                self._closeIdleConnection(addr, con)
+            elif con.getLastActivity() < now - self._timeout/2.0:
+                # The server on the other side will time out the
+                # connection if we don't use it.  We assume that its
+                # timeout is the same as ours.
+                con.sendKeepAlive()
+                self.register(con)
 
     def onPacketReceived(self, pkt):
         """Abstract function.  Called when we get a packet"""
@@ -823,4 +1064,9 @@ class MMTPAsyncServer(AsyncServer):
            checking fd status.
         """
         self._sendQueuedPackets()
+        if self.maxIdleTime:
+            now = time.time()
+            if now >= self.nextIdleCheck:
+                self._checkIdleConnections(now)
+                self.nextIdleCheck = now + 1
         AsyncServer.process(self, timeout)
@@ -549,6 +549,7 @@ class FragmentModule(DeliveryModule):
     # maxInterval: The longest we hold onto a fragment of a message before
     #   we give up on receiving the whole message.  (In seconds.)
     # maxFragments: The largest allowable message size, in fragments.
+    # useManifest: True iff the fragment pool should keep a manifest.
     def __init__(self):
         DeliveryModule.__init__(self)
         self._queue = None
@@ -556,6 +557,7 @@ class FragmentModule(DeliveryModule):
         self.maxMessageSize = None
         self.maxInterval = None
         self.maxFragments = None
+        self.useManifest = 0
         self.lock = threading.RLock()
     def usesDecodingHandle(self): return 0
     def getConfigSyntax(self):
@@ -604,6 +606,7 @@ class FragmentModule(DeliveryModule):
             return
         self.maxMessageSize = sec['MaximumSize']
         self.maxInterval = sec['MaximumInterval'].getSeconds()
+        self.useManifest = config['Server'].get('QueueManifest')
         # How many packets could it take to encode a max-size message?
         fp = mixminion.Fragments.FragmentationParams(self.maxMessageSize, 0)
         self.maxFragments = fp.nChunks * fp.n
@@ -655,7 +658,8 @@ class FragmentDeliveryQueue:
         self.module = module
         self.directory = directory
         self.manager = manager
-        self.pool = mixminion.Fragments.FragmentPool(self.directory)
+        self.pool = mixminion.Fragments.FragmentPool(
+            self.directory, manifest=module.useManifest)
         self.lock = self.module.lock
 
     def getPriority(self):
@@ -697,7 +701,13 @@ class FragmentDeliveryQueue:
             self.pool.unchunkMessages()
             ready = self.pool.listReadyMessages()
             for msgid in ready:
-                msg = self.pool.getReadyMessage(msgid)
+                # Delivery modules need the message as a string, but we can
+                # still avoid the intermediate copies that getReadyMessage
+                # makes while joining and unwhitening the chunks.
+                pieces = []
+                self.pool.writeReadyMessage(msgid, pieces.append)
+                msg = "".join(pieces)
+                del pieces
                 try:
                     ssfm = mixminion.Packet.parseServerSideFragmentedMessage(msg)
                     del msg
@@ -3,7 +3,12 @@
 """mixminion.server.PacketHandler: Code to process mixminion packets"""
 
 import binascii
+import os
+import signal
+import sys
 import threading
+import time
+import traceback
 import types
 
 from mixminion.Common import encodeBase64, formatBase64, LOG
@@ -14,7 +19,23 @@ import mixminion.BuildMessage
 from mixminion.ServerInfo import PACKET_KEY_BYTES
 from mixminion.Common import MixError, MixFatalError, isPrintingAscii
 
-__all__ = [ 'PacketHandler', 'ContentError', 'DeliveryPacket', 'RelayedPacket']
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+__all__ = [ 'PacketHandler', 'ContentError', 'DeliveryPacket', 'RelayedPacket',
+            'canUseWorkers' ]
+
+# How many packets may be waiting for each worker process before
+# processPacketInWorker blocks?
+MAX_PENDING_PER_WORKER = 8
+# How many seconds do we give the worker pool to process a packet before we
+# assume that the worker handling it died, and give the packet to another?
+WORKER_TIMEOUT = 60
+# How many times do we try to process a packet in the worker pool before we
+# give up on it?
+MAX_WORKER_ATTEMPTS = 3
 
 class ContentError(MixError):
     """Exception raised when a packed is malformatted or unacceptable."""
@@ -30,7 +51,20 @@ class PacketHandler:
     # privatekeys: a list of 2-tuples of
     #      (1) a RSA private key that we accept
     #      (2) a HashLog objects corresponding to the given key
-    def __init__(self, privatekeys=(), hashlogs=()):
+    # nWorkers: the number of worker processes to use, or 0.
+    # pool: None, or a multiprocessing.Pool of worker processes used by
+    #      processPacketInWorker.  The workers get our private keys when
+    #      they start, so we replace the pool whenever our keys change.
+    # oldPools: a list of pools that we've replaced, but that may still
+    #      be running workers.
+    # pending: a semaphore bounding the number of packets waiting for
+    #      the pool, or None.
+    # jobs: a map from the _WorkerJob for every packet waiting for the
+    #      pool to 1.
+    # watchdog: None, or a thread that runs _watchWorkers.
+    # stopping: an Event that we set to tell the watchdog to stop.
+    # hashlogsByKey: a map from key digest to the HashLog for that key.
+    def __init__(self, privatekeys=(), hashlogs=(), nWorkers=0):
         """Constructs a new packet handler, given a sequence of
            private key object for header encryption, and a sequence of
            corresponding hashlog object to prevent replays.
@@ -39,15 +73,36 @@ class PacketHandler:
            processed, we try each of the private keys in sequence.  If
            the packet is decodeable with one of the keys, we log it in
            the corresponding entry of the hashlog list.
+
+           If nWorkers is positive, start that many worker processes for
+           use by processPacketInWorker.
         """
         self.privatekeys = []
         self.lock = threading.Lock()
+        self.hashlogsByKey = {}
 
         assert type(privatekeys) in (types.ListType, types.TupleType)
         assert type(hashlogs) in (types.ListType, types.TupleType)
 
+        self.nWorkers = nWorkers
+        self.pool = self.pending = self.watchdog = None
+        self.oldPools = []
+        self.jobs = {}
+        self.stopping = threading.Event()
+        if nWorkers > 0:
+            if not canUseWorkers():
+                raise MixFatalError("Worker processes require Python 2.6 or later")
+            self.pending = threading.Semaphore(
+                nWorkers*MAX_PENDING_PER_WORKER)
+
         self.setKeys(privatekeys, hashlogs)
 
+        if nWorkers > 0:
+            self.watchdog = threading.Thread(target=self._watchWorkers)
+            # When the process exits, don't wait for this thread.
+            self.watchdog.setDaemon(1)
+            self.watchdog.start()
+
     def setKeys(self, keys, hashlogs):
         """Change the keys and hashlogs used by this PacketHandler.
            Arguments are as to PacketHandler.__init__
@@ -67,9 +122,31 @@ class PacketHandler:
                     h.close()
             # Now, set the keys.
             self.privatekeys = zip(keys, hashlogs)
+            self.hashlogsByKey = {}
+            for k, h in self.privatekeys:
+                self.hashlogsByKey[Crypto.sha1(k.encode_key(1))] = h
+            # And give the workers the new keys.
+            if self.nWorkers > 0:
+                self._startPool()
         finally:
             self.lock.release()
 
+    def _startPool(self):
+        """Helper: start a new pool of worker processes that know our
+           current private keys.  Workers in the old pool, if any, finish
+           the packets they already have, and then exit.  Callers must
+           hold self.lock."""
+        encodedKeys = [ (Crypto.sha1(k.encode_key(1)),
+                         Crypto.pk_encode_private_key(k))
+                        for k, _ in self.privatekeys ]
+        LOG.info("Starting %s packet worker processes", self.nWorkers)
+        old = self.pool
+        self.pool = multiprocessing.Pool(self.nWorkers, _workerInit,
+                                         (encodedKeys,))
+        if old is not None:
+            old.close()
+            self.oldPools.append(old)
+
     def syncLogs(self):
         """Sync all this PacketHandler's hashlogs."""
         try:
@@ -80,7 +157,20 @@ class PacketHandler:
             self.lock.release()
 
     def close(self):
-        """Close all this PacketHandler's hashlogs."""
+        """Close all this PacketHandler's hashlogs, and stop its worker
+           processes.  Packets still pending in the workers are not
+           processed."""
+        if self.watchdog is not None:
+            self.stopping.set()
+            self.watchdog.join()
+            self.watchdog = None
+        if self.pool is not None:
+            for pool in self.oldPools + [self.pool]:
+                pool.terminate()
+                pool.join()
+            self.pool = None
+            self.oldPools = []
+            self.jobs = {}
         try:
             self.lock.acquire()
             for _, h in self.privatekeys:
@@ -104,139 +194,359 @@ class PacketHandler:
            attacks: dropped packets, packets with bad digests, replayed
            packets, and exit packets are all processed faster than
            forwarded packets.  You must prevent timing attacks elsewhere."""
-
-        # Break into headers and payload
-        pkt = Packet.parsePacket(msg)
-        header1 = Packet.parseHeader(pkt.header1)
-        encSubh = header1[:Packet.ENC_SUBHEADER_LEN]
-        header1 = header1[Packet.ENC_SUBHEADER_LEN:]
-
-        assert len(header1) == Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
-        assert len(header1) == (128*16) - 256 == 1792
-
-        # Try to decrypt the first subheader.  Try each private key in
-        # order.  Only fail if all private keys fail.
-        subh = None
-        e = None
         self.lock.acquire()
         try:
-            for pk, hashlog in self.privatekeys:
-                try:
-                    subh = Crypto.pk_decrypt(encSubh, pk)
-                    break
-                except Crypto.CryptoError, err:
-                    e = err
+            privatekeys = self.privatekeys
         finally:
             self.lock.release()
-        if not subh:
-            # Nobody managed to get us the first subheader.  Raise the
-            # most-recently-received error.
-            raise e
-
-        if len(subh) != Packet.MAX_SUBHEADER_LEN:
-            raise ContentError("Bad length in RSA-encrypted part of subheader")
-
-        subh = Packet.parseSubheader(subh) #may raise ParseError
-
-        # Check the version: can we read it?
-        if subh.major != Packet.MAJOR_NO or subh.minor != Packet.MINOR_NO:
-            raise ContentError("Invalid protocol version")
-
-        # Check the digest of all of header1 but the first subheader.
-        if subh.digest != Crypto.sha1(header1):
-            raise ContentError("Invalid digest")
-
-        # Get ready to generate packet keys.
-        keys = Crypto.Keyset(subh.secret)
-
-        # Replay prevention
-        replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN)
-        if hashlog.seenHash(replayhash):
-            raise ContentError("Duplicate packet detected.")
-        else:
-            hashlog.logHash(replayhash)
-
-        # If we're meant to drop, drop now.
-        rt = subh.routingtype
-        if rt == Packet.DROP_TYPE:
-            return None
-
-        # Prepare the key to decrypt the header in counter mode.  We'll be
-        # using this more than once.
-        header_sec_key = Crypto.aes_key(keys.get(Crypto.HEADER_SECRET_MODE))
-
-        # Prepare key to generate padding
-        junk_key = Crypto.aes_key(keys.get(Crypto.RANDOM_JUNK_MODE))
-
-        # Pad the rest of header 1
-        header1 += Crypto.prng(junk_key,
-                               Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN
-                               + subh.routinglen)
-
-        assert len(header1) == (Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
-                             + Packet.OAEP_OVERHEAD+Packet.MIN_SUBHEADER_LEN
-                                + subh.routinglen)
-        assert len(header1) == 1792 + 42 + 42 + subh.routinglen == \
-               1876 + subh.routinglen
-
-        # Decrypt the rest of header 1, encrypting the padding.
-        header1 = Crypto.ctr_crypt(header1, header_sec_key)
-
-        # If the subheader says that we have extra routing info that didn't
-        # fit in the RSA-encrypted part, get it now.
-        overflowLength = subh.getOverflowLength()
-        if overflowLength:
-            subh.appendOverflow(header1[:overflowLength])
-            header1 = header1[overflowLength:]
-
-        assert len(header1) == (
-            1876 + subh.routinglen
-            - max(0,subh.routinglen-Packet.MAX_ROUTING_INFO_LEN))
-
-        header1 = subh.underflow + header1
 
-        assert len(header1) == Packet.HEADER_LEN
-
-        # Decrypt the payload.
-        payload = Crypto.lioness_decrypt(pkt.payload,
-                              keys.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE))
-
-        # If we're an exit node, there's no need to process the headers
-        # further.
-        if rt >= Packet.MIN_EXIT_TYPE:
-            return DeliveryPacket(rt, subh.getExitAddress(0),
-                                  keys.get(Crypto.APPLICATION_KEY_MODE),
-                                  payload)
-
-        # If we're not an exit node, make sure that what we recognize our
-        # routing type.
-        if rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
-                      Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
-            raise ContentError("Unrecognized Mixminion routing type")
-
-        # Decrypt header 2.
-        header2 = Crypto.lioness_decrypt(pkt.header2,
-                           keys.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE))
-
-        # If we're the swap node, (1) decrypt the payload with a hash of
-        # header2... (2) decrypt header2 with a hash of the payload...
-        # (3) and swap the headers.
-        if Packet.typeIsSwap(rt):
-            hkey = Crypto.lioness_keys_from_header(header2)
-            payload = Crypto.lioness_decrypt(payload, hkey)
-
-            hkey = Crypto.lioness_keys_from_payload(payload)
-            header2 = Crypto.lioness_decrypt(header2, hkey)
+        return _processPacket(msg, privatekeys, _checkAndLogReplay)
+
+    def usesWorkers(self):
+        """Return true iff this PacketHandler processes packets in a pool
+           of worker processes."""
+        return self.pool is not None
+
+    def processPacketInWorker(self, msg, callback):
+        """Given a 32K mixminion packet, send it to one of our worker
+           processes for decryption.  When the worker is done, invoke
+           'callback' with a single argument: a no-arguments function that
+           checks the packet against our hashlogs, and then returns or
+           raises exactly as processPacket would have done.
+
+           The callback is invoked from a thread internal to the worker
+           pool; it should hand the result off to another thread rather
+           than doing any real work itself.  Blocks while too many packets
+           are already pending.
+
+           If a worker dies while it has the packet, the packet's result
+           never arrives; after WORKER_TIMEOUT seconds, we give the packet
+           to another worker."""
+        assert self.pool is not None
+        self.pending.acquire()
+        job = _WorkerJob(msg, callback)
+        self.lock.acquire()
+        try:
+            self.jobs[job] = 1
+            self._submitJob(job, time.time())
+        finally:
+            self.lock.release()
 
-            header1, header2 = header2, header1
+    def _submitJob(self, job, now):
+        """Helper: hand the packet in 'job' to our current worker pool.
+           Callers must hold self.lock."""
+        job.attempts += 1
+        job.deadline = now + WORKER_TIMEOUT
+        job.pool = self.pool
+        def onDone(r, self=self, job=job, attempt=job.attempts):
+            self._workerDone(job, attempt, r)
+        self.pool.apply_async(_workerProcessPacket, (job.msg,),
+                              callback=onDone)
+
+    def _workerDone(self, job, attempt, r):
+        """Helper: invoked from the worker pool when the 'attempt'th try
+           at processing the packet in 'job' has returned 'r'."""
+        self.lock.acquire()
+        try:
+            if not self.jobs.has_key(job) or job.attempts != attempt:
+                # We already gave up on this try, and gave the packet to
+                # another worker.
+                LOG.debug("Ignoring late result from packet worker")
+                return
+            del self.jobs[job]
+        finally:
+            self.lock.release()
+        self.pending.release()
+        job.callback(lambda self=self, r=r: self._finishWorkerResult(r))
+
+    def _checkWorkerJobs(self, now):
+        """Helper: give every packet that's been waiting for the worker
+           pool since before 'now'-WORKER_TIMEOUT to another worker, or
+           give up on it if it has had too many tries already.  Then shut
+           down any old pool that has no packets left."""
+        failed = []
+        self.lock.acquire()
+        try:
+            for job in self.jobs.keys():
+                if job.deadline > now:
+                    continue
+                if job.attempts >= MAX_WORKER_ATTEMPTS:
+                    del self.jobs[job]
+                    failed.append(job)
+                else:
+                    LOG.warn("Packet worker timed out; retrying packet")
+                    self._submitJob(job, now)
+            inUse = {}
+            for job in self.jobs.keys():
+                inUse[id(job.pool)] = 1
+            oldPools = []
+            for pool in self.oldPools[:]:
+                if not inUse.has_key(id(pool)):
+                    self.oldPools.remove(pool)
+                    oldPools.append(pool)
+        finally:
+            self.lock.release()
 
-        # Build the address object for the next hop
-        address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
+        for job in failed:
+            LOG.warn("Packet worker timed out %s times; giving up on packet",
+                     job.attempts)
+            self.pending.release()
+            job.callback(_raiseWorkerTimeout)
+        for pool in oldPools:
+            # (A pool with a lost packet never finishes on its own, so we
+            # don't wait for it.)
+            pool.terminate()
+            pool.join()
+
+    def _watchWorkers(self):
+        """Run in a separate thread: check on the packets waiting for the
+           worker pool until we're told to stop."""
+        while 1:
+            self.stopping.wait(WORKER_TIMEOUT/4.0)
+            if self.stopping.isSet():
+                return
+            try:
+                self._checkWorkerJobs(time.time())
+            except:
+                LOG.error_exc(sys.exc_info(),
+                              "Exception while checking packet workers")
+
+    def _finishWorkerResult(self, r):
+        """Helper: given the return value of _workerProcessPacket, check
+           and log the replay digest of the packet it processed, and return
+           the processed packet.  Raise the appropriate exception if the
+           worker failed to process the packet."""
+        if r[0] == 'ERR':
+            _, excName, msg = r
+            try:
+                excClass = _WORKER_EXCEPTIONS[excName]
+            except KeyError:
+                raise MixError("Unexpected error in packet worker: %s"%msg)
+            raise excClass(msg)
+
+        _, keyDigest, replayhash, res = r
+        self.lock.acquire()
+        try:
+            hashlog = self.hashlogsByKey.get(keyDigest)
+            if hashlog is None:
+                # The key expired while the worker had the packet.
+                raise ContentError("Packet key expired before processing")
+            _checkAndLogReplay(hashlog, replayhash)
+        finally:
+            self.lock.release()
+        return res
 
-        # Construct the packet for the next hop.
-        pkt = Packet.Packet(header1, header2, payload).pack()
+class _WorkerJob:
+    """A packet waiting for the worker pool."""
+    ## Fields:
+    # msg: the packet.
+    # callback: the callback passed to processPacketInWorker.
+    # attempts: the number of times we've given the packet to the pool.
+    # deadline: the time after which we stop waiting for the latest try.
+    # pool: the pool that has the latest try.
+    def __init__(self, msg, callback):
+        self.msg = msg
+        self.callback = callback
+        self.attempts = 0
+        self.deadline = None
+        self.pool = None
+
+def _raiseWorkerTimeout():
+    """Helper: used as the result of a packet that never came back from
+       the worker pool."""
+    raise ContentError("Packet workers never finished processing packet")
+
+def _checkAndLogReplay(hashlog, replayhash):
+    """Helper: raise ContentError if 'replayhash' is already in 'hashlog';
+       otherwise, add it."""
+    if hashlog.seenHash(replayhash):
+        raise ContentError("Duplicate packet detected.")
+    else:
+        hashlog.logHash(replayhash)
+
+def canUseWorkers():
+    """Return true iff we can process packets in worker processes."""
+    return multiprocessing is not None
+
+# Within a worker process: a list of (RSA private key, key digest).
+_WORKER_KEYS = []
+
+# Map from names of the exceptions that a worker may report to the
+# exceptions we raise in the parent.
+_WORKER_EXCEPTIONS = { 'CryptoError' : Crypto.CryptoError,
+                       'ParseError' : Packet.ParseError,
+                       'ContentError' : ContentError }
+
+def _workerInit(encodedKeys):
+    """Run within each new worker process.  'encodedKeys' is a list of
+       (key digest, ASN.1-encoded private key) for the keys to use.
+
+       The workers inherit the server's SIGTERM and SIGHUP handlers, which
+       only set flags for the server's main loop to check; restore the
+       defaults so that a worker told to stop actually exits.  We also
+       move into our own process group, so that the server's SIGCHLD
+       handler (which only reaps its own process group) leaves us for the
+       pool to reap and replace."""
+    global _WORKER_KEYS
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(os, 'setpgid'):
+        os.setpgid(0, 0)
+    _WORKER_KEYS = [ (Crypto.pk_decode_private_key(k), d)
+                     for d, k in encodedKeys ]
+
+def _workerProcessPacket(msg):
+    """Run within a worker process: process the packet 'msg' using the keys
+       we got in _workerInit, without checking for replays.
+
+       Returns ('OK', key digest, replay digest, result) on success, and
+       ('ERR', exception name, message) on failure.  The parent must
+       check the replay digest against the hashlog for the given key
+       digest before using the result."""
+    try:
+        seen = []
+        res = _processPacket(msg, _WORKER_KEYS,
+                             lambda d, h, seen=seen: seen.append((d,h)))
+        keyDigest, replayhash = seen[0]
+        return ('OK', keyDigest, replayhash, res)
+    except (Crypto.CryptoError, Packet.ParseError, ContentError), e:
+        return ('ERR', e.__class__.__name__, str(e))
+    except:
+        info = sys.exc_info()
+        return ('ERR', None,
+                "".join(traceback.format_exception(*info)).strip())
+
+def _processPacket(msg, privatekeys, replayFn):
+    """Helper: implementation of PacketHandler.processPacket.
+
+       'privatekeys' is a list of (RSA private key, tag) tuples, tried in
+       order.  Once we know the replay-prevention digest for the packet,
+       we call replayFn(tag, digest) for the key that decrypted it;
+       replayFn should raise ContentError if the packet is a replay."""
+    # Copy the packet into a mutable buffer.  The payload and the second
+    # header are decrypted in place there, so that the only full copies
+    # we make are this one and the one we make when we pack the result.
+    pkt = Packet.PacketBuffer(msg)
+    encSubh = msg[:Packet.ENC_SUBHEADER_LEN]
+    header1 = msg[Packet.ENC_SUBHEADER_LEN:Packet.HEADER_LEN]
+
+    assert len(header1) == Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
+    assert len(header1) == (128*16) - 256 == 1792
+
+    # Try to decrypt the first subheader.  Try each private key in
+    # order.  Only fail if all private keys fail.
+    subh = None
+    e = None
+    for pk, tag in privatekeys:
+        try:
+            subh = Crypto.pk_decrypt(encSubh, pk)
+            break
+        except Crypto.CryptoError, err:
+            e = err
+    if not subh:
+        # Nobody managed to get us the first subheader.  Raise the
+        # most-recently-received error.
+        raise e
+
+    if len(subh) != Packet.MAX_SUBHEADER_LEN:
+        raise ContentError("Bad length in RSA-encrypted part of subheader")
+
+    subh = Packet.parseSubheader(subh) #may raise ParseError
+
+    # Check the version: can we read it?
+    if subh.major != Packet.MAJOR_NO or subh.minor != Packet.MINOR_NO:
+        raise ContentError("Invalid protocol version")
+
+    # Check the digest of all of header1 but the first subheader.
+    if subh.digest != Crypto.sha1(header1):
+        raise ContentError("Invalid digest")
+
+    # Get ready to generate packet keys.
+    keys = Crypto.Keyset(subh.secret)
+
+    # Replay prevention
+    replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN)
+    replayFn(tag, replayhash)
+
+    # If we're meant to drop, drop now.
+    rt = subh.routingtype
+    if rt == Packet.DROP_TYPE:
+        return None
+
+    # Prepare the key to decrypt the header in counter mode.  We'll be
+    # using this more than once.
+    header_sec_key = Crypto.aes_key(keys.get(Crypto.HEADER_SECRET_MODE))
+
+    # Prepare key to generate padding
+    junk_key = Crypto.aes_key(keys.get(Crypto.RANDOM_JUNK_MODE))
+
+    # Pad the rest of header 1
+    header1 += Crypto.prng(junk_key,
+                           Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN
+                           + subh.routinglen)
+
+    assert len(header1) == (Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
+                         + Packet.OAEP_OVERHEAD+Packet.MIN_SUBHEADER_LEN
+                            + subh.routinglen)
+    assert len(header1) == 1792 + 42 + 42 + subh.routinglen == \
+           1876 + subh.routinglen
+
+    # Decrypt the rest of header 1, encrypting the padding.
+    header1 = Crypto.ctr_crypt(header1, header_sec_key)
+
+    # If the subheader says that we have extra routing info that didn't
+    # fit in the RSA-encrypted part, get it now.
+    overflowLength = subh.getOverflowLength()
+    if overflowLength:
+        subh.appendOverflow(header1[:overflowLength])
+        header1 = header1[overflowLength:]
+
+    assert len(header1) == (
+        1876 + subh.routinglen
+        - max(0,subh.routinglen-Packet.MAX_ROUTING_INFO_LEN))
+
+    header1 = subh.underflow + header1
+
+    assert len(header1) == Packet.HEADER_LEN
+
+    # Decrypt the payload.
+    pkt.decryptPayload(keys.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE))
+
+    # If we're an exit node, there's no need to process the headers
+    # further.
+    if rt >= Packet.MIN_EXIT_TYPE:
+        return DeliveryPacket(rt, subh.getExitAddress(0),
+                              keys.get(Crypto.APPLICATION_KEY_MODE),
+                              str(pkt.getPayload()))
+
+    # If we're not an exit node, make sure that what we recognize our
+    # routing type.
+    if rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
+                  Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
+        raise ContentError("Unrecognized Mixminion routing type")
+
+    # Decrypt header 2.
+    pkt.setHeader1(header1)
+    pkt.decryptHeader2(keys.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE))
+
+    # If we're the swap node, (1) decrypt the payload with a hash of
+    # header2... (2) decrypt header2 with a hash of the payload...
+    # (3) and swap the headers.
+    if Packet.typeIsSwap(rt):
+        hkey = Crypto.lioness_keys_from_header(pkt.getHeader2())
+        pkt.decryptPayload(hkey)
+
+        hkey = Crypto.lioness_keys_from_payload(pkt.getPayload())
+        pkt.decryptHeader2(hkey)
+
+        pkt.swapHeaders()
+
+    # Build the address object for the next hop
+    address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
 
-        return RelayedPacket(address, pkt)
+    # Construct the packet for the next hop.
+    return RelayedPacket(address, pkt.pack())
 
 class RelayedPacket:
     """A packet that is to be relayed to another server; returned by
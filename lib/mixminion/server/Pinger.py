@@ -278,6 +278,10 @@ class PingLog:
     # _startTime: The 'startup' time for the current myLifespan row.
     # _lastRecalculation: The last time this process recomputed all
     #   the stats, or 0 for 'never'.
+    # _lastUptimeState: None if this process has not yet calculated uptimes;
+    #   otherwise a 3-tuple of the largest connectionAttempt rowid we had
+    #   seen, the IntervalSet of our own uptime, and the start of the
+    #   timespan, as of the last uptime calculation.
     # _set{Uptime|OneHop|CurOneHop|TwoHop}: Functions generated by
     #   getInsertOrUpdateFn.
 
@@ -294,6 +298,7 @@ class PingLog:
         self._interestingChains = {}
         self._startTime = None
         self._lastRecalculation = 0
+        self._lastUptimeState = None
         self._createAllTables()
         self._loadServers()
 
@@ -668,6 +673,9 @@ class PingLog:
         """Helper: calculate the uptime results for a set of servers, named in
            serverIdentities, for all intervals between startTime and endTime
            inclusive.  Does not commit the current transaction.
+
+           We only recompute other servers' uptimes for the intervals that
+           could have changed since the last time we were called.
         """
         cur = self._db.getCursor()
         serverIdentities.sort()
@@ -677,8 +685,7 @@ class PingLog:
         self.heartbeat(now)
 
         timespan = IntervalSet( [(startTime, endTime)] )
-        calcIntervals = [ (s,e,self._getIntervalID(s,e)) for s,e in
-                          self._intervals.getIntervals(startTime,endTime)]
+        allIntervals = self._intervals.getIntervals(startTime,endTime)
 
         cur.execute("SELECT startup, stillup, shutdown FROM myLifespan WHERE "
                     "startup <= ? AND stillup >= ?",
@@ -686,23 +693,60 @@ class PingLog:
         myIntervals = IntervalSet([ (start, max(end,shutdown))
                                     for start,end,shutdown in cur ])
         myIntervals *= timespan
-        for s, e, i in calcIntervals:
-            uptime = (myIntervals * IntervalSet([(s,e)])).spanLength()
+        selfID = self._getServerID("<self>")
+        for (s, e), uptime in zip(
+                allIntervals, myIntervals.getSpanLengthsWithin(allIntervals)):
             fracUptime = float(uptime)/(e-s)
-            self._setUptime((i, self._getServerID("<self>")), (fracUptime,))
-
-        # Okay, now everybody else.
-        for (identity, serverID) in self._serverIDs.items():
-            if s in ('<self>','<unknown>'): continue
-            cur.execute("SELECT at, success FROM connectionAttempt"
-                        " WHERE server = ? AND at >= ? AND at <= ?"
-                        " ORDER BY at",
-                        (serverID, startTime, endTime))
-
+            self._setUptime((self._getIntervalID(s,e), selfID), (fracUptime,))
+
+        # Okay, now everybody else.  Find the earliest time at which our
+        # inputs have changed since last time.
+        cur.execute("SELECT MAX(rowid) FROM connectionAttempt")
+        watermark, = cur.fetchone()
+        changedAt = startTime
+        if (self._lastUptimeState is not None and
+            self._lastUptimeState[2] <= startTime):
+            lastWatermark, lastMyIntervals, _ = self._lastUptimeState
+            changed = ((myIntervals - lastMyIntervals) +
+                       (lastMyIntervals - myIntervals))
+            changed *= timespan
+            if changed:
+                changedAt = changed.start()
+            else:
+                changedAt = endTime
+            cur.execute("SELECT MIN(at) FROM connectionAttempt "
+                        "WHERE rowid > ?", (lastWatermark,))
+            firstNew, = cur.fetchone()
+            if firstNew is not None and firstNew < changedAt:
+                changedAt = firstNew
+            # The uptime or downtime we infer from an attempt starts at the
+            # previous attempt to the same server, so back up to the
+            # earliest such attempt.
+            changedAt = self._getEarliestLastAttempt(startTime, changedAt)
+
+        # We need to recompute every interval from the one containing
+        # changedAt.  To do so, we need each server's attempts from the last
+        # one before that interval.
+        if changedAt > startTime:
+            computeFrom = self._intervals.getIntervalContaining(changedAt)[0]
+        else:
+            computeFrom = startTime
+        calcIntervals = [ (s,e) for s,e in allIntervals if e > computeFrom ]
+        queryFrom = self._getEarliestLastAttempt(startTime, computeFrom)
+
+        cur.execute("SELECT server, at, success FROM connectionAttempt"
+                    " WHERE at >= ? AND at <= ?"
+                    " ORDER BY server, at",
+                    (queryFrom, endTime))
+        attempts = {}
+        for serverID, at, success in cur:
+            attempts.setdefault(serverID, []).append((at, success))
+
+        for serverID, serverAttempts in attempts.items():
             intervals = [[], []] #uptimes, downtimes
             lastStatus = None
             lastTime = None
-            for at, success in cur:
+            for at, success in serverAttempts:
                 assert success in (0,1)
                 upAt, downAt = myIntervals.getIntervalContaining(at)
                 #if upAt == None:
@@ -724,13 +768,34 @@ class PingLog:
             downIntervals *= myIntervals
             upIntervals *= myIntervals
 
-            for s,e,intervalID in calcIntervals:
-                uptime = (upIntervals*IntervalSet([(s,e)])).spanLength()
-                downtime = (downIntervals*IntervalSet([(s,e)])).spanLength()
+            uptimes = upIntervals.getSpanLengthsWithin(calcIntervals)
+            downtimes = downIntervals.getSpanLengthsWithin(calcIntervals)
+            for (s,e), uptime, downtime in zip(calcIntervals, uptimes,
+                                               downtimes):
                 if uptime < 1 and downtime < 1:
                     continue
                 fraction = float(uptime)/(uptime+downtime)
-                self._setUptime((intervalID, serverID), (fraction,))
+                self._setUptime((self._getIntervalID(s,e), serverID),
+                                (fraction,))
+
+        self._lastUptimeState = (watermark or 0, myIntervals, startTime)
+
+    def _getEarliestLastAttempt(self, startTime, t):
+        """Helper: consider every server we tried to connect to at or after
+           't'.  Return the earliest time, over all those servers, of our
+           last connection attempt between 'startTime' and 't'.  If there
+           were no such attempts, return 't'."""
+        cur = self._db.getCursor()
+        cur.execute("SELECT MIN(lastAt) FROM "
+                    "(SELECT MAX(at) AS lastAt FROM connectionAttempt"
+                    "  WHERE at >= ? AND at < ? AND server IN"
+                    "   (SELECT server FROM connectionAttempt WHERE at >= ?)"
+                    "  GROUP BY server)",
+                    (startTime, t, t))
+        lastAt, = cur.fetchone()
+        if lastAt is None:
+            return t
+        return lastAt
 
     def calculateUptimes(self, startAt, endAt, now=None):
         """Calculate the uptimes for all servers for all intervals between
@@ -782,37 +847,52 @@ class PingLog:
     _WEIGHT_AGE_PERIOD = 24*60*60
     _WEIGHT_AGE = [ 1, 2, 2, 3, 5, 8, 9, 10, 10, 10, 10, 5 ]
     _PING_GRANULARITY = 24*60*60
+    def _getOneHopIntervals(self, startTime, endTime, now,
+                            calculateOverallResults):
+        """Helper: return a list of the intervals for which
+           _calculateOneHopResult should compute results."""
+        if calculateOverallResults:
+            startTime = min(startTime,
+                       now - (len(self._WEIGHT_AGE)*self._WEIGHT_AGE_PERIOD))
+            endTime = max(endTime, now)
+        return self._intervals.getIntervals(startTime, endTime)
+
     def _calculateOneHopResult(self, serverIdentity, startTime, endTime,
-                                now=None, calculateOverallResults=1):
+                                now=None, calculateOverallResults=1,
+                                pings=None):
         """Calculate the latency and reliablity for a given server on
            intervals between startTime and endTime, inclusive.  If
            calculateOverallResults is true, also compute the current overall
            results for that server.
+
+           If 'pings' is provided, it is a list of (sentat, received) for
+           all the one-hop pings to this server over those intervals;
+           otherwise, we read them from the database.
         """
         # commit when done; serverName must exist.
         cur = self._db.getCursor()
         if now is None:
             now = time.time()
-        if calculateOverallResults:
-            startTime = min(startTime,
-                       now - (len(self._WEIGHT_AGE)*self._WEIGHT_AGE_PERIOD))
-            endTime = max(endTime, now)
-        intervals = self._intervals.getIntervals(startTime, endTime)
+        intervals = self._getOneHopIntervals(startTime, endTime, now,
+                                             calculateOverallResults)
         nPeriods = len(intervals)
         startTime = intervals[0][0]
         endTime = intervals[-1][1]
         serverID = self._getServerID(serverIdentity)
 
+        if pings is None:
+            cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
+                        " AND sentat >= ? AND sentat <= ?",
+                        (serverID, startTime, endTime))
+            pings = cur.fetchall()
+
         # 1. Compute latencies and number of pings sent in each period.
         #    We need to learn these first so we can tell the percentile
         #    of each ping's latency.
         dailyLatencies = [[] for _ in xrange(nPeriods)]
         nSent = [0]*nPeriods
         nPings = 0
-        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND sentat <= ?",
-                    (serverID, startTime, endTime))
-        for sent,received in cur:
+        for sent,received in pings:
             pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
             nSent[pIdx] += 1
             nPings += 1
@@ -842,10 +922,7 @@ class PingLog:
         nReceived = [0]*nPeriods
         perTotalWeights = [0]*nPeriods
         perTotalWeighted = [0]*nPeriods
-        cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND sentat <= ?",
-                    (serverID, startTime, endTime))
-        for sent,received in cur:
+        for sent,received in pings:
             pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
             if received:
                 nReceived[pIdx] += 1
@@ -914,12 +991,26 @@ class PingLog:
         if now is None:
             now = time.time()
         serverIdentities.sort()
+
+        # Read all the one-hop pings at once, rather than once per server.
+        intervals = self._getOneHopIntervals(now, now, now, 1)
+        cur = self._db.getCursor()
+        cur.execute("SELECT path, sentat, received FROM ping"
+                    " WHERE sentat >= ? AND sentat <= ?"
+                    " AND path NOT LIKE '%,%'",
+                    (intervals[0][0], intervals[-1][1]))
+        pingsByPath = {}
+        for path, sent, received in cur:
+            pingsByPath.setdefault(path, []).append((sent, received))
+
         reliability = {}
         for s in serverIdentities:
             if s in ('<self>','<unknown>'): continue
+            pings = pingsByPath.get(str(self._getServerID(s)), [])
             # For now, always calculate overall results.
             r = self._calculateOneHopResult(s,now,now,now,
-                                             calculateOverallResults=1)
+                                             calculateOverallResults=1,
+                                             pings=pings)
             reliability[s] = r
         self._db.getConnection().commit()
         self._lock.acquire()
@@ -928,54 +1019,72 @@ class PingLog:
         finally:
             self._lock.release()
 
-    def _calculate2ChainStatus(self, since, s1, s2, now=None):
+    def _calculate2ChainStatus(self, nSent, nReceived, nExpected):
         """Helper: Calculate the status (broken/interesting/both/neither) for
-           a chain of the servers 's1' and 's2' (given as identity digests),
-           considering pings sent since 'since'.  Return a tuple of (number of
-           pings sent, number of those pings received, is-broken,
-           is-interesting).  Does not commit the current transaction.
+           a two-hop chain, given the number of pings we have sent along it,
+           the number of those pings we have received, and the number of
+           those pings we would have expected to receive given the
+           one-hop reliability of its servers (or None if we have no
+           one-hop results for them).  Return a tuple of (is-broken,
+           is-interesting).
         """
-        # doesn't commit.
-        cur = self._db.getCursor()
-        path = "%s,%s"%(self._getServerID(s1),self._getServerID(s2))
-        cur.execute("SELECT count() FROM ping WHERE path = ?"
-                    " AND sentat >= ?",
-                    (path,self._db.time(since)))
-        nSent, = cur.fetchone()
-        cur.execute("SELECT count() FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND received > 0",
-                    (path,since))
-        nReceived, = cur.fetchone()
-        cur.execute("SELECT SUM(r1.reliability * r2.reliability) "
-                   "FROM ping, echolotOneHopResult as r1, "
-                   "   echolotOneHopResult as r2, statsInterval "
-                   "WHERE ping.path = ? AND ping.sentAt >= ? "
-                   "AND statsInterval.startAt <= ping.sentAt "
-                   "AND statsInterval.endAt >= ping.sentAt "
-                   "AND r1.server = ? "
-                   "AND r1.interval = statsInterval.id "
-                   "AND r2.server = ? "
-                   "AND r2.interval = statsInterval.id ",
-                    (path, self._db.time(since),
-                     self._getServerID(s1), self._getServerID(s2)))
-
-        nExpected, = cur.fetchone()
-
         isBroken = nSent >= 3 and nExpected and nReceived <= nExpected*0.3
 
         isInteresting = ((nSent < 3 and nReceived == 0) or
                          (nExpected and nReceived <= nExpected*0.3))
-        if 0:
-            if isInteresting:
-                if nSent < 3 and nReceived == 0:
-                    LOG.trace("%s,%s is interesting because %d were sent and %d were received",
-                              s1,s2, nSent, nReceived)
-                elif nExpected and nReceived <= nExpected*0.3:
-                    LOG.trace("%s,%s is interesting because we expected %s and got %s", s1, s2, nExpected, nReceived)
-                else:
-                    LOG.trace("I have no idea why %s,%s is interesting.",s1,s2)
 
-        return nSent, nReceived, isBroken, isInteresting
+        return isBroken, isInteresting
+
+    def _getTwoHopPingCounts(self, since):
+        """Helper: Return a map from the path of every two-hop chain we have
+           pinged since 'since' to a 3-tuple of: the number of pings we have
+           sent along that chain; the number of those pings we have received;
+           and the sum, over those pings, of the product of the one-hop
+           reliabilities of the chain's servers for the interval when the
+           ping was sent (or None if we have no such reliabilities).
+           Does not commit the current transaction.
+        """
+        cur = self._db.getCursor()
+        since = self._db.time(since)
+
+        # Learn the reliability of every server for every recent interval.
+        cur.execute("SELECT id, startAt, endAt FROM statsInterval"
+                    " WHERE endAt >= ? ORDER BY startAt", (since,))
+        intervals = cur.fetchall()
+        intervalStarts = [ s for _,s,_ in intervals ]
+        cur.execute("SELECT server, interval, reliability"
+                    " FROM echolotOneHopResult, statsInterval"
+                    " WHERE echolotOneHopResult.interval = statsInterval.id"
+                    " AND statsInterval.endAt >= ?", (since,))
+        reliability = {}
+        for serverID, intervalID, r in cur:
+            reliability[(serverID, intervalID)] = r
+
+        counts = {}
+        cur.execute("SELECT path, sentat, received FROM ping"
+                    " WHERE sentat >= ? AND path LIKE '%,%'", (since,))
+        for path, sent, received in cur:
+            serverIDs = path.split(",")
+            if len(serverIDs) != 2:
+                continue
+            s1, s2 = int(serverIDs[0]), int(serverIDs[1])
+            nSent, nReceived, nExpected = counts.get(path, (0, 0, None))
+            nSent += 1
+            if received > 0:
+                nReceived += 1
+            # Find every interval that contains 'sent'.
+            idx = bisect.bisect_right(intervalStarts, sent) - 1
+            for intervalID, s, e in intervals[max(idx-1,0):idx+1]:
+                if not (s <= sent <= e):
+                    continue
+                r1 = reliability.get((s1, intervalID))
+                r2 = reliability.get((s2, intervalID))
+                if r1 is None or r2 is None:
+                    continue
+                nExpected = (nExpected or 0) + r1*r2
+            counts[path] = (nSent, nReceived, nExpected)
+
+        return counts
 
     _CHAIN_PING_HORIZON = 12*ONE_DAY
     def calculateChainStatus(self, now=None):
@@ -993,14 +1102,17 @@ class PingLog:
         interestingChains = {}
         since = now - self._CHAIN_PING_HORIZON
         serverIdentities.sort()
+        counts = self._getTwoHopPingCounts(since)
 
         for s1 in serverIdentities:
             if s1 in ('<self>','<unknown>'): continue
             for s2 in serverIdentities:
                 if s2 == ('<self>','<unknown>'): continue
                 p = "%s,%s"%(s1,s2)
-                nS, nR, isBroken, isInteresting = \
-                    self._calculate2ChainStatus(since, s1, s2)
+                path = "%s,%s"%(self._getServerID(s1),self._getServerID(s2))
+                nS, nR, nExpected = counts.get(path, (0, 0, None))
+                isBroken, isInteresting = \
+                    self._calculate2ChainStatus(nS, nR, nExpected)
                 if isBroken:
                     brokenChains[p] = 1
                 if isInteresting:
@@ -1127,7 +1239,7 @@ class PingLog:
             self.dumpAllStatus(f, now-24*60*60*12, now)
             f.close()
         LOG.info("Done computing ping results")
-        self.lastCalculation = now
+        self._lastRecalculation = now
 
 class PingGenerator:
     """Abstract class: A PingGenerator periodically sends traffic into the
@@ -11,6 +11,7 @@ import os
 
 import mixminion.Config
 import mixminion.server.Modules
+import mixminion.server.PacketHandler
 from mixminion.Config import ConfigError
 from mixminion.Common import LOG
 
@@ -64,6 +65,12 @@ class ServerConfig(mixminion.Config._ConfigFile):
         if server['PublicKeyOverlap'].getSeconds() > 72*60*60:
             raise ConfigError("PublicKeyOverlap must be <= 72 hours")
 
+        workers = server['PacketWorkers']
+        if workers < 0:
+            raise ConfigError("PacketWorkers must be nonnegative.")
+        if workers and not mixminion.server.PacketHandler.canUseWorkers():
+            raise ConfigError("PacketWorkers requires Python 2.6 or later.")
+
         if _haveEntry(self, 'Server', 'Mode'):
             LOG.warn("Mode specification is not yet supported.")
 
@@ -94,9 +101,18 @@ class ServerConfig(mixminion.Config._ConfigFile):
         if [e for e in self._sectionEntries['Outgoing/MMTP']
             if e[0] in ('Allow', 'Deny')]:
             LOG.warn("Allow/deny are not yet supported")
+        cs = self['Incoming/MMTP'].get('SessionCacheSize')
+        if cs is not None and cs < 0:
+            raise ConfigError("SessionCacheSize must not be negative.")
         mc = self['Outgoing/MMTP'].get('MaxConnections')
         if mc is not None and mc < 1:
             raise ConfigError("MaxConnections must be at least 1.")
+        sw = self['Outgoing/MMTP'].get('SendWindow')
+        if sw is not None and sw < 1:
+            raise ConfigError("SendWindow must be at least 1.")
+        mi = self['Outgoing/MMTP'].get('MaxIdleConnections')
+        if mi is not None and mi < 0:
+            raise ConfigError("MaxIdleConnections must not be negative.")
         bw = self['Outgoing/MMTP'].get('MaxBandwidth')
         if bw is not None and bw < 4096:
             #XXXX007 this is completely arbitrary. :P
@@ -356,6 +372,8 @@ SERVER_SYNTAX =  {
 		     'Timeout' : ('ALLOW', "interval", "5 min"),
                      'MaxBandwidth' : ('ALLOW', "size", None),
                      'MaxBandwidthSpike' : ('ALLOW', "size", None),
+                     'PacketWorkers' : ('ALLOW', "int", "0"),
+                     'QueueManifest' : ('ALLOW', "boolean", "no"),
                      },
         #DOCDOC
         'Pinging' : { 'Enabled' : ('ALLOW', 'boolean', 'yes'),
@@ -384,6 +402,9 @@ SERVER_SYNTAX =  {
                           'ListenIP' : ('ALLOW', "IP", None),
                           'ListenPort' : ('ALLOW', "int", None),
                           'ListenIP6' : ('ALLOW', "IP6", None),
+                          'SessionCacheSize' : ('ALLOW', "int", "0"),
+                          'SessionLifetime' : ('ALLOW', "interval",
+                                               "10 minutes"),
   		          'Allow' : ('ALLOW*', "addressSet_allow", None),
                           'Deny' : ('ALLOW*', "addressSet_deny", None)
 			 },
@@ -391,6 +412,11 @@ SERVER_SYNTAX =  {
                             'Retry' : ('ALLOW', "intervalList",
                               "every 1 hour for 1 day, 7 hours for 5 days"),
                            'MaxConnections' : ('ALLOW', 'int', '16'),
+                           'SendWindow' : ('ALLOW', 'int', '6'),
+                           'MaxIdleTime' : ('ALLOW', 'interval', None),
+                           'MaxIdleConnections' : ('ALLOW', 'int', '8'),
+                           'SegmentedQueue' : ('ALLOW', 'boolean', 'no'),
+                           'ResumeSessions' : ('ALLOW', 'boolean', 'no'),
                            'Allow' : ('ALLOW*', "addressSet_allow", None),
                            'Deny' : ('ALLOW*', "addressSet_deny", None) },
         # FFFF Missing: Queue-Size / Queue config options
@@ -504,10 +504,18 @@ class ServerKeyring:
                           self.nickname, certStarts, certEnds)
         replaceFile(tmpName, self.certFile)
 
+        cacheSize = self.config['Incoming/MMTP'].get('SessionCacheSize', 0)
+        lifetime = self.config['Incoming/MMTP'].get('SessionLifetime')
+        if lifetime:
+            lifetime = int(lifetime.getSeconds())
+        else:
+            lifetime = 0
         self._tlsContext = (
                     mixminion._minionlib.TLSContext_new(self.certFile,
                                                         mmtpKey,
-                                                        self._getDHFile()))
+                                                        self._getDHFile(),
+                                                        cacheSize,
+                                                        lifetime))
         self._tlsContextExpires = expires
         return self._tlsContext
 
@@ -722,8 +730,10 @@ class ServerKeyset:
             self.serverinfo = ServerInfo(fname=self.descFile)
         return self.serverinfo
     def getHashLog(self):
+        validAfter, validUntil = self.getLiveness()
         return mixminion.server.HashLog.getHashLog(
-            self.getHashLogFileName(), self.getPacketKeyID())
+            self.getHashLogFileName(), self.getPacketKeyID(),
+            validUntil-validAfter)
     def getLiveness(self):
         """Return a 2-tuple of validAfter/validUntil for this server."""
         if self.validAfter is None or self.validUntil is None:
@@ -77,8 +77,9 @@ from mixminion.ScheduleUtils import OneTimeEvent, RecurringEvent, \
 from bisect import insort
 from mixminion.Common import LOG, LogStream, MixError, MixFatalError,\
      UIError, ceilDiv, createPrivateDir, disp64, formatTime, \
-     installSIGCHLDHandler, Lockfile, LockfileLocked, readFile, secureDelete, \
-     succeedingMidnight, tryUnlink, waitForChildren, writeFile
+     getSecureDeleteStats, installSIGCHLDHandler, Lockfile, LockfileLocked, \
+     readFile, secureDelete, succeedingMidnight, tryUnlink, waitForChildren, \
+     writeFile
 
 # Version number for server home-directory.
 #
@@ -156,10 +157,12 @@ class IncomingQueue(mixminion.Filestore.StringStore):
     # mixPool -- an instance of MixPool
     # processingThread -- an instance of ProcessingThread
     # pingLog -- an instance of pingLog, or None
-    def __init__(self, location, packetHandler):
+    def __init__(self, location, packetHandler, manifest=0):
         """Create an IncomingQueue that stores its packets in <location>
-           and processes them through <packetHandler>."""
-        mixminion.Filestore.StringStore.__init__(self, location, create=1)
+           and processes them through <packetHandler>.  If 'manifest' is
+           true, keep a manifest of the queue's packets."""
+        mixminion.Filestore.StringStore.__init__(self, location, create=1,
+                                                 manifest=manifest)
         self.packetHandler = packetHandler
         self.mixPool = None
         self.pingLog = None
@@ -194,11 +197,30 @@ class IncomingQueue(mixminion.Filestore.StringStore):
     def __deliverPacket(self, handle):
         """Process a single packet with a given handle, and insert it into
            the Mix pool.  This function is called from within the processing
-           thread."""
+           thread.  If the packet handler has worker processes, we only
+           hand the packet off to a worker here, and finish processing it
+           once the worker is done."""
         ph = self.packetHandler
         packet = self.messageContents(handle)
+        if ph.usesWorkers():
+            def onResult(getResult, self=self, handle=handle):
+                # Invoked from the worker pool: get back to the processing
+                # thread to check the hashlog and queue the packet.
+                self.processingThread.addJob(
+                    lambda self=self, handle=handle, getResult=getResult:
+                        self.__finishPacket(handle, getResult))
+            ph.processPacketInWorker(packet, onResult)
+        else:
+            self.__finishPacket(handle,
+                         lambda ph=ph, packet=packet: ph.processPacket(packet))
+
+    def __finishPacket(self, handle, getResult):
+        """Given a handle for a packet in this queue, and a no-arguments
+           function that returns the result of PacketHandler.processPacket
+           for that packet, insert the processed packet into the Mix pool.
+           This function is called from within the processing thread."""
         try:
-            res = ph.processPacket(packet)
+            res = getResult()
             if res is None:
                 # Drop padding before it gets to the mix.
                 LOG.debug("Padding packet IN:%s dropped", handle)
@@ -255,19 +277,22 @@ class MixPool:
 
         server = config['Server']
         interval = server['MixInterval'].getSeconds()
+        manifest = server.get('QueueManifest')
         if server['MixAlgorithm'] == 'TimedMixPool':
             self.queue = mixminion.server.ServerQueue.TimedMixPool(
-                location=queueDir, interval=interval)
+                location=queueDir, interval=interval, manifest=manifest)
         elif server['MixAlgorithm'] == 'CottrellMixPool':
             self.queue = mixminion.server.ServerQueue.CottrellMixPool(
                 location=queueDir, interval=interval,
                 minPool=server.get("MixPoolMinSize", 5),
-                sendRate=server.get("MixPoolRate", 0.6))
+                sendRate=server.get("MixPoolRate", 0.6),
+                manifest=manifest)
         elif server['MixAlgorithm'] == 'BinomialCottrellMixPool':
             self.queue = mixminion.server.ServerQueue.BinomialCottrellMixPool(
                 location=queueDir, interval=interval,
                 minPool=server.get("MixPoolMinSize", 5),
-                sendRate=server.get("MixPoolRate", 0.6))
+                sendRate=server.get("MixPoolRate", 0.6),
+                manifest=manifest)
         else:
             raise MixFatalError("Got impossible mix pool type from config")
 
@@ -290,6 +315,10 @@ class MixPool:
         "Return the number of packets in the pool"
         return self.queue.count()
 
+    def close(self):
+        "Release any resources held by the underlying pool"
+        self.queue.close()
+
     def connectQueues(self, outgoing, manager):
         """Sets the queue for outgoing mixminion packets, and the
            module manager for deliverable packets."""
@@ -345,10 +374,13 @@ class OutgoingQueue(mixminion.server.ServerQueue.PerAddressDeliveryQueue):
     #        self->self communication.
     # pingGenerator -- the pingGenerator that may want to add link padding
     #        to outgoing packet sets, or None.
-    def __init__(self, location, keyID):
+    def __init__(self, location, keyID, segmented=0, manifest=0):
         """Create a new OutgoingQueue that stores its packets in a given
-           location."""
-        mixminion.server.ServerQueue.PerAddressDeliveryQueue.__init__(self, location)
+           location.  If 'segmented' is true, keep the packets in segment
+           files rather than one file apiece.  Otherwise, if 'manifest' is
+           true, keep a manifest of the packets."""
+        mixminion.server.ServerQueue.PerAddressDeliveryQueue.__init__(
+            self, location, segmented=segmented, manifest=manifest)
         self.server = None
         self.incomingQueue = None
         self.pingGenerator = None
@@ -484,9 +516,21 @@ class CleaningThread(threading.Thread):
                     else:
                         LOG.warn("Delete thread didn't find file %s",fn)
 
+                before = getSecureDeleteStats()
                 secureDelete(delNames, blocking=1)
-
-            LOG.info("Cleanup thread shutting down.")
+                after = getSecureDeleteStats()
+                if after[0] > before[0]:
+                    nBytes = after[1]-before[1]
+                    secs = after[2]-before[2]
+                    LOG.debug("Deleted %s files (%s KB) in %.2f sec",
+                              after[0]-before[0], nBytes>>10, secs)
+
+            files, nBytes, secs = getSecureDeleteStats()
+            if files:
+                LOG.info("Cleanup thread shutting down; deleted %s files "
+                         "(%s KB) in %.2f sec.", files, nBytes>>10, secs)
+            else:
+                LOG.info("Cleanup thread shutting down.")
         except:
             LOG.error_exc(sys.exc_info(),
                           "Exception while cleaning; shutting down thread.")
@@ -612,7 +656,8 @@ class MixminionServer(Scheduler):
             self.keyring.publishKeys()
 
         LOG.debug("Initializing packet handler")
-        self.packetHandler = mixminion.server.PacketHandler.PacketHandler()
+        self.packetHandler = mixminion.server.PacketHandler.PacketHandler(
+            nWorkers=config['Server'].get('PacketWorkers', 0))
         LOG.debug("Initializing MMTP server")
         self.mmtpServer = _MMTPServer(config, None)
         LOG.debug("Initializing keys")
@@ -643,7 +688,8 @@ class MixminionServer(Scheduler):
 
         incomingDir = os.path.join(queueDir, "incoming")
         LOG.debug("Initializing incoming queue")
-        self.incomingQueue = IncomingQueue(incomingDir, self.packetHandler)
+        self.incomingQueue = IncomingQueue(incomingDir, self.packetHandler,
+                           manifest=config['Server'].get('QueueManifest'))
         LOG.debug("Found %d pending packets in incoming queue",
                   self.incomingQueue.count())
 
@@ -657,7 +703,9 @@ class MixminionServer(Scheduler):
         outgoingDir = os.path.join(queueDir, "outgoing")
         LOG.debug("Initializing outgoing queue")
         self.outgoingQueue = OutgoingQueue(outgoingDir,
-                                   self.keyring.getIdentityKeyDigest())
+                   self.keyring.getIdentityKeyDigest(),
+                   segmented=config['Outgoing/MMTP'].get('SegmentedQueue'),
+                   manifest=config['Server'].get('QueueManifest'))
         self.outgoingQueue.configure(config)
         LOG.debug("Found %d pending packets in outgoing queue",
                        self.outgoingQueue.count())
@@ -979,6 +1027,8 @@ class MixminionServer(Scheduler):
 
         self.packetHandler.close()
         self.moduleManager.close()
+        self.incomingQueue.close()
+        self.mixPool.close()
         self.outgoingQueue.close()
         if self.pingLog:
             if hasattr(self.pingLog, '_baseObject'):
@@ -5,6 +5,7 @@
    Facilities for retriable delivery queues, and for mix pools.
    """
 
+import bisect
 import cPickle
 import math
 import os
@@ -57,6 +58,16 @@ def _calculateNext(lastAttempt, firstAttempt, retrySchedule, canDrop, now):
                     retrySchedule[-1])
         return attempt
 
+def _popDueEntries(schedule, now):
+    """Helper: given a sorted list of (time, item) tuples, remove and return
+       the ones whose time is no later than 'now'."""
+    n = 0
+    while n < len(schedule) and schedule[n][0] <= now:
+        n += 1
+    due = schedule[:n]
+    del schedule[:n]
+    return due
+
 class _DeliveryState:
     """Helper class: holds the state needed to schedule delivery or
        eventual abandonment of a message in a DeliveryQueue."""
@@ -211,20 +222,37 @@ class DeliveryQueue:
     """
     ###
     # Fields:
-    #   store -- An ObjectMetadataStore to back this queue.  The objects
+    #   store -- An ObjectMetadataStore or SegmentedMetadataStore to back
+    #      this queue.  The objects
     #      are instances of whatever deliverable object this queue contains;
     #      the metadata are instances of _DeliveryState.
     #   retrySchedule -- a list of intervals at which delivery of messages
     #      should be reattempted, as described in "setRetrySchedule".
     #   _lock -- a reference to the RLock used to control access to the
     #      store.
-    def __init__(self, location, retrySchedule=None, now=None, name=None):
+    #   _schedule -- a sorted list of (nextAttempt, handle) tuples, so that
+    #      we can find the messages that are ready for delivery without
+    #      looking at every message in the queue.  Every message that we
+    #      aren't currently sending has an entry.  Entries can be stale:
+    #      the message may have been removed or rescheduled since we added
+    #      the entry, so we check each one against the message's state when
+    #      we reach it.  Messages that have expired have a nextAttempt of
+    #      None, which sorts before every time.
+    def __init__(self, location, retrySchedule=None, now=None, name=None,
+                 segmented=0, manifest=0):
         """Create a new DeliveryQueue object that stores its files in
            <location>.  If retrySchedule is provided, it is interpreted as
            in setRetrySchedule.  Name, if present, is a human-readable
-           name used in log messages."""
-        self.store = mixminion.Filestore.ObjectMetadataStore(
-            location,create=1,scrub=1)
+           name used in log messages.  If segmented is true, we keep the
+           messages in a SegmentedMetadataStore instead of one file
+           apiece.  Otherwise, if manifest is true, the store keeps a
+           manifest of its messages."""
+        if segmented:
+            self.store = mixminion.Filestore.SegmentedMetadataStore(
+                location,create=1,scrub=1)
+        else:
+            self.store = mixminion.Filestore.ObjectMetadataStore(
+                location,create=1,scrub=1,manifest=manifest)
         self._lock = self.store._lock
         if name is None:
             self.qname = os.path.split(location)[1]
@@ -294,10 +322,22 @@ class DeliveryQueue:
         else:
             rs = self.retrySchedule
 
-        for ds in self.store._metadata_cache.values():
+        schedule = []
+        for h, ds in self.store._metadata_cache.items():
             ds.setNextAttempt(rs, now)
+            if not ds.isPending():
+                schedule.append((ds.nextAttempt, h))
+        schedule.sort()
+        self._schedule = schedule
         self._repOK()
 
+    def _scheduleMessage(self, handle, ds):
+        """Helper: note that the message 'handle', whose _DeliveryState is
+           'ds', is waiting to be delivered at ds.nextAttempt.
+
+           Callers must hold self._lock."""
+        bisect.insort(self._schedule, (ds.nextAttempt, handle))
+
     def _repOK(self):
         """Raise an assertion error if the internal state of this object is
            nonsensical."""
@@ -324,6 +364,7 @@ class DeliveryQueue:
             ds = _DeliveryState(now,None,address)
             ds.setNextAttempt(self.retrySchedule, now)
             handle = self.store.queueObjectAndMetadata(msg, ds)
+            self._scheduleMessage(handle, ds)
             LOG.trace("DeliveryQueue got message %s for %s",
                       handle, self.qname)
         finally:
@@ -358,7 +399,6 @@ class DeliveryQueue:
         """Sends all messages which are not already being sent, and which
            are scheduled to be sent."""
         assert self.retrySchedule is not None
-        self._repOK()
         if now is None:
             now = time.time()
         LOG.trace("DeliveryQueue checking for deliverable messages in %s",
@@ -366,12 +406,15 @@ class DeliveryQueue:
         try:
             self._lock.acquire()
             messages = []
-            for h in self.store._metadata_cache.keys():
+            for when, h in _popDueEntries(self._schedule, now):
                 try:
                     state = self.store.getMetadata(h)
-                except CorruptedFile:
+                except (KeyError, CorruptedFile):
                     continue
-                if state.isPending():
+                if state.nextAttempt != when:
+                    # This entry is stale; the message has been rescheduled.
+                    continue
+                elif state.isPending():
                     #LOG.trace("     [%s] is pending delivery", h)
                     continue
                 elif state.isRemovable():
@@ -392,7 +435,6 @@ class DeliveryQueue:
             self._lock.release()
 
         self._deliverMessages(messages)
-        self._repOK()
 
     def _deliverMessages(self, msgList):
         """Abstract method; Invoked with a list of PendingMessage objects
@@ -458,6 +500,7 @@ class DeliveryQueue:
                 ds = _DeliveryState(now)
                 ds.setNextAttempt(self.retrySchedule, now)
                 self.store.setMetadata(handle, ds)
+                self._scheduleMessage(handle, ds)
                 return
 
             if not ds.isPending():
@@ -480,6 +523,7 @@ class DeliveryQueue:
                               formatTime(ds.nextAttempt, 1))
 
                     self.store.setMetadata(handle, ds)
+                    self._scheduleMessage(handle, ds)
                     return
                 else:
                     assert ds.isRemovable()
@@ -587,15 +631,32 @@ class PerAddressDeliveryQueue(DeliveryQueue):
     # correctly: most (all?) MTAs use a retry algorithm equivalent to
     # this one.
 
-    # DOCDOC 
-    def __init__(self, location, retrySchedule=None, now=None, name=None):
+    ## Fields:
+    # addressStateDB -- a WritethroughDict mapping str(address) to the
+    #    _AddressState for each address.
+    # totalLifetime -- the number of seconds for which we keep a message
+    #    before giving up on it.
+    # _addrSchedule -- a sorted list of (nextAttempt, str(address)) tuples
+    #    for the addresses that have messages waiting, so that we can find
+    #    the addresses that are ready for delivery without looking at every
+    #    message.  Entries can be stale; see _scheduledAt.
+    # _scheduledAt -- map from str(address) to the nextAttempt in that
+    #    address's current entry in _addrSchedule.
+    # _waiting -- map from str(address) to a map from handle to 1 for every
+    #    message to that address that we aren't currently sending.  (May
+    #    hold handles of messages that have since been removed.)
+    # _expirySchedule -- a sorted list of (queuedTime, handle) tuples for
+    #    every message that we aren't currently sending.
+    def __init__(self, location, retrySchedule=None, now=None, name=None,
+                 segmented=0, manifest=0):
         self.addressStateDB = mixminion.Filestore.WritethroughDict(
             filename=os.path.join(location,"addressStatus.db"),
             purpose="address state")
         if retrySchedule is None:
             retrySchedule = [3600]
         DeliveryQueue.__init__(self, location=location,
-                               retrySchedule=retrySchedule, now=now, name=name)
+                               retrySchedule=retrySchedule, now=now, name=name,
+                               segmented=segmented, manifest=manifest)
 
     def sync(self):
         self._lock.acquire()
@@ -626,10 +687,47 @@ class PerAddressDeliveryQueue(DeliveryQueue):
                 self.totalLifetime = reduce(operator.add,self.retrySchedule,0)
             for addr_state in self.addressStateDB.values():
                 addr_state.setNextAttempt(rs, now)
+
+            self._addrSchedule = []
+            self._scheduledAt = {}
+            self._waiting = {}
+            self._expirySchedule = []
+            for h, ds in self.store._metadata_cache.items():
+                if not ds.isPending():
+                    self._waiting.setdefault(str(ds.address), {})[h] = 1
+                    self._expirySchedule.append((ds.queuedTime, h))
+            self._expirySchedule.sort()
+            for k in self._waiting.keys():
+                when = self.addressStateDB[k].nextAttempt
+                self._addrSchedule.append((when, k))
+                self._scheduledAt[k] = when
+            self._addrSchedule.sort()
             self._repOK()
         finally:
             self._lock.release()
 
+    def _scheduleMessage(self, handle, ds):
+        """Helper: note that the message 'handle', whose _DeliveryState is
+           'ds', is waiting for its address to be ready.
+
+           Callers must hold self._lock."""
+        self._waiting.setdefault(str(ds.address), {})[handle] = 1
+        bisect.insort(self._expirySchedule, (ds.queuedTime, handle))
+        self._scheduleAddress(ds.address)
+
+    def _scheduleAddress(self, address):
+        """Helper: if any messages are waiting for 'address', make sure that
+           _addrSchedule has an entry for its current nextAttempt.
+
+           Callers must hold self._lock."""
+        k = str(address)
+        if not self._waiting.get(k):
+            return
+        when = self._getAddressState(address).nextAttempt
+        if self._scheduledAt.get(k) != when:
+            self._scheduledAt[k] = when
+            bisect.insort(self._addrSchedule, (when, k))
+
     def removeExpiredMessages(self, now=None):
         """DOCDOC"""
         assert self.retrySchedule is not None
@@ -670,10 +768,14 @@ class PerAddressDeliveryQueue(DeliveryQueue):
         self._lock.acquire()
         try:
             messages = []
-            for h in self.store._metadata_cache.keys():
+            # First, remove the messages that have been around too long.
+            # (We check pending messages again once they fail.)
+            expired = _popDueEntries(self._expirySchedule,
+                                     now - self.totalLifetime)
+            for queuedTime, h in expired:
                 try:
                     state = self.store.getMetadata(h)
-                except CorruptedFile:
+                except (KeyError, CorruptedFile):
                     continue
                 if state.isPending():
                     #LOG.trace("     [%s] is pending delivery", h)
@@ -681,17 +783,30 @@ class PerAddressDeliveryQueue(DeliveryQueue):
                 elif state.queuedTime + self.totalLifetime < now:
                     #LOG.trace("     [%s] is expired", h)
                     self.removeMessage(h)
+                else:
+                    self._expirySchedule.insert(0, (queuedTime, h))
+
+            # Then, send every waiting message to every address that's ready.
+            for when, k in _popDueEntries(self._addrSchedule, now):
+                if self._scheduledAt.get(k) != when:
+                    # This entry is stale; the address has been rescheduled.
+                    continue
+                del self._scheduledAt[k]
+                handles = self._waiting.get(k)
+                if not handles:
                     continue
-                addressState = self._getAddressState(state.address, now)
-                if addressState.nextAttempt <= now:
+                del self._waiting[k]
+                for h in handles.keys():
+                    try:
+                        state = self.store.getMetadata(h)
+                    except (KeyError, CorruptedFile):
+                        continue
+                    if state.isPending():
+                        continue
                     #LOG.trace("     [%s] is ready for next attempt on %s", h,
                     #          state.address)
                     messages.append(PendingMessage(h,self,state.address))
                     state.setPending(now)
-                else:
-                    #LOG.trace("     [%s] will wait for next attempt on %s",h,
-                    #          state.address)
-                    continue
         finally:
             self._lock.release()
 
@@ -703,6 +818,8 @@ class PerAddressDeliveryQueue(DeliveryQueue):
 
     def close(self):
         self.addressStateDB.close()
+        if hasattr(self.store, 'close'):
+            self.store.close()
 
     def deliverySucceeded(self, handle, now=None):
         assert self.retrySchedule is not None
@@ -721,6 +838,8 @@ class PerAddressDeliveryQueue(DeliveryQueue):
                 self.addressStateDB[str(mState.address)] = aState
 
             self.removeMessage(handle)
+            if mState:
+                self._scheduleAddress(mState.address)
         finally:
             self._lock.release()
 
@@ -757,6 +876,10 @@ class PerAddressDeliveryQueue(DeliveryQueue):
             aState.failed(attempt=last,now=now)
             aState.setNextAttempt(self.retrySchedule,now=now)
             self.addressStateDB[str(aState.address)] = aState # flush to db.
+            if retriable:
+                self._scheduleMessage(handle, mState)
+            else:
+                self._scheduleAddress(mState.address)
         finally:
             self._lock.release()
 
@@ -791,11 +914,12 @@ class TimedMixPool(mixminion.Filestore.ObjectStore):
        of messages every N seconds."""
     ## Fields:
     #   interval: scanning interval, in seconds.
-    def __init__(self, location, interval=600):
+    def __init__(self, location, interval=600, manifest=0):
         """Create a TimedMixPool that sends its entire batch of messages
-           every 'interval' seconds."""
+           every 'interval' seconds.  If 'manifest' is true, keep a
+           manifest of the pool's messages."""
         mixminion.Filestore.ObjectStore.__init__(
-            self, location, create=1, scrub=1)
+            self, location, create=1, scrub=1, manifest=manifest)
         self.interval = interval
 
     def getBatch(self):
@@ -817,7 +941,7 @@ class CottrellMixPool(TimedMixPool):
     #      sending.
     # sendRate: Largest fraction of the pool to send at a time.
     def __init__(self, location, interval=600, minPool=6, minSend=1,
-                 sendRate=.7):
+                 sendRate=.7, manifest=0):
         """Create a new queue that yields a batch of message every 'interval'
            seconds, always keeps <minPool> messages in the pool, never sends
            unless it has <minPool>+<minSend> messages, and never sends more
@@ -839,7 +963,7 @@ class CottrellMixPool(TimedMixPool):
         # *THIS* is the algorithm that the current 'Batching Taxonomy' paper
         # says that Cottrell says is the real thing.
 
-        TimedMixPool.__init__(self, location, interval)
+        TimedMixPool.__init__(self, location, interval, manifest)
         self.minPool = minPool
         self.minSend = minSend
         self.sendRate = sendRate
@@ -12,12 +12,14 @@
 __pychecker__ = 'no-funcdoc maxlocals=100'
 
 import base64
+import binascii
 import cPickle
 import cStringIO
 import gzip
 import operator
 import os
 import re
+import select
 import socket
 import stat
 import struct
@@ -505,6 +507,15 @@ class MiscTests(TestCase):
                 checkEq((a-b)*(b-a), nil)
                 checkEq((a-b)+(b-a)+a*b, a+b)
 
+        ## getSpanLengthsWithin
+        spans = [(0,3),(3,9),(9,14),(14,26),(30,40),(50,60)]
+        for a in (fromPrimeToPrime, fromSquareToSquare, fromFibToFib, oneToTen,
+                  fifteenToFifty, nil):
+            eq(a.getSpanLengthsWithin(spans),
+               [ (a*IntervalSet([sp])).spanLength() for sp in spans ])
+        eq(fromSquareToSquare.getSpanLengthsWithin(spans), [2,1,5,3,6,0])
+        eq(nil.getSpanLengthsWithin([]), [])
+
         ## Contains / getIntervalContaining
         t = self.assert_
         # 1. With nil
@@ -837,6 +848,38 @@ World!
             self.assertEquals(lst, tst)
             tst.append("unterminated line")
 
+    def test_secureDelete(self):
+        d = mix_mktemp()
+        createPrivateDir(d)
+        names = [ os.path.join(d, str(i)) for i in range(10) ]
+        for i in range(10):
+            writeFile(names[i], "x"*(i*1000), binary=1)
+
+        oldCmd = mixminion.Common._SHRED_CMD
+        mixminion.Common.configureShredCommand(None)
+        try:
+            files, nBytes, _ = getSecureDeleteStats()
+            # Blocking deletes happen before we return.
+            secureDelete(names[:5], blocking=1)
+            for fn in names[:5]:
+                self.failIf(os.path.exists(fn))
+            self.assert_(os.path.exists(names[5]))
+            files2, nBytes2, _ = getSecureDeleteStats()
+            self.assertEquals(files2, files+5)
+            # We round up to the nearest block.
+            self.assert_(nBytes2 - nBytes >= 1000+2000+3000+4000)
+            # Nonblocking deletes are done once we wait for them.
+            secureDelete(names[5:], blocking=0)
+            waitForChildren()
+            for fn in names:
+                self.failIf(os.path.exists(fn))
+            self.assertEquals(getSecureDeleteStats()[0], files+10)
+            # Missing files are no problem.
+            secureDelete(names[:2], blocking=1)
+            self.assertEquals(getSecureDeleteStats()[0], files+10)
+        finally:
+            mixminion.Common._SHRED_CMD = oldCmd
+
 #----------------------------------------------------------------------
 
 class MinionlibCryptoTests(TestCase):
@@ -923,6 +966,70 @@ class MinionlibCryptoTests(TestCase):
         # ...or a long string.
         self.failUnlessRaises(TypeError, _ml.aes_key, "a"*17)
 
+    def test_sprp(self):
+        sha1 = _ml.sha1
+        xor = _ml.strxor
+        def ctr(s, k):
+            return _ml.aes_ctr128_crypt(_ml.aes_key(k[:16]), s, 0)
+        keys = ("ABCDE"*4, "ABCDF"*4, "DECBA"*4, "VWXYZ"*4)
+        plain = "The more it snows the more it goes on snowing"*100
+
+        # Walk through LIONESS step by step.
+        left, right = plain[:20], plain[20:]
+        right = ctr(right, sha1(keys[0]+left+keys[0]))
+        left = xor(left, sha1(keys[1]+right+keys[1]))
+        right = ctr(right, sha1(keys[2]+left+keys[2]))
+        left = xor(left, sha1(keys[3]+right+keys[3]))
+        enc = _ml.lioness_encrypt(plain, keys)
+        self.assertEquals(enc, left+right)
+        self.assertEquals(_ml.lioness_decrypt(enc, keys), plain)
+        self.assertEquals(plain[:20], "The more it snows th")
+
+        # Walk through BEAR step by step.
+        left, right = plain[:20], plain[20:]
+        left = xor(left, sha1(keys[0]+right+keys[0]))
+        right = ctr(right, sha1(left))
+        left = xor(left, sha1(keys[1]+right+keys[1]))
+        enc = _ml.bear_encrypt(plain, keys[:2])
+        self.assertEquals(enc, left+right)
+        self.assertEquals(_ml.bear_decrypt(enc, keys[:2]), plain)
+
+        # In-place versions on a writable buffer.
+        import array
+        a = array.array('c', plain)
+        _ml.sprp_crypt_inplace(a, keys)
+        self.assertEquals(a.tostring(), _ml.lioness_encrypt(plain, keys))
+        _ml.sprp_crypt_inplace(a, keys, 0)
+        self.assertEquals(a.tostring(), plain)
+        _ml.sprp_crypt_inplace(a, keys[:2], 1)
+        self.assertEquals(a.tostring(), _ml.bear_encrypt(plain, keys[:2]))
+        _ml.sprp_crypt_inplace(a, keys[:2], 0)
+        self.assertEquals(a.tostring(), plain)
+        # ...and on part of a buffer.
+        _ml.sprp_crypt_inplace(a, keys, 1, 100, 2000)
+        self.assertEquals(a.tostring(), plain[:100] +
+                          _ml.lioness_encrypt(plain[100:2100], keys) +
+                          plain[2100:])
+        _ml.sprp_crypt_inplace(a, keys, 0, 100, 2000)
+        self.assertEquals(a.tostring(), plain)
+        _ml.sprp_crypt_inplace(a, keys[:2], 1, 4000)
+        self.assertEquals(a.tostring(), plain[:4000] +
+                          _ml.bear_encrypt(plain[4000:], keys[:2]))
+        _ml.sprp_crypt_inplace(a, keys[:2], 0, 4000)
+        self.assertEquals(a.tostring(), plain)
+
+        # Bad arguments.
+        self.failUnlessRaises(TypeError, _ml.lioness_encrypt, plain, keys[:3])
+        self.failUnlessRaises(TypeError, _ml.lioness_encrypt, plain,
+                              ("X",)*4)
+        self.failUnlessRaises(TypeError, _ml.bear_decrypt, "X"*20, keys[:2])
+        self.failUnlessRaises(TypeError, _ml.sprp_crypt_inplace, plain, keys)
+        self.failUnlessRaises(TypeError, _ml.sprp_crypt_inplace, a, keys[:3])
+        self.failUnlessRaises(TypeError, _ml.sprp_crypt_inplace, a, keys, 1,
+                              len(plain)+1)
+        self.failUnlessRaises(TypeError, _ml.sprp_crypt_inplace, a, keys, 1,
+                              100, len(plain))
+
     def test_openssl_seed(self):
         # Just try seeding openssl a couple of times, and make sure it
         # doesn't crash.
@@ -1118,6 +1225,78 @@ class MinionlibFECTests(TestCase):
         self.assertRaises(_ml.FECError,fec.decode, cInp[:-1])
         self.assertRaises(_ml.FECError,fec.decode, cInp[0:2]+[2,'x'])
 
+        self.assertRaises(_ml.FECError,fec.encodeChunks, 5)
+        self.assertRaises(_ml.FECError,fec.encodeChunks, [inp, inp[0:2]])
+        self.assertRaises(_ml.FECError,fec.encodeChunks, [inp[0:2]+[3]])
+        self.assertRaises(_ml.FECError,fec.decodeChunks, 5)
+        self.assertRaises(_ml.FECError,fec.decodeChunks, [cInp[2:5], cInp])
+        self.assertRaises(_ml.FECError,fec.decodeChunks,
+                          [cInp[2:5], cInp[2:4]+[cInp[2]]])
+
+    def test_fec_chunks(self):
+        r = getCommonPRNG()
+        eq = self.assertEquals
+        fec = _ml.FEC_generate(4,6)
+        eq([], fec.encodeChunks([]))
+        eq([], fec.decodeChunks([]))
+
+        # Chunks can have different block sizes.
+        chunks = [ [ r.getBytes(sz) for i in xrange(4) ]
+                   for sz in (128, 128, 1, 1024) ]
+        enc = fec.encodeChunks(chunks)
+        eq(len(enc), 4)
+        for c, e in zip(chunks, enc):
+            eq(e, [ fec.encode(i, c) for i in xrange(6) ])
+
+        numbered = [ [ (i, e[i]) for i in xrange(6) ] for e in enc ]
+        for _ in xrange(20):
+            inp = [ r.shuffle(n, 4) for n in numbered ]
+            eq(fec.decodeChunks(inp), chunks)
+        # The encoded blocks were not modified.
+        eq(enc, fec.encodeChunks(chunks))
+
+        # A tuple argument is left alone.
+        tup = tuple(chunks)
+        eq(enc, fec.encodeChunks(tup))
+        for c, orig in zip(tup, chunks):
+            self.assert_(c is orig)
+            eq(type(c), type([]))
+
+    def test_fec_implementations(self):
+        # Every implementation of the inner loop we support here should
+        # give the same results.
+        r = getCommonPRNG()
+        eq = self.assertEquals
+        default = _ml.FEC_getImplementation()
+        self.assert_(default in ("avx2", "ssse3", "scalar"))
+        self.assertRaises(_ml.FECError, _ml.FEC_setImplementation, "xyzzy")
+        impls = []
+        try:
+            for impl in ("avx2", "ssse3", "scalar"):
+                try:
+                    _ml.FEC_setImplementation(impl)
+                except _ml.FECError:
+                    continue
+                eq(impl, _ml.FEC_getImplementation())
+                impls.append(impl)
+            self.assert_("scalar" in impls)
+
+            fec = _ml.FEC_generate(8,11)
+            # Include sizes that don't fill a whole vector.
+            chunks = [ [ r.getBytes(sz) for i in xrange(8) ]
+                       for sz in (1, 15, 17, 33, 1000) ]
+            results = []
+            for impl in impls:
+                _ml.FEC_setImplementation(impl)
+                enc = fec.encodeChunks(chunks)
+                results.append(enc)
+                inp = [ [ (i, e[i]) for i in xrange(3,11) ] for e in enc ]
+                eq(fec.decodeChunks(inp), chunks)
+            for enc in results[1:]:
+                eq(enc, results[0])
+        finally:
+            _ml.FEC_setImplementation(default)
+
 #----------------------------------------------------------------------
 
 class CryptoTests(TestCase):
@@ -1240,6 +1419,22 @@ class CryptoTests(TestCase):
         self.assertNotEquals(w, u)
         self.assertEquals(unwhiten(w), u)
 
+        # Make sure that streaming decryption matches, however the
+        # ciphertext is split into blocks.
+        for n in 21, 22, 100, 5000:
+            c = (plain*20)[:n]
+            for bs in 1, 7, 20, 21, 4096:
+                blocks = lambda c=c,bs=bs: [c[i:i+bs]
+                                            for i in xrange(0,len(c),bs)]
+                out = []
+                lioness_decrypt_stream(blocks, key, out.append)
+                self.assertEquals(dec(c,key), "".join(out))
+                out = []
+                unwhiten_stream(blocks, out.append)
+                self.assertEquals(unwhiten(c), "".join(out))
+        self.failUnlessRaises(CryptoError, lioness_decrypt_stream,
+                              lambda: ["X"*20], key, [].append)
+
     def test_bear(self):
         enc = bear_encrypt
         dec = bear_decrypt
@@ -1443,6 +1638,27 @@ class PacketTests(TestCase):
         self.failUnlessRaises(ParseError, parsePacket, m[:-1])
         self.failUnlessRaises(ParseError, parsePacket, m+"x")
 
+        # Now try the same thing with a PacketBuffer.
+        pb = PacketBuffer(m)
+        self.assertEquals(pb.pack(), m)
+        self.assertEquals(str(pb.getHeader1()), m[:2048])
+        self.assertEquals(str(pb.getHeader2()), m[2048:4096])
+        self.assertEquals(str(pb.getPayload()), m[4096:])
+        self.failUnlessRaises(ParseError, PacketBuffer, m[:-1])
+        # Decrypting in place should match decrypting a copy.
+        keys = Crypto.Keyset("X"*16).getLionessKeys("Y")
+        pb.decryptPayload(keys)
+        pb.decryptHeader2(keys)
+        self.assertEquals(str(pb.getPayload()),
+                          Crypto.lioness_decrypt(m[4096:], keys))
+        self.assertEquals(str(pb.getHeader2()),
+                          Crypto.lioness_decrypt(m[2048:4096], keys))
+        pb.setHeader1("Z"*2048)
+        pb.swapHeaders()
+        self.assertEquals(str(pb.getHeader2()), "Z"*2048)
+        self.assertEquals(str(pb.getHeader1()),
+                          Crypto.lioness_decrypt(m[2048:4096], keys))
+
     def test_ipv4info(self):
         # Check the IPV4Info structure used to hold the addresses for the
         # FWD and SWAP_FWD routing types.
@@ -1784,6 +2000,100 @@ class HashLogTests(TestCase):
 
         h[0].close()
 
+        # Reopen with a lifetime, and make sure everything's still there.
+        h[0] = HashLog(fname, "Xyzzy", 3600)
+        for s in ("a"*20, "ddddd"*4, "Abcd"*5, "Ghij"*5):
+            seen(s)
+        notseen("Hijk"*5)
+        h[0].close()
+
+        # Make sure we refuse to open a log with the wrong keyid.
+        self.failUnlessRaises(MixFatalError, HashLog, fname, "Plugh")
+
+    def test_hashlog_resize(self):
+        # Add enough entries to make the table grow a few times, and make
+        # sure they all survive.
+        fname = mix_mktemp(".db")
+        prng = AESCounterPRNG("b"*16)
+        h = HashLog(fname, "Xyzzy")
+        nSlots = h.nSlots
+        added = [ prng.getBytes(20) for _ in xrange(nSlots*2) ]
+        for i in xrange(len(added)):
+            h.logHash(added[i])
+            if i % 1000 == 0:
+                h.sync()
+        h.sync()
+        self.assert_(h.nSlots >= nSlots*4)
+        self.assertEquals(h.nEntries, len(added))
+        h.close()
+        h = HashLog(fname, "Xyzzy")
+        for d in added:
+            self.assert_(h.seenHash(d))
+        self.assert_(not h.seenHash(prng.getBytes(20)))
+
+        # Resize the table again, and look at what's on disk before we
+        # sync or close the log: every digest should already be there.
+        h._growTable(h.nEntries*4)
+        h2 = HashLog(fname, "Xyzzy")
+        self.assertEquals(h2.nSlots, h.nSlots)
+        self.assertEquals(h2.nEntries, len(added))
+        for d in added:
+            self.assert_(h2.seenHash(d))
+        h2.close()
+        h.close()
+
+    def test_hashlog_migrate(self):
+        # Build a hashlog in the old anydbm format, and make sure that
+        # getHashLog converts it.
+        import mixminion.server.HashLog as HL
+        fname = mix_mktemp(".db")
+        old = mixminion.Filestore.BooleanJournaledDBBase(fname,
+                                                         "digest hash", 20)
+        old.log["KEYID"] = "Xyzzy"
+        old["a"*20] = 1
+        old["\000"*20] = 1
+        old.sync()
+        old["b"*20] = 1 # Leave this one in the journal.
+        old.journalFile.close()
+        old.log.close()
+        self.assert_(HL._getOldHashLogFiles(fname))
+
+        suspendLog()
+        try:
+            self.failUnlessRaises(MixFatalError, HL.getHashLog, fname, "Foo")
+            h = HL.getHashLog(fname, "Xyzzy")
+        finally:
+            resumeLog()
+        self.assertEquals([], HL._getOldHashLogFiles(fname))
+        for d in ("a"*20, "\000"*20, "b"*20):
+            self.assert_(h.seenHash(d))
+        self.assert_(not h.seenHash("c"*20))
+        HL.deleteHashLog(fname)
+        self.assert_(not os.path.exists(fname+".tbl"))
+        self.assert_(not os.path.exists(fname+".log"))
+
+    def test_bloomfilter(self):
+        from mixminion.server.HashLog import BloomFilter
+        prng = AESCounterPRNG("a"*16)
+        bf = BloomFilter(1000)
+        # The filter is always a power of two bits long, with room for
+        # BITS_PER_ENTRY bits per entry.
+        self.assertEquals(len(bf.bits)*8, bf.mask+1)
+        self.assert_(len(bf.bits)*8 >= 1000*BloomFilter.BITS_PER_ENTRY)
+        self.assert_(not bf.mightContain("a"*20))
+        added = [ prng.getBytes(20) for _ in xrange(1000) ]
+        for d in added:
+            bf.add(d)
+        # No false negatives...
+        for d in added:
+            self.assert_(bf.mightContain(d))
+        # ...and not too many false positives.
+        nFalse = 0
+        for _ in xrange(1000):
+            if bf.mightContain(prng.getBytes(20)):
+                nFalse += 1
+        self.assert_(nFalse < 20)
+
 #----------------------------------------------------------------------
 class NetUtilTests(TestCase):
     def testGetIP(self):
@@ -1923,6 +2233,28 @@ class BuildMessageTests(TestCase):
 
         self.failUnlessRaises(ParseError, uncompressData, "3")
 
+        # Check the streaming decompressor, including its size limit.
+        c = BuildMessage.compressData(longMsg*10)
+        for bs in 1, 5, 100, len(c):
+            out = []
+            d = StreamDecompressor(out.append, len(longMsg)*10)
+            for i in xrange(0, len(c), bs):
+                d.feed(c[i:i+bs])
+            self.assertEquals(len(longMsg)*10, d.close())
+            self.assertEquals(longMsg*10, "".join(out))
+            d = StreamDecompressor(out.append, len(longMsg)*10-1)
+            try:
+                for i in xrange(0, len(c), bs):
+                    d.feed(c[i:i+bs])
+                self.fail("Expected CompressedDataTooLong")
+            except CompressedDataTooLong:
+                pass
+        d = StreamDecompressor([].append)
+        self.failUnlessRaises(ParseError, d.feed, "3xxxxxx")
+        d = StreamDecompressor([].append)
+        d.feed(c[:4])
+        self.failUnlessRaises(ParseError, d.close)
+
         for _ in xrange(20):
             for _ in xrange(20):
                 m = p.getBytes(p.getInt(1000))
@@ -2338,6 +2670,49 @@ class BuildMessageTests(TestCase):
             self.assertEquals(sha1(msg[22:]), msg[2:22])
             self.assertStartsWith(msg[22:], comp)
 
+    def test_build_fwd_packets(self):
+        # Build several forward packets at once, sharing a routing cache.
+        msgs = [ "Hello %s"%i for i in xrange(3) ]
+        payloads = [ BuildMessage.encodeMessage(m,0)[0] for m in msgs ]
+        paths = [ ([self.server1, self.server2], [self.server3, self.server2])
+                  for _ in msgs ]
+        pkts = BuildMessage.buildForwardPackets(payloads, 500, "Goodbye",
+                                                paths)
+        self.assertEquals(len(pkts), 3)
+        # Each packet gets its own secrets and tag.
+        self.assertEquals(len({pkts[0]:1, pkts[1]:1, pkts[2]:1}), 3)
+        for m, pkt in zip(msgs, pkts):
+            self.do_message_test(pkt,
+                             ( (self.pk1, self.pk2), None,
+                               (FWD_HOST_TYPE, SWAP_FWD_HOST_TYPE),
+                               (self.server2.getRoutingInfo().pack(),
+                                self.server3.getRoutingInfo().pack()) ),
+                             ( (self.pk3, self.pk2), None,
+                               (FWD_HOST_TYPE, 500),
+                               (self.server2.getRoutingInfo().pack(),
+                                "Goodbye") ),
+                             m)
+
+        # The cache computes each routing only once.
+        cache = BuildMessage.RoutingCache()
+        calls = []
+        origGetRoutingFor = self.server1.getRoutingFor
+        def getRoutingFor(other, swap=0, calls=calls, orig=origGetRoutingFor):
+            calls.append((other, swap))
+            return orig(other, swap=swap)
+        self.server1.getRoutingFor = getRoutingFor
+        try:
+            for payload in payloads:
+                BuildMessage.buildForwardPacket(payload, 500, "Goodbye",
+                                                [self.server1],
+                                                [self.server2],
+                                                routingCache=cache)
+        finally:
+            del self.server1.getRoutingFor
+        self.assertEquals(calls, [(self.server2, 1)])
+        self.assertEquals(cache.getRoutingFor(self.server1, self.server2, 1),
+                          self.server1.getRoutingFor(self.server2, swap=1))
+
     def test_buildreply(self):
         brbi = BuildMessage._buildReplyBlockImpl
         brb = BuildMessage.buildReplyBlock
@@ -2954,6 +3329,105 @@ class PacketHandlerTests(TestCase):
         m_x = self.sp2.processPacket(m_x).getPacket()
         self.failUnlessRaises(CryptoError, self.sp3.processPacket, m_x)
 
+    def test_workers(self):
+        PH = mixminion.server.PacketHandler
+        if not PH.canUseWorkers():
+            print "[Skipping packet worker tests: no multiprocessing]",
+            return
+        bfm = BuildMessage.buildForwardPacket
+        h2 = HashLog(mix_mktemp(".db"), "Y"*20)
+        sp = PacketHandler([self.pk1], [h2], nWorkers=2)
+        try:
+            self.assert_(sp.usesWorkers())
+            self.assert_(not self.sp1.usesWorkers())
+            results = mixminion.ThreadUtils.MessageQueue()
+            def process(m, sp=sp, results=results):
+                sp.processPacketInWorker(m, results.put)
+                getResult = results.get(timeout=60)
+                try:
+                    return getResult()
+                except (MixError, CryptoError), e:
+                    return e
+
+            p = "Now is the time for all good men to come to the aid"
+            zPayload = BuildMessage.encodeMessage("\n"+p,0)[0]
+            m = bfm(zPayload, SMTP_TYPE, "nobody@invalid",
+                    [self.server1, self.server2], [self.server3])
+            res = process(m)
+            self.assert_(isinstance(res, RelayedPacket))
+            self.assertEquals(res.getAddress().pack(),
+                              self.server2.getRoutingInfo().pack())
+            # Same answer as in-thread processing...
+            m2 = self.sp2.processPacket(res.getPacket()).getPacket()
+            self.assert_(isinstance(self.sp3.processPacket(m2),
+                                    DeliveryPacket))
+            # ...and the parent's hashlog caught the replay.
+            self.assert_(isinstance(process(m), ContentError))
+            self.assert_(isinstance(process(m+"X"), ParseError))
+
+            # Workers don't know about a key until we tell them.
+            m = bfm(zPayload, DROP_TYPE, "", [self.server2], [self.server1])
+            self.assert_(isinstance(process(m), CryptoError))
+            h3 = HashLog(mix_mktemp(".db"), "Z"*20)
+            sp.setKeys([self.pk1, self.pk2], [h2, h3])
+            self.assertEquals(process(m).getAddress().pack(),
+                              self.server1.getRoutingInfo().pack())
+            # If a key goes away while the worker has the packet, we
+            # reject it.
+            m = bfm(zPayload, DROP_TYPE, "", [self.server2], [self.server1])
+            sp.processPacketInWorker(m, results.put)
+            getResult = results.get(timeout=60)
+            oldPool = sp.pool
+            sp.setKeys([self.pk1], [h2])
+            self.failUnlessRaises(ContentError, getResult)
+            # Changing the keys starts a new pool; we shut down the old one
+            # once it has no packets left.
+            self.assert_(sp.pool is not oldPool)
+            self.assert_(oldPool in sp.oldPools)
+            sp._checkWorkerJobs(time.time())
+            self.assertEquals(sp.oldPools, [])
+
+            # If a worker dies, the pool replaces it: our SIGCHLD handler
+            # doesn't reap it first.
+            mixminion.Common.installSIGCHLDHandler()
+            m = bfm(zPayload, SMTP_TYPE, "nobody@invalid",
+                    [self.server1, self.server2], [self.server3])
+            for w in sp.pool._pool:
+                sp.pool.apply_async(os._exit, (1,))
+            self.assert_(isinstance(process(m), RelayedPacket))
+
+            # A packet that takes too long gets retried; we only report
+            # one result for it.
+            m = bfm(zPayload, SMTP_TYPE, "nobody@invalid",
+                    [self.server1, self.server2], [self.server3])
+            sp.processPacketInWorker(m, results.put)
+            try:
+                suspendLog()
+                sp._checkWorkerJobs(time.time()+PH.WORKER_TIMEOUT)
+            finally:
+                resumeLog()
+            self.assert_(isinstance(results.get(timeout=60)(),
+                                    RelayedPacket))
+            time.sleep(.5)
+            self.assertEquals(sp.jobs, {})
+            self.failUnlessRaises(mixminion.ThreadUtils.QueueEmpty,
+                                  results.get, 0)
+            # After too many tries, we give up on it.
+            sp.oldPools.append(sp.pool)
+            sp.pool = PH.multiprocessing.Pool(1, time.sleep, (1000,))
+            sp.processPacketInWorker(m, results.put)
+            try:
+                suspendLog()
+                for i in range(PH.MAX_WORKER_ATTEMPTS):
+                    self.assertEquals(len(sp.jobs), 1)
+                    sp._checkWorkerJobs(time.time()+PH.WORKER_TIMEOUT*(i+1))
+            finally:
+                resumeLog()
+            self.assertEquals(sp.jobs, {})
+            self.failUnlessRaises(ContentError, results.get(timeout=60))
+        finally:
+            sp.close()
+
 #----------------------------------------------------------------------
 # FILESTORE and QUEUE
 
@@ -3152,6 +3626,180 @@ class FilestoreTests(FStoreTestBase):
         self.assert_(not os.path.exists(os.path.join(d_d, "rmvm_"+h2)))
         self.assert_(not os.path.exists(os.path.join(d_d, "rmv_"+h2)))
 
+    def testSegmentedStore(self):
+        d = mix_mktemp("q_seg")
+        Store = mixminion.Filestore.SegmentedMetadataStore
+        Store.SLOTS_PER_SEGMENT = 4
+        try:
+            queue = Store(d, create=1, slotLen=100)
+            h1 = queue.queueMessageAndMetadata("abc", [2,3])
+            # This one needs 3 slots.
+            h2 = queue.queueMessageAndMetadata("x"*200, None)
+            self.assertEquals(os.listdir(d), ["seg_00000"])
+            self.assertEquals(os.path.getsize(os.path.join(d,"seg_00000")),
+                              400)
+            self.assertEquals(queue.messageContents(h2), "x"*200)
+            self.assertEquals(queue.getMetadata(h1), [2,3])
+            # Changing the metadata moves the message.
+            queue.setMetadata(h1, "Hello")
+            self.assertEquals(queue.count(), 2)
+            self.assertEquals(queue.messageContents(h1), "abc")
+            h3 = queue.queueObjectAndMetadata(("a", 99), {})
+            self.assertUnorderedEq(os.listdir(d), ["seg_00000","seg_00001"])
+            self.assertEquals(queue.getObject(h3), ("a", 99))
+            f, h4 = queue.openNewMessage()
+            f.write("hi there")
+            self.assert_(not queue.messageExists(h4))
+            queue.finishMessage(f, h4)
+            self.assertEquals(queue.openMessage(h4).read(), "hi there")
+            self.assertUnorderedEq(queue.getAllMessages(), [h1,h2,h3,h4])
+            self.assertUnorderedEq(queue.pickRandom(), [h1,h2,h3,h4])
+
+            # Removing a message zeroes its slots.
+            slots = queue._records[h2][1]
+            queue.removeMessage(h2)
+            queue.cleanQueue()
+            self.assert_(not queue.messageExists(h2))
+            self.assertEquals(queue._readSlot(slots[1]), "\000"*100)
+            queue.close()
+
+            # Reopen the store; the index comes back from the headers.
+            self.assertRaises(MixFatalError, Store, d)
+            queue = Store(d, slotLen=100)
+            self.assertUnorderedEq(queue.getAllMessages(), [h1,h3,h4])
+            self.assertEquals(queue.messageContents(h1), "abc")
+            self.assertEquals(queue.getMetadata(h1), "Hello")
+            self.assertEquals(queue.getObject(h3), ("a", 99))
+            self.assertRaises(KeyError, queue.getMetadata, h4)
+            # Simulate a crash while writing h1 again: the second slot of
+            # the new record never made it to disk.
+            queue.setMetadata(h1, "x"*150)
+            queue._writeSlot(queue._records[h1][1][1], "")
+            queue.close()
+            try:
+                suspendLog()
+                queue = Store(d, slotLen=100)
+            finally:
+                s = resumeLog()
+            self.assertEndsWith(s, "Discarding incomplete message %s in %s\n"
+                                % (h1, d))
+            self.assertUnorderedEq(queue.getAllMessages(), [h3,h4])
+            queue.removeAll()
+            self.assertEquals(queue.count(), 0)
+            queue.close()
+        finally:
+            del Store.SLOTS_PER_SEGMENT
+
+        # Import messages from a file-based store.
+        d2 = mix_mktemp("q_seg")
+        old = mixminion.Filestore.StringMetadataStore(d2, create=1)
+        h1 = old.queueMessageAndMetadata("abc", [2,3])
+        h2 = old.queueMessageAndMetadata("def", None)
+        queue = Store(d2)
+        self.assertEquals(os.listdir(d2), ["seg_00000"])
+        self.assertUnorderedEq(queue.getAllMessages(), [h1,h2])
+        self.assertEquals(queue.messageContents(h2), "def")
+        self.assertEquals(queue.getMetadata(h1), [2,3])
+        queue.close()
+
+    def testStoreManifest(self):
+        d = mix_mktemp("q_man")
+        Store = mixminion.Filestore.StringMetadataStore
+        # Build a manifest for a store that didn't have one.
+        queue = Store(d, create=1)
+        h1 = queue.queueMessageAndMetadata("abc", [2,3])
+        h2 = queue.queueMessageAndMetadata("def", [4,5])
+        queue = Store(d, manifest=1)
+        self.assertUnorderedEq(queue.getAllMessages(), [h1,h2])
+        self.assertEquals(queue.getMetadata(h2), [4,5])
+        h3 = queue.queueMessageAndMetadata("ghi", "x")
+        queue.setMetadata(h1, "y")
+        queue.removeMessage(h2)
+        self.assert_(not queue.messageExists(h2))
+        self.assertEquals(queue.count(), 2)
+
+        # Reopen without closing, as if we had crashed: the journal has
+        # our changes.
+        queue = Store(d, manifest=1)
+        self.assertUnorderedEq(queue.getAllMessages(), [h1,h3])
+        queue.loadAllMetadata(lambda h: None)
+        # We don't unpickle any metadata until somebody asks for it.
+        self.assertEquals(queue._metadata_cache.objects, {})
+        self.assertUnorderedEq(queue._metadata_cache.keys(), [h1, h3])
+        self.assertEquals(queue._metadata_cache[h3], "x")
+        self.assertEquals(queue._metadata_cache.objects, { h3 : "x" })
+        self.assertEquals(dict(queue._metadata_cache.items()),
+                          { h1 : "y", h3 : "x" })
+        # We don't look at the directory once the manifest exists...
+        writeFile(os.path.join(d, "msg_ABCDEFGH"), "jkl")
+        queue.close()
+        queue = Store(d, manifest=1)
+        self.assertEquals(queue.count(), 2)
+        self.assert_(not queue.messageExists("ABCDEFGH"))
+        # ...unless we ask it to recount.
+        try:
+            suspendLog()
+            self.assertEquals(queue.count(1), 3)
+        finally:
+            resumeLog()
+        self.assertEquals(queue.messageContents("ABCDEFGH"), "jkl")
+
+        # A change that was journaled, but never made, gets undone.
+        queue._manifest.addMessage("IJKLMNOP")
+        queue._manifest.removeMessage(h1)
+        queue = Store(d, manifest=1)
+        self.assertUnorderedEq(queue.getAllMessages(), [h1,h3,"ABCDEFGH"])
+
+        # Big journals get replaced by a new snapshot.
+        queue._manifest.MIN_JOURNAL = 4
+        for i in range(10):
+            queue.queueMessageAndMetadata(str(i), i)
+        self.assert_(queue._manifest.nJournaled < 20)
+        queue = Store(d, manifest=1)
+        self.assertEquals(queue.count(), 13)
+        queue.removeAll(self.unlink)
+        queue.close()
+        queue = Store(d, manifest=1)
+        self.assertEquals(queue.count(), 0)
+
+        # We forget removed messages once their files are gone.
+        self.assert_(queue._manifest.removed)
+        queue.cleanQueue()
+        self.assertEquals(queue._manifest.removed, {})
+
+        # Scrubbing uses the manifest to find incomplete and removed
+        # messages.
+        h1 = queue.queueMessageAndMetadata("abc", [2,3])
+        h2 = queue.queueMessageAndMetadata("def", [4,5])
+        f, h3 = queue.openNewMessage()
+        f.write("ghi")
+        f.close()
+        f, h4 = queue.openNewMessage()
+        f.close()
+        past = time.time() - mixminion.Filestore.INPUT_TIMEOUT - 100
+        os.utime(os.path.join(d, "inp_"+h3), (past, past))
+        queue.removeMessage(h2)
+        self.assertUnorderedEq(queue._manifest.inputs.keys(), [h3,h4])
+        self.assertEquals(queue._manifest.removed.keys(), [h2])
+        # (Files that the manifest doesn't know about stay where they are.)
+        writeFile(os.path.join(d, "rmv_QRSTUVWX"), "jkl")
+        queue = Store(d, manifest=1, scrub=1)
+        self.assertUnorderedEq(os.listdir(d),
+                   ["manifest", "manifest_jrnl", "msg_"+h1, "meta_"+h1,
+                    "inp_"+h4, "rmv_QRSTUVWX"])
+        self.assertEquals(queue._manifest.inputs.keys(), [h4])
+        self.assertUnorderedEq(queue._manifest.removed.keys(), [h2,h3])
+        queue.cleanQueue()
+        self.assertEquals(queue._manifest.removed, {})
+        # Rebuilding the manifest finds them.
+        queue.count(1)
+        self.assertEquals(queue._manifest.removed.keys(), ["QRSTUVWX"])
+        queue.cleanQueue()
+        self.assert_(not os.path.exists(os.path.join(d, "rmv_QRSTUVWX")))
+        queue.abortMessage(open(os.path.join(d, "inp_"+h4)), h4)
+        self.assertEquals(queue._manifest.inputs, {})
+        queue.close()
+
     def testDBWrappers(self):
         d_parent = mix_mktemp("db")
         loc = os.path.join(d_parent, "db0")
@@ -3278,6 +3926,33 @@ class FilestoreTests(FStoreTestBase):
         self.assert_(not db2.has_key("08"))
         db2.close()
 
+        # Test group-commit mode for journal files.
+        jf = mixminion.Filestore.JournalFile(jloc, groupCommit=1)
+        jf.MAX_BATCH = 3
+        jf.append("17")
+        jf.append("19")
+        self.assertEquals(readFile(jloc), "")
+        jf.append("23")
+        self.assertEquals(readFile(jloc), "171923")
+        jf.append("29")
+        self.assertEquals(readFile(jloc), "171923")
+        jf.commit()
+        self.assertEquals(readFile(jloc), "17192329")
+        # Records that have waited long enough get written with the next one.
+        jf.MAX_DELAY = 0
+        jf.append("31")
+        self.assertEquals(readFile(jloc), "1719232931")
+        jf.MAX_DELAY = 1000
+        jf.append("37")
+        jf.close()
+        self.assertEquals(readFile(jloc), "171923293137")
+        # A partial record at the end of the journal is ignored.
+        writeFile(jloc, "4143"+"4")
+        db2 = mixminion.Filestore.BooleanJournaledDBBase(loc, "numbers", 2)
+        for k in ("13", "41", "43"):
+            self.assert_(db2.has_key(k))
+        db2.close()
+
         # Test migration from unjournaled to journaled.
         loc = os.path.join(d_parent, "db3")
         jloc = loc+"_jrnl"
@@ -3425,6 +4100,68 @@ class QueueTests(FStoreTestBase):
         queue.removeAll(self.unlink)
         queue.cleanQueue(self.unlink)
 
+    def testDeliveryQueueSchedule(self):
+        # Make sure that queues only look at the messages that are due.
+        now = 10000
+        queue = TestDeliveryQueue(mix_mktemp("qd"), now)
+        queue.setRetrySchedule([10, 10], now)
+        hs = [ queue.queueDeliveryMessage("Msg %s"%i, now=now+i)
+               for i in xrange(20) ]
+        self.assertEquals(len(queue._schedule), 20)
+        queue.sendReadyMessages(now+4)
+        self.assertUnorderedEq([m.getHandle() for m in queue._msgs], hs[:5])
+        self.assertEquals(len(queue._schedule), 15)
+        # Failed messages come back at their next attempt.
+        for m in queue._msgs:
+            m.failed(retriable=1, now=now+5)
+        queue.sendReadyMessages(now+9)
+        self.assertUnorderedEq([m.getHandle() for m in queue._msgs], hs[5:10])
+        queue.sendReadyMessages(now+10)
+        self.assertUnorderedEq([m.getHandle() for m in queue._msgs],
+                               [hs[0], hs[10]])
+        # Messages removed behind the schedule's back are skipped.
+        queue.removeMessage(hs[11])
+        queue.sendReadyMessages(now+12)
+        self.assertUnorderedEq([m.getHandle() for m in queue._msgs],
+                               hs[1:3]+[hs[12]])
+        # A new schedule can make messages expire.
+        queue.setRetrySchedule([1], now+20)
+        queue.sendReadyMessages(now+20)
+        self.assertUnorderedEq([m.getHandle() for m in queue._msgs],
+                               hs[4:5]+hs[13:20])
+        self.assertUnorderedEq(queue.getAllMessages(),
+                               hs[:3]+hs[4:11]+hs[12:20])
+        queue.removeAll(self.unlink)
+        queue.cleanQueue(self.unlink)
+
+        # Per-address queues keep one entry per waiting address.
+        A1 = _TestAddr("FirstAddress")
+        A2 = _TestAddr("SecondAddress")
+        q = TestPerAddressDeliveryQueue(mix_mktemp(), now=now)
+        q.setRetrySchedule([100, 100], now)
+        h1 = [ q.queueDeliveryMessage("A1 %s"%i, A1, now) for i in xrange(10) ]
+        h2 = q.queueDeliveryMessage("A2", A2, now)
+        self.assertEquals(len(q._addrSchedule), 2)
+        q.sendReadyMessages(now+1)
+        self.assertEquals(len(q._msgs), 11)
+        self.assertEquals(q._addrSchedule, [])
+        for m in q._msgs:
+            m.failed(retriable=1, now=now+2)
+        self.assertEquals(q._addrSchedule, [(now+101, str(A1)),
+                                            (now+101, str(A2))])
+        # Nothing is ready until the addresses are.
+        q.sendReadyMessages(now+50)
+        self.assertEquals(q._msgs, [])
+        q.sendReadyMessages(now+101)
+        self.assertUnorderedEq([m.getHandle() for m in q._msgs], h1+[h2])
+        for m in q._msgs:
+            m.failed(retriable=1, now=now+102)
+        # After the last retry, the messages expire.
+        q.sendReadyMessages(now+201)
+        self.assertEquals(q._msgs, [])
+        self.assertEquals(q.store.count(), 0)
+        q.close()
+
     def testPerAddressDeliveryQueue(self):
         PADQ = TestPerAddressDeliveryQueue
         A1 = _TestAddr("FirstAddress")
@@ -3895,8 +4632,10 @@ TEST_PORT = 40199
 
 dhfile = pkfile = certfile = None
 
-def _getTLSContext(isServer):
-    "Helper function: create a new TLSContext object."
+def _getTLSContext(isServer, sessionCacheSize=0):
+    """Helper function: create a new TLSContext object.  If
+       'sessionCacheSize' is nonzero, a server context remembers that many
+       sessions for clients to resume."""
     global dhfile
     global pkfile
     global certfile
@@ -3937,7 +4676,7 @@ def _getTLSContext(isServer):
                               time.time(), time.time()+365*24*60*60)
 
         pk = _ml.rsa_PEM_read_key(open(pkfile, 'r'), 0)
-        return _ml.TLSContext_new(certfile, pk, dhfile)
+        return _ml.TLSContext_new(certfile, pk, dhfile, sessionCacheSize)
     else:
         return _ml.TLSContext_new()
 
@@ -3946,7 +4685,7 @@ def _getTLSContextKeyID():
     keyid = sha1(ident.encode_key(1))
     return keyid
 
-def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT):
+def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT,sessionCacheSize=0):
     """Helper function: create a new MMTP server with a listener connection
        Return a tuple of AsyncServer, ListenerConnection, list of received
        messages, and keyid."""
@@ -3956,7 +4695,7 @@ def _getMMTPServer(minimal=0,reject=0,port=TEST_PORT):
         m.append(pkt)
     server.nJunkPackets = 0
     def junkCallback(server=server): server.nJunkPackets += 1
-    def conFactory(sock, context=_getTLSContext(1),
+    def conFactory(sock, context=_getTLSContext(1,sessionCacheSize),
                    receiveMessage=receivedHook,junkCallback=junkCallback,
                    reject=reject,server=server):
         tls = context.sock(sock, serverMode=1)
@@ -4021,6 +4760,188 @@ class MMTPTests(TestCase):
                     self.server.process(0.1)
                     count = count + 1
 
+    def testAsyncServers(self):
+        # Make sure that every kind of AsyncServer we can use here
+        # dispatches events, tracks changes in what connections want, and
+        # forgets closed connections.
+        import mixminion.server.MMTPServer as M
+        if not hasattr(socket, 'socketpair'):
+            return
+        kinds = [ M.SelectAsyncServer ]
+        if hasattr(select, 'poll'):
+            kinds.append(M.PollAsyncServer)
+        if hasattr(select, 'epoll'):
+            kinds.append(M.EpollAsyncServer)
+
+        class PipeCon(M.Connection):
+            def __init__(self, sock):
+                self.sock = sock
+                self.got = []
+                self.toWrite = ""
+                self.isOpen = 1
+            def fileno(self):
+                return self.sock.fileno()
+            def getStatus(self):
+                return self.isOpen, self.toWrite and 1 or 0, self.isOpen
+            def process(self, r, w, x, cap):
+                if r:
+                    d = self.sock.recv(1024)
+                    if d:
+                        self.got.append(d)
+                    else:
+                        self.sock.close()
+                        self.isOpen = 0
+                        return 0,0,0,0
+                if w and self.toWrite:
+                    n = self.sock.send(self.toWrite)
+                    self.toWrite = self.toWrite[n:]
+                wr, ww, isOpen = self.getStatus()
+                return wr, ww, isOpen, 0
+
+        for kind in kinds:
+            server = kind()
+            a, b = socket.socketpair()
+            ca, cb = PipeCon(a), PipeCon(b)
+            ca.toWrite = "Hello"
+            server.register(ca)
+            server.register(cb)
+            for _ in xrange(10):
+                server.process(0.01)
+            self.assertEquals("".join(cb.got), "Hello")
+            # Tell the server that b now wants to write.
+            cb.toWrite = "world"
+            server.register(cb)
+            for _ in xrange(10):
+                server.process(0.01)
+            self.assertEquals("".join(ca.got), "world")
+            # Closing one end should get both ends closed and removed.
+            b.shutdown(socket.SHUT_WR)
+            for _ in xrange(10):
+                server.process(0.01)
+            self.assert_(not ca.isOpen)
+            self.assert_(not cb.isOpen)
+            self.assertEquals(server.connections, {})
+
+    def testAsyncServerTimeouts(self):
+        # Make sure that tryTimeout only times out the connections that
+        # have been idle too long, and only asks those that might have.
+        import mixminion.server.MMTPServer as M
+        asked = []
+        class IdleCon(M.Connection):
+            def __init__(self, fd, lastActivity):
+                self.fd = fd
+                self.lastActivity = lastActivity
+            def fileno(self): return self.fd
+            def getStatus(self): return 0,0,1
+            def getLastActivity(self): return self.lastActivity
+            def tryTimeout(self, cutoff, asked=asked):
+                asked.append(self.fd)
+                return self.lastActivity <= cutoff
+
+        server = M.SelectAsyncServer()
+        server._timeout = 100
+        cons = [ IdleCon(fd, 1000+fd*10) for fd in xrange(10) ]
+        for c in cons:
+            server.register(c)
+        # This one never times out.
+        listener = IdleCon(99, None)
+        listener.getLastActivity = lambda: None
+        server.register(listener)
+        self.assertEquals(server.getFirstActivityTime(), 1000)
+        # Nothing is old enough at 1099.
+        server.tryTimeout(1099)
+        self.assertEquals(asked, [])
+        self.assertEquals(len(server.connections), 11)
+        # At 1125, connections 0, 1, and 2 are old enough... but 1 has
+        # seen activity since we registered it.
+        cons[1].lastActivity = 1200
+        server.tryTimeout(1125)
+        self.assertEquals(asked, [0,1,2])
+        self.assertUnorderedEq(server.connections.keys(),
+                               [99,1,3,4,5,6,7,8,9])
+        self.assertEquals(server.getFirstActivityTime(), 1030)
+        # Removed connections are forgotten.
+        server.remove(cons[3])
+        self.assertEquals(server.getFirstActivityTime(), 1040)
+        del asked[:]
+        server.tryTimeout(1305)
+        self.assertEquals(asked, [4,5,6,7,8,9,1])
+        self.assertEquals(server.connections.keys(), [99])
+        self.assertEquals(server.getFirstActivityTime(), None)
+
+    def testTLSInbuf(self):
+        # Make sure that TLSConnection's input buffer keeps the bytes we
+        # read in order as it compacts and grows.
+        import array
+        class FakeTLS:
+            def __init__(self):
+                self.chunks = []
+            def readinto(self, buf, offset, n):
+                if not self.chunks:
+                    raise _ml.TLSWantRead()
+                s = self.chunks[0][:n]
+                self.chunks[0] = self.chunks[0][n:]
+                if not self.chunks[0]:
+                    del self.chunks[0]
+                buf[offset:offset+len(s)] = array.array('c', s)
+                return len(s)
+            def pending(self): return 0
+            def get_num_bytes_raw(self): return 0
+        tls = FakeTLS()
+        con = mixminion.TLSConnection.TLSConnection(tls, None, "fake")
+        con.onRead = lambda: None
+        con.beginReading()
+        # 'expected' holds the bytes we expect to find in the buffer.
+        expected = [ "" ]
+        def feed(n, tls=tls, con=con, expected=expected):
+            s = Crypto.getCommonPRNG().getBytes(n)
+            tls.chunks.append(s)
+            expected[0] += s
+            con.process(1,0,0)
+        # Fill the buffer past its initial size, so that it grows.
+        for _ in xrange(6):
+            feed(1000)
+        self.assertEquals(con.inbuflen, 6000)
+        self.assertEquals(con.getInbuf(), expected[0])
+        self.assertEquals(str(con.peekInbuf(10)), expected[0][:10])
+        con.consumeInbuf(10)
+        self.assertEquals(con.getInbuf(2500, clear=1), expected[0][10:2510])
+        expected[0] = expected[0][2510:]
+        # Now keep reading and consuming, so that the buffer has to move
+        # the data it has left to the front.
+        for _ in xrange(20):
+            feed(900)
+            self.assertEquals(con.getInbuf(1000, clear=1), expected[0][:1000])
+            expected[0] = expected[0][1000:]
+        self.assertEquals(con.getInbuf(clear=1), expected[0])
+        self.assertEquals(con.inbuflen, 0)
+        self.assertEquals(con.getInbuf(), "")
+        feed(5)
+        con.clearInbuf()
+        self.assertEquals(con.getInbuf(), "")
+
+    def testTLSSessionCache(self):
+        cache = mixminion.MMTPClient.TLSSessionCache(maxSessions=2)
+        self.assertEquals(cache.get("A"*20), None)
+        cache.set("A"*20, "sessA")
+        cache.set("B"*20, "sessB")
+        self.assertEquals(cache.get("A"*20), "sessA")
+        # Replacing a session doesn't evict anything.
+        cache.set("B"*20, "sessB2")
+        self.assertEquals(len(cache.sessions), 2)
+        self.assertEquals(cache.get("B"*20), "sessB2")
+        # Adding a third evicts one.
+        cache.set("C"*20, "sessC")
+        self.assertEquals(len(cache.sessions), 2)
+        self.assertEquals(cache.get("C"*20), "sessC")
+        cache.invalidate("C"*20)
+        cache.invalidate("C"*20)
+        self.assertEquals(cache.get("C"*20), None)
+        cache.set("D"*20, None)
+        self.assertEquals(cache.get("D"*20), None)
+        cache.clear()
+        self.assertEquals(cache.sessions, {})
+
     def testBlockingTransmission(self):
         self.doTest(self._testBlockingTransmission)
 
@@ -4030,6 +4951,9 @@ class MMTPTests(TestCase):
     def testTimeout(self):
         self.doTest(self._testTimeout)
 
+    def testSessionResumption(self):
+        self.doTest(self._testSessionResumption)
+
     def testRejected(self):
         self.doTest(self._testRejected)
 
@@ -4072,6 +4996,49 @@ class MMTPTests(TestCase):
             server.process(0.1)
         t.join()
 
+    def _testSessionResumption(self):
+        server, listener, packetsIn, keyid = _getMMTPServer(
+            sessionCacheSize=16)
+        self.listener = listener
+        self.server = server
+
+        clientConClass = mixminion.MMTPClient.MMTPClientConnection
+        class RecordingCon(clientConClass):
+            # Remember whether the handshake resumed an old session.
+            def onConnected(self):
+                self.resumed = self.tls.session_reused()
+                clientConClass.onConnected(self)
+
+        cache = mixminion.MMTPClient.TLSSessionCache()
+        context = _ml.TLSContext_new()
+        async = mixminion.server.MMTPServer.AsyncServer()
+        packets = ["helloxxx"*4096, "helloyyy"*4096]
+        cons = []
+        for p in packets:
+            deliv = FakeDeliverable(p)
+            clientcon = RecordingCon(socket.AF_INET, "127.0.0.1", TEST_PORT,
+                                     keyid, context=context,
+                                     sessionCache=cache)
+            clientcon.addPacket(deliv)
+            async.register(clientcon)
+            def clientThread(clientcon=clientcon, async=async):
+                while clientcon.sock is not None:
+                    async.process(2)
+            t = threading.Thread(None, clientThread)
+            t.start()
+            while t.isAlive():
+                server.process(0.1)
+            t.join()
+            self.assert_(deliv._succeeded)
+            self.failIf(cache.get(keyid) is None)
+            cons.append(clientcon)
+
+        self.assertEquals(packetsIn, packets)
+        # The first connection does a full handshake; the second one
+        # resumes the session that the first one left in the cache.
+        self.failIf(cons[0].resumed)
+        self.failUnless(cons[1].resumed)
+
     def testStallingTransmission(self):
         # XXXX I know this works, but there doesn't seem to be a good
         # XXXX way to test it.  It's hard to open a connection that
@@ -4167,6 +5134,58 @@ class MMTPTests(TestCase):
         self.assert_(deliv[0]._succeeded)
         self.assert_(deliv[1]._succeeded)
 
+        # Again, sending only one packet at a time.
+        del packetsIn[:]
+        deliv = [FakeDeliverable(p) for p in packets]
+        clientcon = mixminion.server.MMTPServer.MMTPClientConnection(
+            socket.AF_INET, "127.0.0.1", TEST_PORT, keyid, sendWindow=1)
+        for d in deliv:
+            clientcon.addPacket(d)
+        async.register(clientcon)
+        t = threading.Thread(None, clientThread, args=(clientcon,))
+        t.start()
+        while t.isAlive():
+            server.process(0.1)
+        t.join()
+        self.assertEquals(packetsIn, packets)
+        self.assert_(deliv[0]._succeeded)
+        self.assert_(deliv[1]._succeeded)
+        self.assertEquals(clientcon.nPacketsAcked, 2)
+
+        # Again, keeping the connection open between packets.
+        del packetsIn[:]
+        deliv = [FakeDeliverable(p) for p in packets]
+        clientcon = mixminion.server.MMTPServer.MMTPClientConnection(
+            socket.AF_INET, "127.0.0.1", TEST_PORT, keyid, keepAlive=1)
+        self.failIf(clientcon.isIdle())
+        clientcon.addPacket(deliv[0])
+        async.register(clientcon)
+        def clientThreadIdle(clientcon=clientcon, async=async):
+            while not clientcon.isIdle():
+                async.process(2)
+        for d in deliv:
+            if d is not deliv[0]:
+                clientcon.addPacket(d)
+                self.failIf(clientcon.isIdle())
+                async.register(clientcon)
+            t = threading.Thread(None, clientThreadIdle)
+            t.start()
+            while t.isAlive():
+                server.process(0.1)
+            t.join()
+            self.assert_(d._succeeded)
+            self.assert_(clientcon.getIdleSince() is not None)
+        self.assertEquals(packetsIn, packets)
+        self.assert_(clientcon.closeIdle())
+        self.failIf(clientcon.closeIdle())
+        async.register(clientcon)
+        t = threading.Thread(None, clientThread, args=(clientcon,))
+        t.start()
+        while t.isAlive():
+            server.process(0.1)
+        t.join()
+        self.assertEquals(clientcon.nPacketsAcked, 2)
+
         # Again, with bad keyid.
         deliv = [FakeDeliverable(p) for p in packets]
         clientcon = mixminion.server.MMTPServer.MMTPClientConnection(
@@ -5214,6 +6233,22 @@ class DirectoryServerTests(TestCase):
         sd2 = ServerDirectory(d2)
         self.assertEquals(2, len(sd2.getServers()))
 
+        # Descriptors we've already parsed get reused, not parsed again.
+        known = {}
+        for s in sd2.getAllServers():
+            self.assert_(s.isValidated())
+            known[s.getDigest()] = s
+        sd3 = ServerDirectory(d2, knownServers=known)
+        eq(len(sd2.getAllServers()), len(sd3.getAllServers()))
+        for s in sd3.getAllServers():
+            self.assert_(known[s.getDigest()] is s)
+        del known[sd2.getAllServers()[0].getDigest()]
+        sd3 = ServerDirectory(d2, knownServers=known)
+        self.assert_(sd3.getAllServers()[0] is not sd2.getAllServers()[0])
+        eq(sd3.getAllServers()[0].getDigest(),
+           sd2.getAllServers()[0].getDigest())
+        self.assert_(sd3.getAllServers()[1] is sd2.getAllServers()[1])
+
         # Now try cleaning servers.   First, make sure we can't insert
         # an expired server.
         self.failUnlessRaises(MixError,
@@ -5356,6 +6391,34 @@ class DirectoryServerTests(TestCase):
             [ ("voter1",s_vote1), ("voter2",s_vote2), ("voter3",s_vote3) ],
             vd1)
 
+        # Test directory diffs.  Descriptors in both directories are
+        # only referred to by digest.
+        diff = DF.generateDirectoryDiff(s_vote1, s_vote2)
+        self.assertStartsWith(diff, "Mixminion-Directory-Diff: 0.1\n")
+        self.assertEquals(3, diff.count("\nKeep: "))
+        self.assert_(len(diff) < len(s_vote2))
+        clean2 = SI._cleanForDigest(s_vote2)
+        self.assertEquals(clean2, SI.applyDirectoryDiff(s_vote1, diff))
+        self.assertEquals(clean2, SI.applyDirectoryDiff(s_vote2, diff))
+        vote2 = SI.SignedDirectory(string=SI.applyDirectoryDiff(s_vote1,diff))
+        self.assertEquals(vote2.getSigners(), [(keyid1, ub1)])
+        # Diffs that don't apply, or that are damaged, are rejected.
+        self.assertRaises(ConfigError, SI.applyDirectoryDiff, s_vote3, diff)
+        self.assertRaises(ConfigError, SI.applyDirectoryDiff, s_vote1,
+                          diff[:-10])
+        self.assertRaises(ConfigError, SI.applyDirectoryDiff, s_vote1,
+                          diff.replace("Keep: ", "Keep: A", 1))
+        self.assertRaises(ConfigError, SI.applyDirectoryDiff, s_vote1,
+                          diff.replace("0.1", "9.9", 1))
+        # Diffs are published under the digest of their base.
+        base1 = SI.getDirectoryDiffBase(s_vote1)
+        self.assertEquals(base1, sha1(SI._cleanForDigest(s_vote1)))
+        self.assertEquals(
+            "http://x/Directory-diff-%s.gz"%binascii.b2a_hex(base1),
+            SI.getDirectoryDiffName("http://x/Directory.gz", base1))
+        self.assertEquals("/x/Directory-diff-%s"%binascii.b2a_hex(base1),
+                          SI.getDirectoryDiffName("/x/Directory", base1))
+
     def testVoteFile(self):
         VF = mixminion.directory.Directory.VoteFile
         d = mix_mktemp()
@@ -7084,6 +8147,32 @@ class ClientDirectoryTests(TestCase):
             if i == 2:
                 ks.rescan(force=1)
 
+        # The cache holds only summaries of the descriptors: loading it
+        # parses none of them, and path selection doesn't need to.
+        ks = mixminion.ClientDirectory.ClientDirectory(config)
+        cached = ks.getAllServers()
+        for s in cached:
+            self.assert_(isinstance(s,
+                              mixminion.ClientDirectory._CachedServerInfo))
+        self.failIf(stringContains(readFile(ks.store.cacheFile),
+                                   "Packet-Key"))
+        p = ks.getPath([None, None, None])
+        eq(3, len(p))
+        for s in cached:
+            self.assert_(s._info is None)
+        # Anything else parses the descriptor, from the directory or from
+        # the imported file.
+        for nickname, text in (("Bob", edesc["Bob"][3]),
+                               ("Joe", edesc["Joe"][0])):
+            s = ks.getServerInfo(nickname)
+            si = ServerInfo(string=text, assumeValid=1)
+            self.assertSameSD(si, s)
+            eq(si.getPacketKey().get_public_key(),
+               s.getPacketKey().get_public_key())
+            eq(si['Server']['Contact'], s['Server']['Contact'])
+            eq(si.getMMTPHostInfo(), s.getMMTPHostInfo())
+            self.assert_(s._info is not None)
+
         replaceFunction(ks.store.bases[0], 'downloadDirectory')
 
         # Now make sure that update is properly zealous.
@@ -7168,11 +8257,20 @@ class ClientDirectoryTests(TestCase):
             neq(p[1].getNickname(), "Alice")
             neq(p[1].getNickname(), "Joe")
 
+            # The relay graph is reused for paths over the same window,
+            # and discarded when the configuration changes.
+            g = ks._relayGraph
+            self.assert_(g is not None)
+            self.assert_(g.covers(time.time(), time.time()+1))
+            p = ks.getPath([None, None, None])
+            self.assert_(ks._relayGraph is g)
+
             # 2a.1. (Blocking some servers)
             configBlock = mixminion.Config.ClientConfig(string=(
                 "[User]\nUserDir: %s\n[Security]\nBlockServers: Joe\n"
                 "BlockEntries: Alice\nBlockExits: Bob\n" % dirname))
             ks.configure(configBlock)
+            self.assert_(ks._relayGraph is None)
 
             for _ in xrange(100):
                 p = ks.getPath([None]*4)
@@ -7855,7 +8953,13 @@ class FragmentTests(TestCase):
         self.assertEquals(len(pool.listReadyMessages()), 1)
         mid = pool.listReadyMessages()[0]
         self.assertLongStringEq(M2, uncompressData(pool.getReadyMessage(mid)))
+        out = []
+        d = StreamDecompressor(out.append, len(M2))
+        self.assert_(pool.writeReadyMessage(mid, d.feed))
+        d.close()
+        self.assertLongStringEq(M2, "".join(out))
         pool.markMessageCompleted(mid)
+        self.assert_(not pool.writeReadyMessage(mid, out.append))
         pool.close()
         pool = mixminion.Fragments.FragmentPool(loc)
         pool.addFragment(pkts2[48])
@@ -7985,6 +9089,19 @@ wanted to play with the new experimental built-in pinger code.]"""
         # id2 was only down once in the interval; we refuse to extrapolate.
         self.assert_(not ups[interval].has_key(id2))
 
+        # id0 goes down at 100 and comes back at 120.  We only recompute
+        # the intervals that changed, but we should get the same answer as
+        # if we had started from scratch.
+        log.connectFailed(id0,now=t+100)
+        log.connected(id0,now=t+120)
+        log.calculateUptimes(t,t+200,now=t+200)
+        ups = log.getUptimes(t,t+200)
+        self.assertFloatEq(ups[interval][id0], 85/100.)
+        self.assertFloatEq(ups[interval][id1], 40/50.)
+        log._lastUptimeState = None
+        log.calculateUptimes(t,t+200,now=t+200)
+        self.assertEquals(ups, log.getUptimes(t,t+200))
+
         log.calculateChainStatus(now=t+200)
         log.calculateAll(now=t+200)
         log.shutdown()
@@ -43,6 +43,7 @@ typedef struct mm_RSA {
 
 extern PyTypeObject mm_TLSContext_Type;
 extern PyTypeObject mm_TLSSock_Type;
+extern PyTypeObject mm_TLSSession_Type;
 extern PyTypeObject mm_FEC_Type;
 
 /**
@@ -66,6 +67,11 @@ FUNC_DOC(mm_aes_key);
 FUNC_DOC(mm_aes_ctr128_crypt);
 FUNC_DOC(mm_aes128_block_crypt);
 FUNC_DOC(mm_strxor);
+FUNC_DOC(mm_lioness_encrypt);
+FUNC_DOC(mm_lioness_decrypt);
+FUNC_DOC(mm_bear_encrypt);
+FUNC_DOC(mm_bear_decrypt);
+FUNC_DOC(mm_sprp_crypt_inplace);
 FUNC_DOC(mm_openssl_seed);
 #ifdef MS_WINDOWS
 FUNC_DOC(mm_win32_openssl_seed);
@@ -87,6 +93,8 @@ extern char mm_CryptoError__doc__[];
 
 /* From fec.c */
 FUNC_DOC(mm_FEC_generate);
+FUNC_DOC(mm_FEC_getImplementation);
+FUNC_DOC(mm_FEC_setImplementation);
 extern PyTypeObject mm_FEC_Type;
 extern PyObject *mm_FECError;
 extern char mm_FECError__doc__[];
@@ -306,6 +306,277 @@ mm_strxor(PyObject *self, PyObject *args, PyObject *kwdict)
         return output;
 }
 
+/* Helper: set 'out' to the SHA-1 digest of key | data | key, where key is
+ * DIGEST_LEN bytes long.  This is the construction that LIONESS and BEAR
+ * use for their hash rounds; doing it here saves us from copying 'data'
+ * into a temporary string.
+ */
+static void
+mm_sha1_keyed(const unsigned char *key, const unsigned char *data, int len,
+              unsigned char *out)
+{
+        SHA_CTX ctx;
+        SHA1_Init(&ctx);
+        SHA1_Update(&ctx,key,SHA_DIGEST_LENGTH);
+        SHA1_Update(&ctx,data,len);
+        SHA1_Update(&ctx,key,SHA_DIGEST_LENGTH);
+        SHA1_Final(out,&ctx);
+        memset(&ctx,0,sizeof(ctx));
+}
+
+/* Helper: XOR the DIGEST_LEN bytes at 'digest' into 'buf'. */
+static INLINE void
+mm_xor_digest(unsigned char *buf, const unsigned char *digest)
+{
+        int i;
+        for (i = 0; i < SHA_DIGEST_LENGTH; ++i)
+                buf[i] ^= digest[i];
+}
+
+/* Helper: encrypt 'len' bytes at 'buf' in counter mode, using the first
+ * 16 bytes of 'digest' as a key. */
+static void
+mm_ctr_crypt_with_digest(unsigned char *buf, int len,
+                         const unsigned char *digest)
+{
+        AES_KEY aes_key;
+        AES_set_encrypt_key(digest, 128, &aes_key);
+        mm_aes_counter128((char*)buf, (char*)buf, len, &aes_key, 0);
+        memset(&aes_key, 0, sizeof(aes_key));
+}
+
+/* Encrypt (if 'encrypt') or decrypt the 'len' bytes at 'buf' in place with
+ * the LIONESS SPRP, using the four DIGEST_LEN-byte keys in 'keys'.  'len'
+ * must be greater than DIGEST_LEN.  See Crypto.lioness_encrypt. */
+static void
+mm_lioness_crypt(unsigned char *buf, int len, unsigned char **keys,
+                 int encrypt)
+{
+        unsigned char digest[SHA_DIGEST_LENGTH];
+        unsigned char *left = buf, *right = buf+SHA_DIGEST_LENGTH;
+        int rlen = len-SHA_DIGEST_LENGTH;
+
+        if (encrypt) {
+                mm_sha1_keyed(keys[0], left, SHA_DIGEST_LENGTH, digest);
+                mm_ctr_crypt_with_digest(right, rlen, digest);
+                mm_sha1_keyed(keys[1], right, rlen, digest);
+                mm_xor_digest(left, digest);
+                mm_sha1_keyed(keys[2], left, SHA_DIGEST_LENGTH, digest);
+                mm_ctr_crypt_with_digest(right, rlen, digest);
+                mm_sha1_keyed(keys[3], right, rlen, digest);
+                mm_xor_digest(left, digest);
+        } else {
+                mm_sha1_keyed(keys[3], right, rlen, digest);
+                mm_xor_digest(left, digest);
+                mm_sha1_keyed(keys[2], left, SHA_DIGEST_LENGTH, digest);
+                mm_ctr_crypt_with_digest(right, rlen, digest);
+                mm_sha1_keyed(keys[1], right, rlen, digest);
+                mm_xor_digest(left, digest);
+                mm_sha1_keyed(keys[0], left, SHA_DIGEST_LENGTH, digest);
+                mm_ctr_crypt_with_digest(right, rlen, digest);
+        }
+        memset(digest, 0, sizeof(digest));
+}
+
+/* Encrypt (if 'encrypt') or decrypt the 'len' bytes at 'buf' in place with
+ * the BEAR PRP, using the two DIGEST_LEN-byte keys in 'keys'.  'len' must
+ * be greater than DIGEST_LEN.  See Crypto.bear_encrypt. */
+static void
+mm_bear_crypt(unsigned char *buf, int len, unsigned char **keys,
+              int encrypt)
+{
+        unsigned char digest[SHA_DIGEST_LENGTH];
+        unsigned char *left = buf, *right = buf+SHA_DIGEST_LENGTH;
+        int rlen = len-SHA_DIGEST_LENGTH;
+        unsigned char *k1 = keys[encrypt ? 0 : 1];
+        unsigned char *k2 = keys[encrypt ? 1 : 0];
+
+        mm_sha1_keyed(k1, right, rlen, digest);
+        mm_xor_digest(left, digest);
+        SHA1(left, SHA_DIGEST_LENGTH, digest);
+        mm_ctr_crypt_with_digest(right, rlen, digest);
+        mm_sha1_keyed(k2, right, rlen, digest);
+        mm_xor_digest(left, digest);
+        memset(digest, 0, sizeof(digest));
+}
+
+/* Helper: check that 'n' keys with lengths in 'keylens' are all DIGEST_LEN
+ * bytes long, and that a block of length 'len' is long enough to
+ * encrypt.  On failure, raise TypeError and return 0. */
+static int
+mm_check_sprp_args(int len, int *keylens, int n)
+{
+        int i;
+        for (i = 0; i < n; ++i) {
+                if (keylens[i] != SHA_DIGEST_LENGTH) {
+                        TYPE_ERR("Keys must be 20 bytes long");
+                        return 0;
+                }
+        }
+        if (len <= SHA_DIGEST_LENGTH) {
+                TYPE_ERR("String too short to encrypt");
+                return 0;
+        }
+        return 1;
+}
+
+/* Helper: implementation for lioness_encrypt, lioness_decrypt,
+ * bear_encrypt, and bear_decrypt.  Returns a new string holding the
+ * encrypted or decrypted copy of the input. */
+static PyObject*
+mm_sprp_crypt(PyObject *args, PyObject *kwdict, int lioness, int encrypt,
+              char *format)
+{
+        static char *kwlist[] = { "string", "keys", NULL };
+        unsigned char *input, *keys[4];
+        int inputlen, keylens[4];
+        PyObject *output;
+        int ok;
+
+        if (lioness)
+                ok = PyArg_ParseTupleAndKeywords(args, kwdict, format, kwlist,
+                                   &input, &inputlen,
+                                   &keys[0], &keylens[0], &keys[1], &keylens[1],
+                                   &keys[2], &keylens[2], &keys[3], &keylens[3]);
+        else
+                ok = PyArg_ParseTupleAndKeywords(args, kwdict, format, kwlist,
+                                   &input, &inputlen,
+                                   &keys[0], &keylens[0], &keys[1], &keylens[1]);
+        if (!ok)
+                return NULL;
+        if (!mm_check_sprp_args(inputlen, keylens, lioness ? 4 : 2))
+                return NULL;
+
+        if (!(output = PyString_FromStringAndSize(NULL, inputlen))) {
+                PyErr_NoMemory();
+                return NULL;
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        memcpy(PyString_AS_STRING(output), input, inputlen);
+        if (lioness)
+                mm_lioness_crypt(PyString_AS_USTRING(output), inputlen, keys,
+                                 encrypt);
+        else
+                mm_bear_crypt(PyString_AS_USTRING(output), inputlen, keys,
+                              encrypt);
+        Py_END_ALLOW_THREADS
+
+        return output;
+}
+
+const char mm_lioness_encrypt__doc__[] =
+  "lioness_encrypt(string, (key1,key2,key3,key4)) -> str\n\n"
+  "Encrypts a string with the LIONESS super-pseudorandom permutation,\n"
+  "given four 20-byte keys.  See Crypto.lioness_encrypt.\n";
+
+PyObject*
+mm_lioness_encrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return mm_sprp_crypt(args, kwdict, 1, 1,
+                             "s#(s#s#s#s#):lioness_encrypt");
+}
+
+const char mm_lioness_decrypt__doc__[] =
+  "lioness_decrypt(string, (key1,key2,key3,key4)) -> str\n\n"
+  "Decrypts a string with the LIONESS super-pseudorandom permutation,\n"
+  "given four 20-byte keys.  See Crypto.lioness_decrypt.\n";
+
+PyObject*
+mm_lioness_decrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return mm_sprp_crypt(args, kwdict, 1, 0,
+                             "s#(s#s#s#s#):lioness_decrypt");
+}
+
+const char mm_bear_encrypt__doc__[] =
+  "bear_encrypt(string, (key1,key2)) -> str\n\n"
+  "Encrypts a string with the BEAR pseudorandom permutation, given two\n"
+  "20-byte keys.  See Crypto.bear_encrypt.\n";
+
+PyObject*
+mm_bear_encrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return mm_sprp_crypt(args, kwdict, 0, 1, "s#(s#s#):bear_encrypt");
+}
+
+const char mm_bear_decrypt__doc__[] =
+  "bear_decrypt(string, (key1,key2)) -> str\n\n"
+  "Decrypts a string with the BEAR pseudorandom permutation, given two\n"
+  "20-byte keys.  See Crypto.bear_decrypt.\n";
+
+PyObject*
+mm_bear_decrypt(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        return mm_sprp_crypt(args, kwdict, 0, 0, "s#(s#s#):bear_decrypt");
+}
+
+const char mm_sprp_crypt_inplace__doc__[] =
+  "sprp_crypt_inplace(buffer, keys, encrypt=1, offset=0, length=-1)\n\n"
+  "Encrypts or decrypts a writable buffer (such as an array) in place.  If\n"
+  "'keys' holds four 20-byte keys, uses LIONESS; if it holds two, uses\n"
+  "BEAR.  If 'offset' and 'length' are given, only the 'length' bytes\n"
+  "starting at 'offset' are transformed.  A negative length means 'to the\n"
+  "end of the buffer'.\n";
+
+PyObject*
+mm_sprp_crypt_inplace(PyObject *self, PyObject *args, PyObject *kwdict)
+{
+        static char *kwlist[] = { "buffer", "keys", "encrypt", "offset",
+                                  "length", NULL };
+        unsigned char *buf, *keys[4];
+        int buflen, keylens[4], encrypt=1, offset=0, length=-1;
+        PyObject *keytuple;
+        int i, n;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwdict,
+                                         "w#O!|iii:sprp_crypt_inplace", kwlist,
+                                         &buf, &buflen,
+                                         &PyTuple_Type, &keytuple, &encrypt,
+                                         &offset, &length))
+                return NULL;
+
+        if (offset < 0 || offset > buflen) {
+                TYPE_ERR("Offset out of range");
+                return NULL;
+        }
+        if (length < 0)
+                length = buflen - offset;
+        if (length > buflen - offset) {
+                TYPE_ERR("Length out of range");
+                return NULL;
+        }
+        buf += offset;
+        buflen = length;
+
+        n = PyTuple_GET_SIZE(keytuple);
+        if (n != 2 && n != 4) {
+                TYPE_ERR("Expected a tuple of 2 or 4 keys");
+                return NULL;
+        }
+        for (i = 0; i < n; ++i) {
+                PyObject *k = PyTuple_GET_ITEM(keytuple, i);
+                if (!PyString_Check(k)) {
+                        TYPE_ERR("Keys must be strings");
+                        return NULL;
+                }
+                keys[i] = PyString_AS_USTRING(k);
+                keylens[i] = PyString_GET_SIZE(k);
+        }
+        if (!mm_check_sprp_args(buflen, keylens, n))
+                return NULL;
+
+        /* We hold on to the interpreter lock here: nothing stops another
+           thread from resizing the buffer out from under us. */
+        if (n == 4)
+                mm_lioness_crypt(buf, buflen, keys, encrypt);
+        else
+                mm_bear_crypt(buf, buflen, keys, encrypt);
+
+        Py_INCREF(Py_None);
+        return Py_None;
+}
+
 const char mm_openssl_seed__doc__[]=
   "openssl_seed(str)\n\n"
   "Seeds OpenSSL\'s internal random number generator with a provided source\n"
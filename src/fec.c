@@ -288,7 +288,7 @@ generate_gf(void)
  * Note that gcc on
  */
 #define addmul(dst, src, c, sz) \
-    if (c != 0) addmul1(dst, src, c, sz)
+    if (c != 0) addmul_impl(dst, src, c, sz)
 
 #define UNROLL 16 /* 1, 4, 8, 16 */
 static void
@@ -329,6 +329,128 @@ addmul1(gf *dst1, gf *src1, gf c, int sz)
 	GF_ADDMULC( *dst , *src );
 }
 
+/* ======= END OF ORIGINAL addmul; VECTORIZED VERSIONS FOLLOW ======= */
+
+/*
+ * On x86, we can do addmul 16 or 32 bytes at a time with SSSE3 or AVX2.
+ * Multiplication by c is linear over GF(2), so for any byte x,
+ *     c*x == c*(x & 0x0f) ^ c*(x & 0xf0).
+ * We put the 16 possible values of each half in a register, and use
+ * PSHUFB to look up 16 (or 32) low and high nibbles at once.
+ *
+ * We compile these versions with per-function target attributes, so that
+ * the rest of the module doesn't need SSSE3 or AVX2, and we choose among
+ * them at runtime in choose_addmul().  Everywhere else, we use addmul1.
+ */
+#if (GF_BITS == 8) && (defined(__x86_64__) || defined(__i386__)) && \
+    (defined(__clang__) || \
+     (defined(__GNUC__) && (__GNUC__ > 4 || \
+                            (__GNUC__ == 4 && __GNUC_MINOR__ >= 9))))
+#define FEC_USE_SIMD
+#include <immintrin.h>
+#endif
+
+typedef void (*addmul_fn)(gf *dst, gf *src, gf c, int sz);
+static addmul_fn addmul_impl = addmul1;
+static const char *addmul_impl_name = "scalar";
+
+#ifdef FEC_USE_SIMD
+/* Set lo[i] to c*i, and hi[i] to c*(i<<4), for 0 <= i < 16. */
+static void
+make_nibble_tables(gf c, gf *lo, gf *hi)
+{
+    int i;
+    for (i = 0; i < 16; i++) {
+	lo[i] = gf_mul(c, i);
+	hi[i] = gf_mul(c, i << 4);
+    }
+}
+
+__attribute__((target("ssse3")))
+static void
+addmul_ssse3(gf *dst, gf *src, gf c, int sz)
+{
+    gf lo[16], hi[16];
+    __m128i tlo, thi, mask, x, p;
+    int i;
+
+    make_nibble_tables(c, lo, hi);
+    tlo = _mm_loadu_si128((__m128i*)lo);
+    thi = _mm_loadu_si128((__m128i*)hi);
+    mask = _mm_set1_epi8(0x0f);
+
+    for (i = 0; i + 16 <= sz; i += 16) {
+	x = _mm_loadu_si128((__m128i*)(src+i));
+	p = _mm_xor_si128(
+	       _mm_shuffle_epi8(tlo, _mm_and_si128(x, mask)),
+	       _mm_shuffle_epi8(thi, _mm_and_si128(_mm_srli_epi64(x, 4), mask)));
+	p = _mm_xor_si128(p, _mm_loadu_si128((__m128i*)(dst+i)));
+	_mm_storeu_si128((__m128i*)(dst+i), p);
+    }
+    if (i < sz)
+	addmul1(dst+i, src+i, c, sz-i);
+}
+
+__attribute__((target("avx2")))
+static void
+addmul_avx2(gf *dst, gf *src, gf c, int sz)
+{
+    gf lo[16], hi[16];
+    __m256i tlo, thi, mask, x, p;
+    int i;
+
+    make_nibble_tables(c, lo, hi);
+    /* VPSHUFB looks up within each 128-bit lane, so we need the tables
+     * in both lanes. */
+    tlo = _mm256_broadcastsi128_si256(_mm_loadu_si128((__m128i*)lo));
+    thi = _mm256_broadcastsi128_si256(_mm_loadu_si128((__m128i*)hi));
+    mask = _mm256_set1_epi8(0x0f);
+
+    for (i = 0; i + 32 <= sz; i += 32) {
+	x = _mm256_loadu_si256((__m256i*)(src+i));
+	p = _mm256_xor_si256(
+	       _mm256_shuffle_epi8(tlo, _mm256_and_si256(x, mask)),
+	       _mm256_shuffle_epi8(thi,
+				   _mm256_and_si256(_mm256_srli_epi64(x, 4),
+						    mask)));
+	p = _mm256_xor_si256(p, _mm256_loadu_si256((__m256i*)(dst+i)));
+	_mm256_storeu_si256((__m256i*)(dst+i), p);
+    }
+    if (i < sz)
+	addmul1(dst+i, src+i, c, sz-i);
+}
+#endif
+
+/*
+ * Set addmul_impl to the implementation called 'name' ("avx2", "ssse3",
+ * or "scalar"), or to the fastest one this CPU supports if 'name' is
+ * NULL.  Return 0 on success, or -1 if the implementation is unknown or
+ * unsupported.
+ */
+static int
+choose_addmul(const char *name)
+{
+#ifdef FEC_USE_SIMD
+    __builtin_cpu_init();
+    if ((!name || !strcmp(name, "avx2")) && __builtin_cpu_supports("avx2")) {
+	addmul_impl = addmul_avx2;
+	addmul_impl_name = "avx2";
+	return 0;
+    }
+    if ((!name || !strcmp(name, "ssse3")) && __builtin_cpu_supports("ssse3")) {
+	addmul_impl = addmul_ssse3;
+	addmul_impl_name = "ssse3";
+	return 0;
+    }
+#endif
+    if (!name || !strcmp(name, "scalar")) {
+	addmul_impl = addmul1;
+	addmul_impl_name = "scalar";
+	return 0;
+    }
+    return -1;
+}
+
 /*
  * computes C = AB where A is n*k, B is k*m, C is n*m
  */
@@ -551,6 +673,7 @@ init_fec()
 {
     generate_gf();
     init_mul_table();
+    choose_addmul(NULL);
     fec_initialized = 1 ;
 }
 
@@ -834,6 +957,50 @@ mm_FEC_generate(PyObject *self, PyObject *args, PyObject *kwargs)
 	return (PyObject*)output;
 }
 
+const char mm_FEC_getImplementation__doc__[] =
+ "FEC_getImplementation()\n\n"
+ "Return the name of the implementation we use for the FEC inner loop:\n"
+ "one of 'avx2', 'ssse3', or 'scalar'.\n";
+
+PyObject *
+mm_FEC_getImplementation(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        if (PyTuple_Size(args)) {
+                PyErr_SetString(PyExc_TypeError, "No arguments expected");
+                return NULL;
+        }
+        if (fec_initialized == 0)
+                init_fec();
+        return PyString_FromString(addmul_impl_name);
+}
+
+const char mm_FEC_setImplementation__doc__[] =
+ "FEC_setImplementation(name)\n\n"
+ "Use the implementation called 'name' for the FEC inner loop.  (By\n"
+ "default, we use the fastest one this CPU supports.)  Raises FECError if\n"
+ "'name' isn't supported here.  Only useful for testing and benchmarks.\n";
+
+PyObject *
+mm_FEC_setImplementation(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = { "name", NULL };
+        char *name;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "s:FEC_setImplementation", kwlist,
+                                         &name))
+                return NULL;
+        if (fec_initialized == 0)
+                init_fec();
+        if (choose_addmul(name) < 0) {
+                PyErr_SetString(mm_FECError,
+                                "FEC implementation not supported");
+                return NULL;
+        }
+        Py_INCREF(Py_None);
+        return Py_None;
+}
+
 static void
 mm_FEC_dealloc(mm_FEC *self)
 {
@@ -960,21 +1127,155 @@ mm_FEC_encode(PyObject *self, PyObject *args, PyObject *kwargs)
 	return NULL;
 }
 
-static const char mm_FEC_decode__doc__[] =
- "fec.decode([ (idx1,block1), (idx2, block2), ...])\n\n"
- "Recover a FEC-encoded string.  This methods expects as input a list of\n"
- "2-tuples, each containing the index (0<=idx<=N) of an encoded block, and\n"
- "the encoded block itself.  There must be exactly K elements in the list,\n"
- "and their indices must be distinct.  Returns a list of K strings, which\n"
- "when concatenated yields the original FEC-encoded string.\n";
+static const char mm_FEC_encodeChunks__doc__[] =
+"fec.encodeChunks([[blocks...], [blocks...], ...])\n\n"
+"Encode several chunks of FEC-encoded data at once.  Each element of the\n"
+"argument is a list of K strings of equal length, as for encode().\n"
+"Returns a list containing, for each chunk, a list of all N encoded\n"
+"blocks.  The encoding happens without holding the interpreter lock.\n";
 
 static PyObject *
-mm_FEC_decode(PyObject *self, PyObject *args, PyObject *kwargs)
+mm_FEC_encodeChunks(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-	static char *kwlist[] = { "blocks", NULL };
+	static char *kwlist[] = { "chunks", NULL };
         struct fec_parms *fec;
-        PyObject *blocks;
+        PyObject *chunks;
+
+        int nChunks;
+        int c, i;
+        PyObject *o, *chunk, *out;
+
+        PyObject *seq = NULL;
+        PyObject *tups = NULL;
+        char **srcPtrs = NULL;
+        char **dstPtrs = NULL;
+        int *sizes = NULL;
+        PyObject *result = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "O:encodeChunks", kwlist,
+					 &chunks))
+                return NULL;
 
+        fec = ((mm_FEC*)self)->fec;
+
+        if (!PySequence_Check(chunks)) {
+                PyErr_SetString(mm_FECError,
+                                "encodeChunks expects a sequence");
+                return NULL;
+        }
+        /* As in encode, we hold onto each chunk as a tuple so that the
+         * strings can't go away while we're not holding the lock.  (If
+         * 'chunks' is already a tuple, PySequence_Tuple gives us the
+         * caller's object, so we keep the chunk tuples in a new one.) */
+        if (!(seq = PySequence_Tuple(chunks)))
+                return NULL;
+        nChunks = PyTuple_GET_SIZE(seq);
+        if (!(tups = PyTuple_New(nChunks)))
+                goto err;
+
+        if (!(srcPtrs = malloc(sizeof(gf*)*fec->k*(nChunks+1))) ||
+            !(dstPtrs = malloc(sizeof(gf*)*fec->n*(nChunks+1))) ||
+            !(sizes = malloc(sizeof(int)*(nChunks+1)))) {
+                PyErr_NoMemory();
+                goto err;
+        }
+        if (!(result = PyList_New(nChunks)))
+                goto err;
+
+        for (c = 0; c < nChunks; ++c) {
+                o = PyTuple_GET_ITEM(seq, c);
+                if (!PySequence_Check(o) || PySequence_Size(o) != fec->k) {
+                        PyErr_SetString(mm_FECError,
+                           "encodeChunks expects a sequence of lists of length K");
+                        goto err;
+                }
+                if (!(chunk = PySequence_Tuple(o)))
+                        goto err;
+                /* 'tups' steals the reference, and keeps the strings
+                 * alive. */
+                PyTuple_SET_ITEM(tups, c, chunk);
+
+                sizes[c] = -1;
+                for (i = 0; i < fec->k; ++i) {
+                        o = PyTuple_GET_ITEM(chunk, i);
+                        if (!PyString_Check(o)) {
+                                PyErr_SetString(mm_FECError,
+                                      "encodeChunks expects lists of strings");
+                                goto err;
+                        }
+                        if (sizes[c] < 0)
+                                sizes[c] = PyString_Size(o);
+                        else if (sizes[c] != PyString_Size(o)) {
+                                PyErr_SetString(mm_FECError,
+                           "encodeChunks expects lists of equally long strings");
+                                goto err;
+                        }
+                        srcPtrs[c*fec->k + i] = PyString_AS_STRING(o);
+                }
+
+                if (!(out = PyList_New(fec->n)))
+                        goto err;
+                PyList_SET_ITEM(result, c, out);
+                for (i = 0; i < fec->n; ++i) {
+                        if (i < fec->k) {
+                                o = PyTuple_GET_ITEM(chunk, i);
+                                Py_INCREF(o);
+                        } else if (!(o = PyString_FromStringAndSize(NULL,
+                                                                 sizes[c]))) {
+                                goto err;
+                        }
+                        PyList_SET_ITEM(out, i, o);
+                        dstPtrs[c*fec->n + i] = PyString_AS_STRING(o);
+                }
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        for (c = 0; c < nChunks; ++c) {
+                for (i = fec->k; i < fec->n; ++i) {
+                        fec_encode(fec, (gf**)(srcPtrs + c*fec->k),
+                                   (gf*)dstPtrs[c*fec->n + i], i, sizes[c]);
+                }
+        }
+        Py_END_ALLOW_THREADS
+
+        Py_DECREF(seq);
+        Py_DECREF(tups);
+        free(srcPtrs);
+        free(dstPtrs);
+        free(sizes);
+        return result;
+ err:
+        Py_XDECREF(seq);
+        Py_XDECREF(tups);
+        if (srcPtrs)
+                free(srcPtrs);
+        if (dstPtrs)
+                free(dstPtrs);
+        if (sizes)
+                free(sizes);
+        Py_XDECREF(result);
+        return NULL;
+}
+
+/* Helper for decode and decodeChunks: check that 'blocks' is a sequence
+ * of K (index, string) tuples with distinct indices and equally long
+ * strings.  If so, return a new list of K strings to hold the decoded
+ * blocks, fill 'stringPtrs' and 'indices' (each of length K) with the
+ * arguments for fec_decode, and set *szOut to the length of the blocks.
+ *
+ * Any string that is already in the right place is used directly: we
+ * just incref it and put it in the result, since fec_decode won't touch
+ * its buffer.  Any other string, however, will have its contents zapped
+ * by fec_decode: we need to copy those to keep Python strings nice and
+ * immutable.  This way, we never allocate more memory than we need.
+ *
+ * On failure, set an exception and return NULL.
+ */
+static PyObject *
+fec_prepare_decode(struct fec_parms *fec, PyObject *blocks,
+                   char **stringPtrs, int *indices, int *szOut)
+{
         int tmp;
         char *s;
         int sz = -1;
@@ -983,19 +1284,9 @@ mm_FEC_decode(PyObject *self, PyObject *args, PyObject *kwargs)
 
         PyObject *tup = NULL;
         PyObject **objPtrs = NULL;
-        char **stringPtrs = NULL;
-        int *indices = NULL;
         PyObject *result = NULL;
 
-        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                         "O:decode", kwlist,
-					 &blocks))
-                return NULL;
-
-        fec = ((mm_FEC*)self)->fec;
-
-        /* Check whether the second arg is a sequence of K equally sized
-         * strings. */
+        /* Check whether the arg is a sequence of K index-string tuples. */
         if (!PySequence_Check(blocks)) {
                 PyErr_SetString(mm_FECError, "decode expects a sequence");
                 return NULL;
@@ -1012,14 +1303,6 @@ mm_FEC_decode(PyObject *self, PyObject *args, PyObject *kwargs)
         if (!(tup = PySequence_Tuple(blocks))) {
                 return NULL;
         }
-        if (!(stringPtrs = malloc(sizeof(gf*)*fec->k))) {
-                PyErr_NoMemory();
-                goto err;
-        }
-        if (!(indices = malloc(sizeof(int)*fec->k))) {
-                PyErr_NoMemory();
-                goto err;
-        }
         if (!(objPtrs = malloc(sizeof(PyObject*)*fec->k))) {
                 PyErr_NoMemory();
                 goto err;
@@ -1041,57 +1324,99 @@ mm_FEC_decode(PyObject *self, PyObject *args, PyObject *kwargs)
                 indices[i] = j;
                 objPtrs[i] = PyTuple_GET_ITEM(o, 1);
         }
-        if (shuffle(objPtrs, indices, fec->k))
+        if (shuffle(objPtrs, indices, fec->k)) {
+                PyErr_SetString(mm_FECError,
+                                "decode expects distinct indices");
                 goto err;
+        }
         if (!(result = PyList_New(fec->k))) {
                 PyErr_NoMemory(); goto err;
         }
 
-        /* Now set up the result for the user, and stringPtrs/indices
-         * for fec_decode.  Any string objects that are in the right
-         * place in objPtrs won't have their underlying string buffers
-         * touched: we just incref those objects and use them in the
-         * result.  Any other strings, however, will have their
-         * contents zapped by fec_decode: we need to copy those to
-         * keep Python strings nice and immutable.
-         *
-         * This way, we never allocate more memory than we need.
-         *
-         */
         for (i = 0; i < fec->k; ++i) {
                 o = objPtrs[i];
                 if (indices[i] < fec->k) {
                         assert(indices[i] == i);
                         Py_INCREF(o);
-                        PyList_SET_ITEM(result, i, o);
-                        stringPtrs[i] = PyString_AS_STRING(o);
                 } else {
-                        o = PyString_FromStringAndSize(NULL, sz);
+                        if (!(o = PyString_FromStringAndSize(NULL, sz)))
+                                goto err;
                         memcpy(PyString_AS_STRING(o),
                                PyString_AS_STRING(objPtrs[i]), sz);
-                        PyList_SET_ITEM(result, i, o);
-                        stringPtrs[i] = PyString_AS_STRING(o);
                 }
+                PyList_SET_ITEM(result, i, o);
+                stringPtrs[i] = PyString_AS_STRING(o);
+        }
+
+        /* Every buffer in stringPtrs is now owned by 'result'. */
+        free(objPtrs);
+        Py_DECREF(tup);
+        *szOut = sz;
+        return result;
+ err:
+        Py_XDECREF(tup);
+        if (objPtrs)
+                free(objPtrs);
+        Py_XDECREF(result);
+        return NULL;
+}
+
+static const char mm_FEC_decode__doc__[] =
+ "fec.decode([ (idx1,block1), (idx2, block2), ...])\n\n"
+ "Recover a FEC-encoded string.  This methods expects as input a list of\n"
+ "2-tuples, each containing the index (0<=idx<=N) of an encoded block, and\n"
+ "the encoded block itself.  There must be exactly K elements in the list,\n"
+ "and their indices must be distinct.  Returns a list of K strings, which\n"
+ "when concatenated yields the original FEC-encoded string.\n";
+
+static PyObject *
+mm_FEC_decode(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = { "blocks", NULL };
+        struct fec_parms *fec;
+        PyObject *blocks;
+
+        int r;
+        int sz;
+        char **stringPtrs = NULL;
+        int *indices = NULL;
+        PyObject *result = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "O:decode", kwlist,
+					 &blocks))
+                return NULL;
+
+        fec = ((mm_FEC*)self)->fec;
+
+        if (!(stringPtrs = malloc(sizeof(gf*)*fec->k))) {
+                PyErr_NoMemory();
+                goto err;
+        }
+        if (!(indices = malloc(sizeof(int)*fec->k))) {
+                PyErr_NoMemory();
+                goto err;
         }
+        if (!(result = fec_prepare_decode(fec, blocks, stringPtrs, indices,
+                                          &sz)))
+                goto err;
+
         Py_BEGIN_ALLOW_THREADS
-        tmp = fec_decode(fec, (gf**) stringPtrs, (int*) indices, sz);
+        r = fec_decode(fec, (gf**) stringPtrs, (int*) indices, sz);
         Py_END_ALLOW_THREADS
 
-        if (tmp)
+        if (r) {
+                PyErr_SetString(mm_FECError, "Unable to decode blocks");
                 goto err;
+        }
 
         free(stringPtrs);
         free(indices);
-        free(objPtrs);
-        Py_DECREF(tup);
 
         return result;
  err:
-        Py_XDECREF(tup);
         if (indices)
                 free(indices);
-        if (objPtrs)
-                free(objPtrs);
         if (stringPtrs)
                 free(stringPtrs);
         Py_XDECREF(result);
@@ -1099,11 +1424,101 @@ mm_FEC_decode(PyObject *self, PyObject *args, PyObject *kwargs)
 	return NULL;
 }
 
+static const char mm_FEC_decodeChunks__doc__[] =
+ "fec.decodeChunks([ [(idx1,block1), (idx2, block2), ...], ...])\n\n"
+ "Recover several FEC-encoded strings at once.  Each element of the\n"
+ "argument is a list of K (index, block) tuples, as for decode().\n"
+ "Returns a list containing, for each chunk, the list of K strings that\n"
+ "decode() would return.  The decoding happens without holding the\n"
+ "interpreter lock.\n";
+
+static PyObject *
+mm_FEC_decodeChunks(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+	static char *kwlist[] = { "chunks", NULL };
+        struct fec_parms *fec;
+        PyObject *chunks;
+
+        int nChunks;
+        int c, r = 0;
+        PyObject *o;
+
+        PyObject *tups = NULL;
+        char **stringPtrs = NULL;
+        int *indices = NULL;
+        int *sizes = NULL;
+        PyObject *result = NULL;
+
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                         "O:decodeChunks", kwlist,
+					 &chunks))
+                return NULL;
+
+        fec = ((mm_FEC*)self)->fec;
+
+        if (!PySequence_Check(chunks)) {
+                PyErr_SetString(mm_FECError,
+                                "decodeChunks expects a sequence");
+                return NULL;
+        }
+        if (!(tups = PySequence_Tuple(chunks)))
+                return NULL;
+        nChunks = PyTuple_GET_SIZE(tups);
+
+        if (!(stringPtrs = malloc(sizeof(gf*)*fec->k*(nChunks+1))) ||
+            !(indices = malloc(sizeof(int)*fec->k*(nChunks+1))) ||
+            !(sizes = malloc(sizeof(int)*(nChunks+1)))) {
+                PyErr_NoMemory();
+                goto err;
+        }
+        if (!(result = PyList_New(nChunks)))
+                goto err;
+
+        for (c = 0; c < nChunks; ++c) {
+                if (!(o = fec_prepare_decode(fec, PyTuple_GET_ITEM(tups, c),
+                                             stringPtrs + c*fec->k,
+                                             indices + c*fec->k,
+                                             &sizes[c])))
+                        goto err;
+                PyList_SET_ITEM(result, c, o);
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        for (c = 0; c < nChunks && !r; ++c) {
+                r = fec_decode(fec, (gf**)(stringPtrs + c*fec->k),
+                               indices + c*fec->k, sizes[c]);
+        }
+        Py_END_ALLOW_THREADS
+
+        if (r) {
+                PyErr_SetString(mm_FECError, "Unable to decode blocks");
+                goto err;
+        }
+
+        Py_DECREF(tups);
+        free(stringPtrs);
+        free(indices);
+        free(sizes);
+        return result;
+ err:
+        Py_XDECREF(tups);
+        if (stringPtrs)
+                free(stringPtrs);
+        if (indices)
+                free(indices);
+        if (sizes)
+                free(sizes);
+        Py_XDECREF(result);
+	return NULL;
+}
+
 
 static PyMethodDef mm_FEC_methods[] = {
         METHOD(mm_FEC, getParameters),
         METHOD(mm_FEC, encode),
         METHOD(mm_FEC, decode),
+        METHOD(mm_FEC, encodeChunks),
+        METHOD(mm_FEC, decodeChunks),
         { NULL, NULL }
 };
 
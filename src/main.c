@@ -56,6 +56,11 @@ static struct PyMethodDef _mixcryptlib_functions[] = {
         ENTRY(aes_ctr128_crypt),
         ENTRY(aes128_block_crypt),
         ENTRY(strxor),
+        ENTRY(lioness_encrypt),
+        ENTRY(lioness_decrypt),
+        ENTRY(bear_encrypt),
+        ENTRY(bear_decrypt),
+        ENTRY(sprp_crypt_inplace),
         ENTRY(openssl_seed),
         ENTRY(openssl_rand),
 #ifdef MS_WINDOWS
@@ -74,6 +79,8 @@ static struct PyMethodDef _mixcryptlib_functions[] = {
         ENTRY(TLSContext_new),
 
         ENTRY(FEC_generate),
+        ENTRY(FEC_getImplementation),
+        ENTRY(FEC_setImplementation),
         { NULL, NULL }
 };
 
@@ -155,7 +162,8 @@ init_minionlib(void)
 
         /* We set ob_type here so that Cygwin and Win32 are happy. */
         mm_RSA_Type.ob_type = mm_TLSContext_Type.ob_type =
-                mm_TLSSock_Type.ob_type = mm_FEC_Type.ob_type = &PyType_Type;
+                mm_TLSSock_Type.ob_type = mm_TLSSession_Type.ob_type =
+                mm_FEC_Type.ob_type = &PyType_Type;
 
         Py_INCREF(&mm_RSA_Type);
         if (PyDict_SetItemString(d, "RSA", (PyObject*)&mm_RSA_Type) < 0)
@@ -171,6 +179,11 @@ init_minionlib(void)
                                  (PyObject*)&mm_TLSSock_Type) < 0)
                 return;
 
+        Py_INCREF(&mm_TLSSession_Type);
+        if (PyDict_SetItemString(d, "TLSSession",
+                                 (PyObject*)&mm_TLSSession_Type) < 0)
+                return;
+
         Py_INCREF(&mm_FEC_Type);
         if (PyDict_SetItemString(d, "FEC",
                                  (PyObject*)&mm_FEC_Type) < 0)
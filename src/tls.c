@@ -107,20 +107,39 @@ typedef struct mm_TLSSock {
 
 #define mm_TLSSock_Check(v) ((v)->ob_type == &mm_TLSSock_Type)
 
+typedef struct mm_TLSSession {
+        PyObject_HEAD
+        SSL_SESSION *session;
+} mm_TLSSession;
+
+#define mm_TLSSession_Check(v) ((v)->ob_type == &mm_TLSSession_Type)
+
+/* An arbitrary string to identify our sessions to OpenSSL's server-side
+ * session cache. */
+#define SESSION_ID_CONTEXT "mixminion-mmtp"
+
 const char mm_TLSContext_new__doc__[] =
-   "TLSContext([certfile, [rsa, [dhfile] ] ] )\n\n"
+   "TLSContext([certfile, [rsa, [dhfile, [sessionCacheSize,\n"
+   "           [sessionLifetime] ] ] ] ] )\n\n"
    "Allocates a new TLSContext object.  The files, if provided, are used\n"
    "contain the PEM-encoded X509 public keys, private key, and DH\n"
    "parameters for this context.\n\n"
+   "If sessionCacheSize is positive, and a cert is provided, remember up\n"
+   "to that many sessions so that clients can resume them; forget each\n"
+   "one after sessionLifetime seconds.  The cache belongs to the context,\n"
+   "so replacing the context forgets all of its sessions.\n\n"
    "If a cert is provided, assume we're working in server mode, and allow\n\n"
    "LIMITATION: We don\'t expose any more features than Mixminion needs.\n";
 
 PyObject*
 mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-        static char *kwlist[] = { "certfile", "rsa", "dhfile", NULL };
+        static char *kwlist[] = { "certfile", "rsa", "dhfile",
+                                  "sessionCacheSize", "sessionLifetime",
+                                  NULL };
         char *certfile = NULL, *dhfile=NULL;
         mm_RSA *rsa = NULL;
+        int sessionCacheSize = 0, sessionLifetime = 0;
         int err = 0;
 
         SSL_METHOD *method = NULL;
@@ -131,11 +150,13 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
         EVP_PKEY *pkey = NULL;
         mm_TLSContext *result;
 
-        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|sO!s:TLSContext_new",
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|sO!sii:TLSContext_new",
                                          kwlist,
                                          &certfile,
                                          &mm_RSA_Type, &rsa,
-                                         &dhfile))
+                                         &dhfile,
+                                         &sessionCacheSize,
+                                         &sessionLifetime))
                 return NULL;
 
         Py_BEGIN_ALLOW_THREADS;
@@ -160,8 +181,24 @@ mm_TLSContext_new(PyObject *self, PyObject *args, PyObject *kwargs)
         if (!err && certfile &&
             !SSL_CTX_use_certificate_chain_file(ctx,certfile))
                 err = 1;
-        if (!err)
+        if (!err && certfile && sessionCacheSize > 0) {
+                SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_SERVER);
+                SSL_CTX_sess_set_cache_size(ctx, sessionCacheSize);
+                if (sessionLifetime > 0)
+                        SSL_CTX_set_timeout(ctx, sessionLifetime);
+                if (!SSL_CTX_set_session_id_context(ctx,
+                          (unsigned char*)SESSION_ID_CONTEXT,
+                          strlen(SESSION_ID_CONTEXT)))
+                        err = 1;
+        } else if (!err) {
                 SSL_CTX_set_session_cache_mode(ctx, SSL_SESS_CACHE_OFF);
+        }
+#ifdef SSL_OP_NO_TICKET
+        /* Only resume sessions from our own cache: a ticket could outlive
+         * the context (and the certificate) that issued it. */
+        if (!err)
+                SSL_CTX_set_options(ctx, SSL_OP_NO_TICKET);
+#endif
         if (!err && rsa) {
                 if (!(_rsa = RSAPrivateKey_dup(rsa->rsa)) ||
                     !(pkey = EVP_PKEY_new()))
@@ -454,6 +491,61 @@ mm_TLSSock_read(PyObject *self, PyObject *args, PyObject *kwargs)
         }
 }
 
+static char mm_TLSSock_readinto__doc__[] =
+   "tlssock.readinto(buffer, offset=0, size=-1)\n\n"
+   "Tries to read [up to] size bytes from this socket into a writable buffer\n"
+   "(such as an array), starting at offset.  If size is negative, reads up\n"
+   "to the end of the buffer.  Returns the number of bytes read if the read\n"
+   "was successful, and otherwise behaves as tlssock.read.\n";
+
+static PyObject*
+mm_TLSSock_readinto(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        static char *kwlist[] = { "buffer", "offset", "size", NULL };
+        char *buf;
+        int buflen, offset=0, n=-1;
+        SSL *ssl;
+        int r;
+
+        assert(mm_TLSSock_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "w#|ii:readinto",
+                                         kwlist, &buf, &buflen, &offset, &n))
+                return NULL;
+
+        if (offset < 0 || offset > buflen) {
+                TYPE_ERR("Offset out of range");
+                return NULL;
+        }
+        if (n < 0)
+                n = buflen - offset;
+        if (n > buflen - offset) {
+                TYPE_ERR("Size out of range");
+                return NULL;
+        }
+        if (n == 0) {
+                TYPE_ERR("No room to read into");
+                return NULL;
+        }
+
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        /* We hold on to the interpreter lock here: nothing stops another
+           thread from resizing the buffer out from under us. */
+        r = SSL_read(ssl, buf+offset, n);
+        if (r > 0)
+                return PyInt_FromLong(r);
+        switch (tls_error(ssl, r, IGNORE_ZERO_RETURN)) {
+            case NO_ERROR:
+                    Py_INCREF(Py_None);
+                    return Py_None;
+            case ZERO_RETURN:
+                    return PyInt_FromLong(0);
+            case ERROR:
+            default:
+                    return NULL;
+        }
+}
+
 static char mm_TLSSock_write__doc__[] =
    "tlssock.write(string)\n\n"
    "Try to write to a TLS socket.\n"
@@ -742,6 +834,78 @@ mm_TLSSock_verify_cert_and_get_identity_pk(
         return NULL;
 }
 
+static char mm_TLSSock_get_session__doc__[] =
+    "tlssock.get_session()\n\n"
+    "Return a TLSSession for this connection's session, so that a later\n"
+    "connection to the same server can try to resume it.  Returns None if\n"
+    "no session has been negotiated.\n";
+
+static PyObject*
+mm_TLSSock_get_session(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        SSL *ssl;
+        SSL_SESSION *session;
+        mm_TLSSession *result;
+
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        if (!(session = SSL_get1_session(ssl))) {
+                Py_INCREF(Py_None);
+                return Py_None;
+        }
+        if (!(result = PyObject_New(mm_TLSSession, &mm_TLSSession_Type))) {
+                SSL_SESSION_free(session); PyErr_NoMemory(); return NULL;
+        }
+        result->session = session;
+        return (PyObject*) result;
+}
+
+static char mm_TLSSock_set_session__doc__[] =
+    "tlssock.set_session(session)\n\n"
+    "Ask to resume the TLSSession 'session' when this socket connects.\n"
+    "Must be called before connect().  If the server doesn't remember the\n"
+    "session, we fall back to a full handshake.\n";
+
+static PyObject*
+mm_TLSSock_set_session(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        static char *kwlist[] = { "session", NULL };
+        SSL *ssl;
+        mm_TLSSession *session;
+
+        assert(mm_TLSSock_Check(self));
+        if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!:set_session",
+                                         kwlist,
+                                         &mm_TLSSession_Type, &session))
+                return NULL;
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        if (!SSL_set_session(ssl, session->session)) {
+                mm_SSL_ERR(0); return NULL;
+        }
+        Py_INCREF(Py_None);
+        return Py_None;
+}
+
+static char mm_TLSSock_session_reused__doc__[] =
+    "tlssock.session_reused()\n\n"
+    "Return true iff the handshake on this connection resumed an earlier\n"
+    "session instead of negotiating a new one.\n";
+
+static PyObject*
+mm_TLSSock_session_reused(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+        SSL *ssl;
+
+        assert(mm_TLSSock_Check(self));
+        FAIL_IF_ARGS();
+        ssl = ((mm_TLSSock*)self)->ssl;
+
+        return PyInt_FromLong(SSL_session_reused(ssl));
+}
+
 static char mm_TLSSock_renegotiate__doc__[] =
     "tlssock.renegotiate()\n\n"
     "Mark this connection as requiring renegotiation.  No renegotiation is\n"
@@ -819,6 +983,7 @@ static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, connect),
         METHOD(mm_TLSSock, pending),
         METHOD(mm_TLSSock, read),
+        METHOD(mm_TLSSock, readinto),
         METHOD(mm_TLSSock, write),
         METHOD(mm_TLSSock, shutdown),
         METHOD(mm_TLSSock, get_peer_cert_pk),
@@ -829,6 +994,9 @@ static PyMethodDef mm_TLSSock_methods[] = {
         METHOD(mm_TLSSock, renegotiate),
         METHOD(mm_TLSSock, get_num_bytes_raw),
         METHOD(mm_TLSSock, get_cert_lifetime),
+        METHOD(mm_TLSSock, get_session),
+        METHOD(mm_TLSSock, set_session),
+        METHOD(mm_TLSSock, session_reused),
         { NULL, NULL }
 };
 
@@ -860,6 +1028,46 @@ PyTypeObject mm_TLSSock_Type = {
         (char*)mm_TLSSock_Type__doc__
 };
 
+static void
+mm_TLSSession_dealloc(mm_TLSSession *self)
+{
+        SSL_SESSION_free(self->session);
+        PyObject_DEL(self);
+}
+
+static PyMethodDef mm_TLSSession_methods[] = {
+        { NULL, NULL }
+};
+
+static PyObject*
+mm_TLSSession_getattr(PyObject *self, char *name)
+{
+        return Py_FindMethod(mm_TLSSession_methods, self, name);
+}
+
+static const char mm_TLSSession_Type__doc__[] =
+   "mixminion._minionlib.TLSSession\n\n"
+   "An opaque handle for a negotiated TLS session, as returned by\n"
+   "TLSSock.get_session().  It remembers the peer's certificate chain.";
+
+PyTypeObject mm_TLSSession_Type = {
+        PyObject_HEAD_INIT(/*&PyType_Type*/ 0)
+        0,                                  /*ob_size*/
+        "mixminion._minionlib.TLSSession",  /*tp_name*/
+        sizeof(mm_TLSSession),              /*tp_basicsize*/
+        0,                                  /*tp_itemsize*/
+        /* methods */
+        (destructor)mm_TLSSession_dealloc,  /*tp_dealloc*/
+        (printfunc)0,                       /*tp_print*/
+        (getattrfunc)mm_TLSSession_getattr, /*tp_getattr*/
+        (setattrfunc)0,                     /*tp_setattr*/
+        0,0,
+        0,0,0,
+        0,0,0,0,0,
+        0,0,
+        (char*)mm_TLSSession_Type__doc__
+};
+
 /*
   Local Variables:
   mode:c